@@ -3,6 +3,7 @@ import os
 from sunholo.agents import VACRoutes, create_app
 
 from vac_service import vac_stream, vac
+from job_routes import register_render_job_routes
 
 app = create_app(__name__)
 
@@ -10,6 +11,9 @@ app = create_app(__name__)
 # creates /vac/<vector_name> and /vac/streaming/<vector_name>
 VACRoutes(app, vac_stream, vac)
 
+# creates /render/<vector_name> and /render/jobs/<job_id> for background renders
+register_render_job_routes(app)
+
 if __name__ == "__main__":
     import os
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)), debug=False)
@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+"""
+Offline benchmark of the vac_stream agent loop, measuring its overhead apart from model latency.
+
+A scripted model replays predefined streamed text and function calls, quarto is replaced by
+bench/stub_quarto.py and GCS by a local folder, so every number here is our own code.
+Each scenario runs in a fresh process so peak RSS is per scenario.
+
+    cd quarto
+    python bench/bench_agent_loop.py                       # all scenarios
+    python bench/bench_agent_loop.py render_fix_render --json bench_output.json
+
+Reports per loop latency, time per tool and per stage span, bytes uploaded and peak RSS.
+"""
+import argparse
+import functools
+import hashlib
+import base64
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+QUARTO_DIR = os.path.dirname(BENCH_DIR)
+
+SCRIPT = '''# %% [markdown]
+# ---
+# title: Benchmark report {version}
+# ---
+
+# %%
+values = list(range({version} * 10))
+print(sum(values))
+
+# %% [markdown]
+# The total changes with each fix.
+'''
+
+
+def call(name, **args):
+    # like the proto-plus FunctionCall, a call without arguments has args None
+    return {"function_call": {"name": name, "args": args or None}}
+
+
+def text(chunk):
+    return {"text": chunk}
+
+
+def render_fix_render(steps=10):
+    """write_to_file then render, with a one line fix each step"""
+    turns = []
+    for step in range(steps):
+        turns.append([
+            text(f"Step {step}: writing and rendering the report. "),
+            call("write_to_file", text=SCRIPT.format(version=step), file_path="renders/report.py"),
+            call("render_and_upload_quarto", markdown_filename="renders/report.py", format="html"),
+        ])
+    turns[0].insert(1, call("quarto_version"))
+    turns.append([call("decide_to_go_on", go_on=False, chat_summary="Report rendered")])
+    return {"turns": turns, "env": {}}
+
+
+def html_200_files():
+    """one render whose output has 200 dependency files to upload"""
+    return {
+        "turns": [
+            [text("Rendering. "), call("render_and_upload_quarto", markdown_filename="tools/demo.qmd", format="html")],
+            [call("decide_to_go_on", go_on=False, chat_summary="Done")],
+        ],
+        "env": {"STUB_QUARTO_FILES": "200", "STUB_QUARTO_FILE_BYTES": "20000"},
+    }
+
+
+def large_logs():
+    """renders that write 20k log lines each"""
+    turns = [[call("quarto_command", cmd="render tools/demo.qmd --to=html")] for _ in range(3)]
+    turns.append([call("decide_to_go_on", go_on=False, chat_summary="Done")])
+    return {"turns": turns, "env": {"STUB_QUARTO_LOG_LINES": "20000", "STUB_QUARTO_DELAY": "0"}}
+
+
+def cached_rerender(repeats=5):
+    """the same document rendered again and again"""
+    turns = [[call("render_and_upload_quarto", markdown_filename="tools/demo.qmd", format="html")] for _ in range(repeats)]
+    turns.append([call("decide_to_go_on", go_on=False, chat_summary="Done")])
+    return {"turns": turns, "env": {}}
+
+
+def multi_format():
+    """html, pdf and docx of one document in a single call"""
+    return {
+        "turns": [
+            [call("render_and_upload_quarto", markdown_filename="tools/demo.qmd", format="html,pdf,docx")],
+            [call("decide_to_go_on", go_on=False, chat_summary="Done")],
+        ],
+        "env": {"STUB_QUARTO_DELAY": "0.3", "STUB_QUARTO_EXECUTE_DELAY": "1.0"},
+    }
+
+
+def separate_formats():
+    """html, pdf and docx of one document as three calls, to compare with multi_format"""
+    turns = [[call("render_and_upload_quarto", markdown_filename="tools/demo.qmd", format=fmt)]
+             for fmt in ("html", "pdf", "docx")]
+    turns.append([call("decide_to_go_on", go_on=False, chat_summary="Done")])
+    return {"turns": turns, "env": {"STUB_QUARTO_DELAY": "0.3", "STUB_QUARTO_EXECUTE_DELAY": "1.0"}}
+
+
+def broken_script():
+    """a script with a bad cell option and a syntax error, caught before rendering, then fixed"""
+    broken = SCRIPT.format(version=1).replace("# %%\n", "# %%\n#| echo false\n", 1).replace("print(sum(values))", "print(sum(values)")
+    return {
+        "turns": [
+            [call("write_to_file", text=broken, file_path="renders/report.py"),
+             call("render_and_upload_quarto", markdown_filename="renders/report.py", format="html")],
+            [call("write_to_file", text=SCRIPT.format(version=1), file_path="renders/report.py"),
+             call("render_and_upload_quarto", markdown_filename="renders/report.py", format="html")],
+            [call("decide_to_go_on", go_on=False, chat_summary="Done")],
+        ],
+        "env": {"STUB_QUARTO_DELAY": "1.0"},
+    }
+
+
+def parallel_calls(tool_workers=4):
+    """two scripts written and rendered in one turn, each render waiting only for its own write"""
+    return {
+        "turns": [
+            [call("write_to_file", text=SCRIPT.format(version=1), file_path="renders/first.py"),
+             call("write_to_file", text=SCRIPT.format(version=2), file_path="renders/second.py"),
+             call("render_and_upload_quarto", markdown_filename="renders/first.py", format="html"),
+             call("render_and_upload_quarto", markdown_filename="renders/second.py", format="html")],
+            [call("decide_to_go_on", go_on=False, chat_summary="Done")],
+        ],
+        "env": {"STUB_QUARTO_DELAY": "1.0"},
+        "tool_config": {"tool_workers": tool_workers},
+    }
+
+
+def serial_calls():
+    """parallel_calls with one call at a time, as before function calls ran concurrently"""
+    return parallel_calls(tool_workers=1)
+
+
+def report_series(publish=None):
+    """three reports rendered one after another, each with the same 200 HTML dependency files"""
+    turns = [[call("write_to_file", text=SCRIPT.format(version=version), file_path=f"renders/report{version}.py"),
+              call("render_and_upload_quarto", markdown_filename=f"renders/report{version}.py", format="html")]
+             for version in range(3)]
+    turns.append([call("decide_to_go_on", go_on=False, chat_summary="Done")])
+    scenario = {"turns": turns, "env": {"STUB_QUARTO_FILES": "200", "STUB_QUARTO_FILE_BYTES": "20000"}}
+    if publish is not None:
+        scenario["tool_config"] = {"publish": publish}
+    return scenario
+
+
+def report_series_upload_all():
+    """report_series uploading every file of each render, as before selective publishing"""
+    return report_series(publish=False)
+
+
+def report_series_embedded():
+    """report_series rendering self-contained HTML"""
+    return report_series(publish={"embed_resources": True})
+
+
+def runaway_render():
+    """a render holding more memory than the sandbox allows, stopped by the watchdog rather than left to run"""
+    return {
+        "turns": [
+            [call("render_and_upload_quarto", markdown_filename="tools/demo.qmd", format="html")],
+            [call("decide_to_go_on", go_on=False, chat_summary="Done")],
+        ],
+        "env": {"STUB_QUARTO_ALLOCATE_MB": "300", "STUB_QUARTO_DELAY": "2.0"},
+        "tool_config": {"sandbox": {"max_rss_bytes": 200 * 1024 * 1024}},
+    }
+
+
+def long_script(scale):
+    """a percent script of about 20k characters, whose only difference between versions is the scale line"""
+    cells = [f"# %%\nseries_{cell} = [value * scale for value in range({cell}, {cell} + 40)]\n"
+             f"print('Series {cell}: total', sum(series_{cell}), 'largest', max(series_{cell}))\n\n"
+             for cell in range(150)]
+    return ("# %% [markdown]\n# ---\n# title: Long benchmark report\n# ---\n\n"
+            f"# %%\nscale = {scale}\n\n" + "".join(cells))
+
+
+def long_script_chunked(fixes=2, chunk_chars=4000):
+    """a long script written in 4000 character appends and rewritten whole for each fix, as write_to_file once required"""
+    turns = []
+    for scale in range(1, fixes + 2):
+        script = long_script(scale)
+        chunks = [script[start:start + chunk_chars] for start in range(0, len(script), chunk_chars)]
+        turns.extend([call("write_to_file", text=chunk, file_path="renders/long.py", append=position > 0)]
+                     for position, chunk in enumerate(chunks))
+        turns.append([call("render_and_upload_quarto", markdown_filename="renders/long.py", format="html")])
+    turns.append([call("decide_to_go_on", go_on=False, chat_summary="Done")])
+    return {"turns": turns, "env": {}}
+
+
+def long_script_edited(fixes=2):
+    """long_script_chunked with the script written once and each fix a one line edit_file diff"""
+    turns = [[call("write_to_file", text=long_script(1), file_path="renders/long.py"),
+              call("render_and_upload_quarto", markdown_filename="renders/long.py", format="html")]]
+    for scale in range(2, fixes + 2):
+        sha256 = hashlib.sha256(long_script(scale - 1).encode("utf-8")).hexdigest()
+        turns.append([call("edit_file", file_path="renders/long.py", expected_sha256=sha256[:12],
+                           diff=f"@@ -7,1 +7,1 @@\n-scale = {scale - 1}\n+scale = {scale}\n"),
+                      call("render_and_upload_quarto", markdown_filename="renders/long.py", format="html")])
+    turns.append([call("decide_to_go_on", go_on=False, chat_summary="Done")])
+    return {"turns": turns, "env": {}}
+
+
+MARKDOWN_SCRIPT = '''# %% [markdown]
+# ---
+# title: Notes {version}
+# ---
+
+# %% [markdown]
+# A script with no code cells, revision {version}.
+
+# %% [raw] format="html"
+# <p>Raw HTML passed through.</p>
+'''
+
+
+def markdown_script(fast_path=True, kernel_pool=False):
+    """a .py script of markdown cells only, rendered to html and then to html and pdf, for a new revision each time"""
+    turns = [[call("write_to_file", text=MARKDOWN_SCRIPT.format(version=version), file_path="renders/notes.py"),
+              call("render_and_upload_quarto", markdown_filename="renders/notes.py", format=fmt)]
+             for version, fmt in enumerate(("html", "html", "html,pdf"))]
+    turns.append([call("decide_to_go_on", go_on=False, chat_summary="Done")])
+    return {
+        "turns": turns,
+        "env": {"STUB_QUARTO_DELAY": "0.3", "STUB_QUARTO_EXECUTE_DELAY": "1.5"},
+        "tool_config": {"fast_path": {"enabled": fast_path}, "kernel_pool": kernel_pool},
+    }
+
+
+def markdown_script_standard():
+    """markdown_script through Jupyter, as before the markdown engine fast path"""
+    return markdown_script(fast_path=False)
+
+
+def markdown_script_kernel_pool():
+    """markdown_script executed in a pooled kernel, as before the fast path with the kernel pool on"""
+    return markdown_script(fast_path=False, kernel_pool={"size": 1})
+
+
+SCENARIOS = {
+    "render_fix_render": render_fix_render,
+    "html_200_files": html_200_files,
+    "large_logs": large_logs,
+    "cached_rerender": cached_rerender,
+    "multi_format": multi_format,
+    "separate_formats": separate_formats,
+    "broken_script": broken_script,
+    "parallel_calls": parallel_calls,
+    "serial_calls": serial_calls,
+    "report_series": report_series,
+    "report_series_upload_all": report_series_upload_all,
+    "report_series_embedded": report_series_embedded,
+    "runaway_render": runaway_render,
+    "long_script_chunked": long_script_chunked,
+    "long_script_edited": long_script_edited,
+    "markdown_script": markdown_script,
+    "markdown_script_standard": markdown_script_standard,
+    "markdown_script_kernel_pool": markdown_script_kernel_pool,
+}
+
+
+class ScriptedResponse:
+
+    def __init__(self, turn, prompt_tokens):
+        self._chunks = [SimpleNamespace(text=item["text"]) for item in turn if "text" in item]
+        parts = []
+        for item in turn:
+            if "function_call" in item:
+                parts.append(SimpleNamespace(function_call=SimpleNamespace(**item["function_call"])))
+            else:
+                parts.append(SimpleNamespace(function_call=None, text=item["text"]))
+        self.candidates = [SimpleNamespace(content=SimpleNamespace(parts=parts))]
+        candidates_tokens = sum(len(json.dumps(item)) for item in turn) // 4
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=candidates_tokens,
+            total_token_count=prompt_tokens + candidates_tokens,
+        )
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+
+class ScriptedChat:
+    """Replays turns in order, estimating prompt tokens from everything sent so far."""
+
+    def __init__(self, turns, stats):
+        self._turns = list(turns)
+        self._stats = stats
+        self._history_chars = 0
+        self.history = []
+
+    def send_message(self, message, stream=True):
+        now = time.perf_counter()
+        if self._stats["sends"]:
+            self._stats["loop_seconds"].append(now - self._stats["sends"][-1])
+        self._stats["sends"].append(now)
+
+        self._history_chars += len(str(message))
+        if not self._turns:
+            raise RuntimeError("Scripted model has no more turns")
+        turn = self._turns.pop(0)
+        self._history_chars += sum(len(json.dumps(item)) for item in turn)
+        self._stats["prompt_tokens"].append(self._history_chars // 4)
+
+        return ScriptedResponse(turn, prompt_tokens=self._history_chars // 4)
+
+
+class ScriptedModel:
+
+    def __init__(self, turns, stats):
+        self.turns = turns
+        self.stats = stats
+
+    def start_chat(self, history=None):
+        return ScriptedChat(self.turns, self.stats)
+
+
+class LocalBlob:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.content_encoding = None
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def md5_hash(self):
+        with open(self.path, 'rb') as f:
+            return base64.b64encode(hashlib.md5(f.read()).digest()).decode('utf-8')
+
+    def upload_from_filename(self, filename, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+        self.bucket.stats["uploads"] += 1
+        self.bucket.stats["bytes_uploaded"] += os.path.getsize(filename)
+
+
+class LocalBucket:
+    """Stands in for a GCS bucket, storing blobs under a local folder."""
+
+    def __init__(self, root, stats):
+        self.root = root
+        self.stats = stats
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def list_blobs(self, prefix=""):
+        folder = os.path.join(self.root, prefix)
+        for root, _, files in os.walk(folder):
+            for file in files:
+                yield self.blob(os.path.relpath(os.path.join(root, file), self.root))
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        target = destination_bucket.blob(new_name)
+        os.makedirs(os.path.dirname(target.path), exist_ok=True)
+        shutil.copyfile(blob.path, target.path)
+        self.stats["copies"] += 1
+
+
+class LocalStorageClient:
+
+    def __init__(self, root, stats):
+        self._bucket = LocalBucket(root, stats)
+
+    def bucket(self, name):
+        return self._bucket
+
+
+class CountingCallback:
+    """Counts what is streamed, passing it on to sunholo's streaming handler as VACRoutes does when available."""
+
+    def __init__(self):
+        self.tokens = 0
+        self.chars = 0
+        try:
+            from sunholo.streaming.content_buffer import ContentBuffer, BufferStreamingStdOutCallbackHandler
+            self.handler = BufferStreamingStdOutCallbackHandler(content_buffer=ContentBuffer(), tokens=".!?\n")
+        except ImportError:
+            self.handler = None
+
+    def on_llm_new_token(self, token):
+        self.tokens += 1
+        self.chars += len(token)
+        if self.handler:
+            self.handler.on_llm_new_token(token=token)
+
+    def on_llm_end(self, response):
+        if self.handler:
+            self.handler.on_llm_end(response=response)
+
+
+class BenchConfig:
+    """A ConfigManager stand-in holding the vacConfig for the benchmark."""
+
+    def __init__(self, vac_config):
+        self.vector_name = "bench"
+        self.config_folder = None
+        self.local_config_folder = None
+        self._vac_config = vac_config
+
+    def vacConfig(self, key):
+        return self._vac_config.get(key)
+
+
+def run_scenario(name: str) -> dict:
+    scenario = SCENARIOS[name]()
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    os.makedirs(os.path.join(workdir, "renders"))
+    os.makedirs(os.path.join(workdir, "tools"))
+    shutil.copy(os.path.join(QUARTO_DIR, "tools", "demo.qmd"), os.path.join(workdir, "tools", "demo.qmd"))
+    os.environ.update(scenario["env"])
+    os.environ["QUARTO_BIN"] = os.path.join(BENCH_DIR, "stub_quarto.py")
+    os.environ.setdefault("STUB_QUARTO_DELAY", "0.05")
+    # the scripted model never calls the API, but init_genai() needs a key to configure google.generativeai
+    os.environ.setdefault("GOOGLE_API_KEY", "bench")
+
+    sys.path.insert(0, QUARTO_DIR)
+    os.chdir(workdir)
+
+    import vac_service
+    from tools import quarto_agent
+
+    stats = {"sends": [], "loop_seconds": [], "prompt_tokens": [], "tools": {},
+             "uploads": 0, "bytes_uploaded": 0, "copies": 0}
+
+    quarto_agent.get_storage_client = lambda: LocalStorageClient(os.path.join(workdir, "bucket"), stats)
+    quarto_agent.resolve_bucket = lambda vector_name: "bench-bucket"
+    vac_service.get_genai().upload_file = lambda filename: f"uploaded:{filename}"
+
+    original_construct_tools = quarto_agent.QuartoProcessor.construct_tools
+
+    def timed_construct_tools(processor):
+        def timed(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    tool = stats["tools"].setdefault(fn.__name__, {"calls": 0, "seconds": 0.0})
+                    tool["calls"] += 1
+                    tool["seconds"] += time.perf_counter() - start
+            return wrapper
+        return {name: timed(fn) for name, fn in original_construct_tools(processor).items()}
+
+    quarto_agent.QuartoProcessor.construct_tools = timed_construct_tools
+
+    config = BenchConfig({
+        "llm": "vertex",
+        "model": "scripted",
+        "tools": {"quarto": dict({"kernel_pool": False}, **scenario.get("tool_config", {}))},
+    })
+    model = ScriptedModel(scenario["turns"], stats)
+    vac_service.get_vac = lambda vector_name: (config, model)
+
+    callback = CountingCallback()
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    result = vac_service.vac_stream("benchmark", "bench", callback=callback, max_steps=len(scenario["turns"]) + 1)
+    total = time.perf_counter() - start
+    loop_cpu = time.process_time() - start_cpu
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    loops = stats["loop_seconds"]
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "scenario": name,
+        "total_seconds": round(total, 3),
+        "loops": len(stats["sends"]),
+        "loop_seconds_mean": round(sum(loops) / len(loops), 4) if loops else 0,
+        "loop_seconds_max": round(max(loops), 4) if loops else 0,
+        "tools": {tool: {"calls": v["calls"], "seconds": round(v["seconds"], 4)} for tool, v in stats["tools"].items()},
+        "uploads": stats["uploads"],
+        "bytes_uploaded": stats["bytes_uploaded"],
+        "server_side_copies": stats["copies"],
+        "final_prompt_tokens": stats["prompt_tokens"][-1] if stats["prompt_tokens"] else 0,
+        "streamed_tokens": callback.tokens,
+        "streamed_chars": callback.chars,
+        "answer_chars": len(result["answer"]),
+        "stage_seconds": result["metadata"]["timings"],
+        "peak_rss_mb": round(self_usage.ru_maxrss / 1024, 1),
+        "peak_child_rss_mb": round(child_usage.ru_maxrss / 1024, 1),
+        "cpu_seconds": round(self_usage.ru_utime + self_usage.ru_stime, 3),
+        "loop_cpu_seconds": round(loop_cpu, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run, from {', '.join(SCENARIOS)} (default all)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_scenario(args.run_one)))
+        return
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios {', '.join(sorted(unknown))}")
+
+    results = []
+    for name in args.scenarios or list(SCENARIOS):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", name],
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            print(f"{name} failed:\n{output.stderr[-4000:]}", file=sys.stderr)
+            continue
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        results.append(result)
+        tools = ", ".join(f"{tool} {v['calls']}x {v['seconds']}s" for tool, v in result["tools"].items())
+        print(f"{name:<20} total {result['total_seconds']}s  loops {result['loops']} "
+              f"(mean {result['loop_seconds_mean']}s, max {result['loop_seconds_max']}s)  "
+              f"uploaded {result['uploads']} files / {result['bytes_uploaded']} bytes  "
+              f"prompt tokens {result['final_prompt_tokens']}  peak RSS {result['peak_rss_mb']}MB")
+        print(f"{'':<20} streamed {result['streamed_tokens']} tokens / {result['streamed_chars']} chars  "
+              f"loop CPU {result['loop_cpu_seconds']}s")
+        print(f"{'':<20} {tools}")
+        print(f"{'':<20} stages: {', '.join(f'{stage} {seconds}s' for stage, seconds in result['stage_seconds'].items())}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
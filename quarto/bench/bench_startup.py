@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Benchmark of how long a new instance takes before it can answer, i.e. what scale-from-zero adds to the first answer.
+
+    cd quarto
+    python bench/bench_startup.py                 # 4 workers, as in cloudbuild.yaml
+    python bench/bench_startup.py --workers 2 --json startup.json
+
+Reports:
+    import         seconds to import app in a new interpreter, and the slowest top level imports
+    first request  the first and second offline request in one process (scripted model, as in
+                   bench_agent_loop.py), without and with warm_up() having run first
+    workers        seconds until the first and the last of --workers processes have the app loaded, each
+                   importing it itself (gunicorn without preload) or forked from a master that imported it
+                   once (preload_app in gunicorn.conf.py)
+"""
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+QUARTO_DIR = os.path.dirname(BENCH_DIR)
+VECTOR_NAME = "quarto_test"
+
+
+def bench_env() -> dict:
+    env = dict(os.environ)
+    # the scripted model never calls the API, but init_genai() needs a key to configure google.generativeai
+    env.setdefault("GOOGLE_API_KEY", "bench")
+    env.setdefault("VAC_CONFIG_FOLDER", os.path.join(QUARTO_DIR, "config"))
+    env["QUARTO_BIN"] = os.path.join(BENCH_DIR, "stub_quarto.py")
+    return env
+
+
+def measure_import(top: int = 5) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)"],
+        cwd=QUARTO_DIR, env=bench_env(), capture_output=True, text=True, check=True
+    )
+    seconds = float(output.stdout.strip().splitlines()[-1])
+
+    # "import time: self [us] | cumulative | imported package", where a package's first import includes its own
+    # imports of other packages - so each package's largest cumulative time is what importing it costs
+    packages = {}
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        package = name.strip().split(".")[0]
+        if cumulative.strip().isdigit() and package not in ("app", "vac_service", "job_routes", "tools"):
+            packages[package] = max(packages.get(package, 0), int(cumulative))
+
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        "import_seconds": round(seconds, 3),
+        "slowest_imports": {package: round(us / 1e6, 3) for package, us in slowest},
+    }
+
+
+def run_first_request(warm: bool) -> dict:
+    """Runs in its own process: imports vac_service and times its first two requests."""
+    sys.path.insert(0, QUARTO_DIR)
+    os.chdir(QUARTO_DIR)
+    os.environ.update(bench_env())
+
+    start = time.perf_counter()
+    import vac_service
+    from bench_agent_loop import ScriptedModel, CountingCallback, call
+    import_seconds = time.perf_counter() - start
+
+    warm_up_seconds = 0
+    if warm:
+        start = time.perf_counter()
+        vac_service.warm_up([VECTOR_NAME])
+        warm_up_seconds = time.perf_counter() - start
+
+    # the real config and model are built, but the chat is scripted so nothing goes over the network
+    get_vac = vac_service.get_vac
+    turns = [[call("decide_to_go_on", go_on=False, chat_summary="Done")]]
+    stats = {"sends": [], "loop_seconds": [], "prompt_tokens": []}
+    vac_service.get_vac = lambda vector_name: (get_vac(vector_name)[0], ScriptedModel(turns, stats))
+
+    requests = []
+    for _ in range(2):
+        start = time.perf_counter()
+        vac_service.vac_stream("benchmark", VECTOR_NAME, callback=CountingCallback())
+        requests.append(round(time.perf_counter() - start, 3))
+
+    return {
+        "warm_up": warm,
+        "import_seconds": round(import_seconds, 3),
+        "warm_up_seconds": round(warm_up_seconds, 3),
+        "first_request_seconds": requests[0],
+        "second_request_seconds": requests[1],
+    }
+
+
+def measure_workers(workers: int, preload: bool) -> dict:
+    start = time.perf_counter()
+    ready = []
+    if preload:
+        sys.path.insert(0, QUARTO_DIR)
+        os.chdir(QUARTO_DIR)
+        os.environ.update(bench_env())
+        # imported only for its module load, as a gunicorn master with preload does before forking the workers
+        importlib.import_module("app")
+        pids = []
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+            ready.append(time.perf_counter() - start)
+    else:
+        processes = [subprocess.Popen([sys.executable, "-c", "import app"], cwd=QUARTO_DIR, env=bench_env(),
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                     for _ in range(workers)]
+        for process in processes:
+            process.wait()
+            ready.append(time.perf_counter() - start)
+
+    return {
+        "preload": preload,
+        "workers": workers,
+        "first_worker_ready_seconds": round(min(ready), 3),
+        "all_workers_ready_seconds": round(max(ready), 3),
+    }
+
+
+def run_in_process(*args) -> dict:
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), *args], capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed:\n{output.stderr[-4000:]}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers per instance (default 4)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--run-first-request", choices=["cold", "warm"], help=argparse.SUPPRESS)
+    parser.add_argument("--run-workers", choices=["preload", "no-preload"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_first_request:
+        print(json.dumps(run_first_request(warm=args.run_first_request == "warm")))
+        return
+    if args.run_workers:
+        print(json.dumps(measure_workers(args.workers, preload=args.run_workers == "preload")))
+        return
+
+    results = {"import": measure_import()}
+    print(f"import          {results['import']['import_seconds']}s  slowest: "
+          f"{', '.join(f'{name} {seconds}s' for name, seconds in results['import']['slowest_imports'].items())}")
+
+    results["first_request"] = [run_in_process("--run-first-request", mode) for mode in ("cold", "warm")]
+    for result in results["first_request"]:
+        print(f"first request   {'warmed' if result['warm_up'] else 'cold':<10} first {result['first_request_seconds']}s  "
+              f"second {result['second_request_seconds']}s  (warm_up {result['warm_up_seconds']}s)")
+
+    results["workers"] = [run_in_process("--run-workers", mode, "--workers", str(args.workers))
+                          for mode in ("no-preload", "preload")]
+    for result in results["workers"]:
+        print(f"{result['workers']} workers       {'preload' if result['preload'] else 'no preload':<10} "
+              f"first ready {result['first_worker_ready_seconds']}s  all ready {result['all_workers_ready_seconds']}s")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Stand-in for the quarto binary, for running renders locally without Quarto installed:
+
+    QUARTO_BIN=bench/stub_quarto.py python app.py
+
+Behaviour is set with environment variables:
+    STUB_QUARTO_DELAY         seconds each render takes (default 0.5)
+    STUB_QUARTO_EXECUTE_DELAY extra seconds for renders that execute code, i.e. not --no-execute, not an .ipynb
+                              unless --execute is given, and not a .qmd or .md without code cells (default 0)
+    STUB_QUARTO_LOG_LINES     lines of progress written to stderr per render (default 10)
+    STUB_QUARTO_FILES         extra script files written into <output>_files/libs/stub/ per render and referenced
+                              from the output, or inlined into it with -M embed-resources:true (default 0)
+    STUB_QUARTO_FILE_BYTES    size of each extra file, JavaScript-like text the same for every render (default 4096)
+    STUB_QUARTO_EXIT          exit code of renders (default 0)
+    STUB_QUARTO_ALLOCATE_MB   memory held while rendering, to try out memory limits (default 0)
+"""
+import os
+import random
+import re
+import sys
+import time
+
+JS_WORDS = ("function", "return", "var", "this", "document", "window", "null", "length", "if", "else",
+            "for", "=", "(", ")", "{", "}", ";", ".", "0", "1", "e", "t", "n", "r")
+
+
+def env_number(name, default):
+    return type(default)(os.getenv(name, default))
+
+
+def has_code(source, args):
+    """Whether Quarto would start Jupyter or knitr for source, roughly as its engine detection does"""
+    if source.endswith(".ipynb"):
+        return "--execute" in args
+    if source.lower().endswith((".qmd", ".md")):
+        with open(source, encoding="utf-8", errors="replace") as f:
+            return re.search(r"^```+\s*\{(python|r|julia)\b", f.read(), flags=re.MULTILINE) is not None
+    return True
+
+
+def render(args):
+    source = args[0]
+    to = "html"
+    output = None
+    embed = False
+    for previous, arg in zip(args, args[1:]):
+        if arg.startswith("--to="):
+            to = arg.split("=", 1)[1]
+        elif arg.startswith("--output="):
+            output = arg.split("=", 1)[1]
+        elif previous == "-M" and arg == "embed-resources:true":
+            embed = True
+    output = output or f"{os.path.splitext(os.path.basename(source))[0]}.{to.split(',')[0]}"
+
+    log_lines = env_number("STUB_QUARTO_LOG_LINES", 10)
+    delay = env_number("STUB_QUARTO_DELAY", 0.5)
+    executes = "--no-execute" not in args and has_code(source, args)
+    if executes:
+        delay += env_number("STUB_QUARTO_EXECUTE_DELAY", 0.0)
+    held = bytearray(env_number("STUB_QUARTO_ALLOCATE_MB", 0) * 1024 * 1024)
+    for page in range(0, len(held), 4096):
+        held[page] = 1
+    for line in range(log_lines):
+        print(f"[{line + 1}/{log_lines}] rendering {source} to {to}", file=sys.stderr, flush=True)
+        time.sleep(delay / max(log_lines, 1))
+
+    exit_code = env_number("STUB_QUARTO_EXIT", 0)
+    if exit_code:
+        print(f"ERROR: stub render of {source} failed", file=sys.stderr)
+        return exit_code
+
+    with open(source, 'rb') as f:
+        content = f.read()
+
+    libraries = []
+    libs = os.path.join(f"{os.path.splitext(output)[0]}_files", "libs", "stub")
+    for number in range(env_number("STUB_QUARTO_FILES", 0)):
+        # the same pseudo-random text each render, as a Quarto version always ships the same libraries
+        words = random.Random(number).choices(JS_WORDS, k=env_number("STUB_QUARTO_FILE_BYTES", 4096) // 3)
+        libraries.append((f"lib{number}.js", " ".join(words).encode("utf-8")))
+
+    head = b""
+    for name, script in libraries:
+        if embed:
+            head += b"<script>" + script + b"</script>"
+        else:
+            os.makedirs(libs, exist_ok=True)
+            with open(os.path.join(libs, name), 'wb') as f:
+                f.write(script)
+            head += f'<script src="{libs.replace(os.sep, "/")}/{name}"></script>'.encode("utf-8")
+
+    with open(output, 'wb') as f:
+        f.write(b"<html><head>" + head + b"</head><body><pre>" + content + b"</pre></body></html>")
+
+    print(f"Output created: {output}", file=sys.stderr)
+    return 0
+
+
+def main(args):
+    if not args or args[0] in ("--version", "-v"):
+        print("1.5.56-stub")
+        return 0
+    if args[0] == "check":
+        print("Quarto 1.5.56-stub\n[>] Checking Python 3 installation....OK", file=sys.stderr)
+        return 0
+    if args[0] == "render" and len(args) > 1:
+        return render(args[1:])
+
+    print(f"stub quarto: unsupported command {' '.join(args)}", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,13 @@
+# gunicorn settings used by the Cloud Run image, next to the --bind/--workers/--threads flags in cloudbuild.yaml
+import threading
+
+# the app, sunholo and the Google client libraries are imported once in the master and the workers
+# forked from it, rather than each worker importing them again - on one CPU that is most of a cold start.
+# Clients and threads (storage, genai, job and kernel pools) are all created lazily, in the workers.
+preload_app = True
+
+
+def post_worker_init(worker):
+    from vac_service import warm_up
+
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
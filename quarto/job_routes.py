@@ -0,0 +1,88 @@
+import json
+import os
+import uuid
+
+from flask import request, jsonify, Response, stream_with_context
+
+from sunholo.utils import ConfigManager
+
+from tools.quarto_agent import QuartoProcessor
+from tools.render_jobs import get_job_manager
+
+from my_log import log
+
+# uploads are kept in their own workspace session folder, so they are evicted like renders
+UPLOAD_SESSION = "uploads"
+RENDERABLE_EXTENSIONS = ('.qmd', '.md', '.py', '.r', '.rmd', '.ipynb')
+
+
+def register_render_job_routes(app):
+    """
+    Adds the background render job API next to the VACRoutes:
+
+    POST /render/<vector_name>         submit a document (multipart 'file', or JSON 'filename' + 'content') and 'format'
+    GET  /render/jobs/<job_id>         current job state
+    GET  /render/jobs/<job_id>/stream  newline delimited JSON job states until the job finishes
+    GET  /render/workspace/<vector_name>  disk usage of the render workspace
+    """
+
+    @app.route('/render/<vector_name>', methods=['POST'])
+    def submit_render(vector_name):
+        if request.content_type and request.content_type.startswith('multipart/form-data'):
+            data = request.form.to_dict()
+            upload = request.files.get('file')
+            if not upload or not upload.filename:
+                return jsonify({"error": "No file selected"}), 400
+            filename = upload.filename
+            content = upload.read()
+        else:
+            data = request.get_json(silent=True) or {}
+            filename = data.get('filename', '')
+            content = data.get('content', '').encode('utf-8')
+
+        filename = os.path.basename(filename)
+        if not filename.lower().endswith(RENDERABLE_EXTENSIONS) or not content:
+            return jsonify({"error": f"Send a non-empty file ending in one of {RENDERABLE_EXTENSIONS}"}), 400
+
+        processor = QuartoProcessor(ConfigManager(vector_name))
+        workspace = processor.workspace()
+        markdown_filename = os.path.join(workspace.session_dir(UPLOAD_SESSION), f"{uuid.uuid4().hex[:8]}-{filename}")
+        with open(markdown_filename, 'wb') as f:
+            f.write(content)
+        workspace.track(markdown_filename)
+
+        try:
+            job = processor.job_manager().submit("render", processor.funcs["render_and_upload_quarto"],
+                                                 markdown_filename=markdown_filename,
+                                                 format=data.get('format', 'html'))
+        except RuntimeError as err:
+            return jsonify({"error": str(err)}), 429
+
+        log.info(f"Submitted render job {job['job_id']} for {markdown_filename}")
+
+        return jsonify({
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "status_url": f"/render/jobs/{job['job_id']}",
+            "stream_url": f"/render/jobs/{job['job_id']}/stream",
+        }), 202
+
+    @app.route('/render/jobs/<job_id>', methods=['GET'])
+    def render_job_status(job_id):
+        job = get_job_manager().get(job_id)
+        if not job:
+            return jsonify({"error": f"No job found with job_id {job_id}"}), 404
+
+        return jsonify(job)
+
+    @app.route('/render/jobs/<job_id>/stream', methods=['GET'])
+    def render_job_stream(job_id):
+        def generate():
+            for job in get_job_manager().stream(job_id):
+                yield json.dumps(job) + "\n"
+
+        return Response(stream_with_context(generate()), content_type='application/x-ndjson')
+
+    @app.route('/render/workspace/<vector_name>', methods=['GET'])
+    def render_workspace_stats(vector_name):
+        return jsonify(QuartoProcessor(ConfigManager(vector_name)).workspace().stats())
@@ -0,0 +1,82 @@
+import glob
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from my_log import log
+
+RENDERABLE_EXTENSIONS = ('.qmd', '.md', '.py', '.r', '.rmd', '.ipynb')
+DEFAULT_BATCH_WORKERS = os.cpu_count() or 1
+DEFAULT_MAX_BATCH_FILES = 50
+
+
+def find_batch_files(path: str) -> list:
+    """
+    The renderable files for a batch: every document under a directory, or those matching a glob.
+    As with Quarto projects, files and folders starting with '_' or '.' are skipped.
+    """
+    if os.path.isdir(path):
+        filenames = []
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith(('_', '.')))
+            for file in sorted(files):
+                if not file.startswith(('_', '.')) and file.lower().endswith(RENDERABLE_EXTENSIONS):
+                    filenames.append(os.path.join(root, file))
+        return filenames
+
+    return sorted(filename for filename in glob.glob(path, recursive=True)
+                  if os.path.isfile(filename) and filename.lower().endswith(RENDERABLE_EXTENSIONS))
+
+
+def render_batch_file(config, session_id: str, filename: str, format: str) -> dict:
+    """
+    Runs in a batch worker process: renders and uploads one file with its own QuartoProcessor.
+    The kernel pool is not used, as one per worker process would hold too many kernels.
+    """
+    from .quarto_agent import QuartoProcessor
+
+    start = time.time()
+    log.info(f"Batch rendering {filename} in process {os.getpid()}")
+    processor = QuartoProcessor(config)
+    processor.session_id = session_id
+    processor.use_kernel_pool = False
+    result = json.loads(processor.funcs["render_and_upload_quarto"](markdown_filename=filename, format=format))
+
+    return dict(result, file=filename, seconds=round(time.time() - start, 2))
+
+
+def _process_context():
+    # processes are not forked from this one, as it runs threads (uploads, jobs, kernels). A forkserver
+    # imports the agent once and forks each worker from that, which starts far quicker than spawning.
+    # The forkserver finds the tools package from its working directory, the app folder when served by
+    # app.py or gunicorn - from anywhere else the preload is skipped and each worker imports on first use.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([f"{__package__}.quarto_agent"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+def get_batch_pool(max_workers: int = DEFAULT_BATCH_WORKERS) -> ProcessPoolExecutor:
+    """The worker's batch render process pool, created on first use and kept for later batches."""
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            log.info(f"Starting batch render pool with {max_workers} processes")
+            _batch_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=_process_context())
+        return _batch_pool
+
+
+def reset_batch_pool():
+    """Drops a pool broken by a crashed worker process, so the next batch starts a new one."""
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is not None:
+            _batch_pool.shutdown(wait=False, cancel_futures=True)
+            _batch_pool = None
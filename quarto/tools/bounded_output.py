@@ -0,0 +1,58 @@
+from collections import deque
+
+
+def elide_middle(text: str, max_chars: int) -> str:
+    """
+    Shortens text to about max_chars by keeping its head and tail and eliding the middle,
+    which is where long Quarto/pip logs are least informative.
+    """
+    if max_chars <= 0 or len(text) <= max_chars:
+        return text
+
+    head = max_chars // 2
+    tail = max_chars - head
+    elided = len(text) - head - tail
+
+    return f"{text[:head]}\n...[{elided} characters elided]...\n{text[-tail:]}"
+
+
+class BoundedOutput:
+    """
+    Collects a stream of output lines keeping only the first head_chars and the last tail_chars,
+    so a command's full log is never held in memory or sent to the model.
+    """
+
+    def __init__(self, head_chars: int = 4000, tail_chars: int = 4000):
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self._head = []
+        self._head_size = 0
+        self._tail = deque()
+        self._tail_size = 0
+        self.total_chars = 0
+        self.elided_chars = 0
+
+    def append(self, line: str):
+        self.total_chars += len(line)
+        # a single huge line is shortened on its own, and carries its own elision marker
+        line = elide_middle(line, max(self.head_chars, self.tail_chars))
+
+        if not self._tail and self._head_size + len(line) <= self.head_chars:
+            self._head.append(line)
+            self._head_size += len(line)
+            return
+
+        self._tail.append(line)
+        self._tail_size += len(line)
+        while self._tail_size > self.tail_chars and len(self._tail) > 1:
+            dropped = self._tail.popleft()
+            self._tail_size -= len(dropped)
+            self.elided_chars += len(dropped)
+
+    def text(self) -> str:
+        head = "".join(self._head)
+        tail = "".join(self._tail)
+        if not self.elided_chars:
+            return head + tail
+
+        return f"{head}\n...[{self.elided_chars} characters elided]...\n{tail}"
@@ -0,0 +1,117 @@
+import threading
+
+from my_log import log
+
+DEFAULT_FLUSH_CHARS = 1024
+DEFAULT_FLUSH_SECONDS = 0.2
+
+# levels of streamed text: the model's answer, tool calls and their progress, and the loop banners and token counts
+ANSWER = 0
+TOOLS = 1
+LOOP = 2
+VERBOSITY_LEVELS = {"answer": ANSWER, "tools": TOOLS, "all": LOOP}
+
+FENCE = "```"
+
+
+def split_fences(text: str) -> list:
+    """
+    Splits text after each ``` so no piece holds more than one code fence, as streaming handlers
+    such as sunholo's toggle their code block state once per token containing one.
+    """
+    if text.count(FENCE) <= 1:
+        return [text]
+    pieces = [piece + FENCE for piece in text.split(FENCE)]
+    pieces[-1] = pieces[-1][:-len(FENCE)]
+    return [piece for piece in pieces if piece]
+
+
+class TokenEmitter:
+    """
+    Streams text to a callback in batches, rather than one callback per model chunk or output line.
+
+    Pending text is sent once flush_chars have built up, or flush_seconds after the first of it, whichever
+    is sooner. Text above the verbosity level is not streamed. Text recorded for the answer is kept
+    as a list and joined once. It is recorded whatever the verbosity.
+    Can stand in for the callback as QuartoProcessor.stream_callback, streaming tool progress at the TOOLS level.
+    """
+
+    def __init__(self,
+                 callback,
+                 verbosity: str = "all",
+                 flush_chars: int = DEFAULT_FLUSH_CHARS,
+                 flush_seconds: float = DEFAULT_FLUSH_SECONDS):
+        if verbosity not in VERBOSITY_LEVELS:
+            log.warning(f"Unknown stream verbosity '{verbosity}' - using 'all', or choose from {list(VERBOSITY_LEVELS)}")
+        self.callback = callback
+        self.level = VERBOSITY_LEVELS.get(verbosity, LOOP)
+        self.flush_chars = flush_chars
+        self.flush_seconds = flush_seconds
+        self.callback_calls = 0
+        self._answer = []
+        self._pending = []
+        self._pending_chars = 0
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def emit(self, token: str, level: int = ANSWER, record: bool = False):
+        """Streams token if level is within the verbosity, adding it to the answer text if record is set."""
+        if not token:
+            return
+        with self._lock:
+            if record:
+                self._answer.append(token)
+            if level > self.level:
+                return
+
+            self._pending.append(token)
+            self._pending_chars += len(token)
+            if self._pending_chars >= self.flush_chars:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def answer(self, token: str):
+        """Model text, always streamed and part of the answer."""
+        self.emit(token, ANSWER, record=True)
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        self.emit(token, TOOLS)
+
+    def mark(self) -> int:
+        """Position in the answer text, for text(since=) to return what was added after it."""
+        with self._lock:
+            return len(self._answer)
+
+    def text(self, since: int = 0) -> str:
+        with self._lock:
+            return "".join(self._answer[since:])
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        text = "".join(self._pending)
+        self._pending = []
+        self._pending_chars = 0
+        for piece in split_fences(text):
+            self.callback.on_llm_new_token(token=piece)
+            self.callback_calls += 1
+
+    def close(self) -> str:
+        """Sends what is pending and ends the stream with the answer text, which is returned."""
+        answer = self.text()
+        with self._lock:
+            self._flush()
+        self.callback.on_llm_end(response=answer)
+
+        return answer
@@ -0,0 +1,144 @@
+import importlib.metadata
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from my_log import log
+
+# touched when packages are installed, so every worker on the instance probes again
+DEFAULT_STAMP_FILE = "renders/.environment_stamp"
+PROBE_TIMEOUT = 60
+JUPYTER_PACKAGES = ("jupyter_core", "jupyter_client", "nbformat", "nbclient", "ipykernel")
+LATEX_ENGINES = ("xelatex", "pdflatex", "lualatex")
+
+R_PROBE = ("cat(paste(R.version$major, R.version$minor, sep='.'), '\\n'); "
+           "for (p in c('knitr', 'rmarkdown')) cat(p, tryCatch(as.character(packageVersion(p)), error=function(e) ''), '\\n')")
+
+
+def _version(text: str) -> str:
+    match = re.search(r'\d+(\.\d+)+', text or "")
+    return match.group(0) if match else ""
+
+
+def _run(cmd: list) -> str:
+    """stdout of cmd, or "" if it could not be run"""
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=PROBE_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as err:
+        log.info(f"Environment probe {cmd[0]} unavailable - {str(err)}")
+        return ""
+    if result.returncode != 0:
+        log.info(f"Environment probe {' '.join(cmd)} exited with {result.returncode}: {result.stderr[-500:]}")
+        return ""
+    return result.stdout
+
+
+class EnvironmentProbe:
+    """
+    What this process can render with: the Quarto, Python, Jupyter, R, knitr and LaTeX versions and the
+    engines they make available, in place of running `quarto check`.
+
+    The probe runs once per process, one short command per tool run side by side, and the answer is
+    kept until packages are installed. Installs touch stamp_file, so other workers sharing the folder
+    see the change and probe again too.
+    """
+
+    def __init__(self, quarto_bin: str = "quarto", stamp_file: str = DEFAULT_STAMP_FILE):
+        self.quarto_bin = quarto_bin
+        self.stamp_file = stamp_file
+        self._environment = None
+        self._stamp = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(stamp_file) or ".", exist_ok=True)
+
+    def _current_stamp(self) -> float:
+        try:
+            return os.path.getmtime(self.stamp_file)
+        except OSError:
+            return 0
+
+    def invalidate(self):
+        """Forgets the probed environment here and in the other workers, after packages are installed."""
+        with self._lock:
+            self._environment = None
+            with open(self.stamp_file, 'a'):
+                os.utime(self.stamp_file)
+
+    def probe(self) -> dict:
+        """The cached environment, probed first if this is the first call or packages were installed since."""
+        stamp = self._current_stamp()
+        with self._lock:
+            if self._environment is None or stamp != self._stamp:
+                self._environment = self._probe()
+                self._stamp = stamp
+            return self._environment
+
+    def start_background(self):
+        """Probes in a background thread, so the first caller finds the answer ready."""
+        threading.Thread(target=self.probe, name="environment-probe", daemon=True).start()
+
+    def _probe(self) -> dict:
+        start = time.time()
+        rscript = shutil.which("Rscript")
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="environment-probe") as executor:
+            quarto_output = executor.submit(_run, [self.quarto_bin, "--version"])
+            r_output = executor.submit(_run, [rscript, "-e", R_PROBE]) if rscript else None
+
+            jupyter = {}
+            for package in JUPYTER_PACKAGES:
+                try:
+                    jupyter[package] = importlib.metadata.version(package)
+                except importlib.metadata.PackageNotFoundError:
+                    pass
+
+            r = None
+            if r_output and r_output.result():
+                lines = r_output.result().splitlines()
+                r = {"version": lines[0].strip()}
+                for line in lines[1:]:
+                    name, _, version = line.strip().partition(" ")
+                    if version.strip():
+                        r[name] = version.strip()
+
+            quarto_version = _version(quarto_output.result())
+
+        engines = ["markdown"]
+        if {"nbformat", "nbclient", "ipykernel"} <= set(jupyter):
+            engines.append("jupyter")
+        if r and "knitr" in r and "rmarkdown" in r:
+            engines.append("knitr")
+
+        pdf_engines = [engine for engine in LATEX_ENGINES if shutil.which(engine)]
+        # typst is bundled with Quarto from 1.4
+        if quarto_version and tuple(int(part) for part in quarto_version.split(".")[:2]) >= (1, 4):
+            pdf_engines.append("typst")
+
+        environment = {
+            "quarto": {"version": quarto_version or None, "path": shutil.which(self.quarto_bin) or self.quarto_bin},
+            "python": {"version": platform.python_version(), "executable": sys.executable, "jupyter": jupyter},
+            "r": r,
+            "engines": engines,
+            "pdf_engines": pdf_engines,
+            "probe_seconds": round(time.time() - start, 3),
+        }
+        log.info(f"Probed environment in {environment['probe_seconds']}s: {environment}")
+
+        return environment
+
+
+_environment_probe = None
+_environment_probe_lock = threading.Lock()
+
+def get_environment_probe(**settings) -> EnvironmentProbe:
+    """The worker's EnvironmentProbe, created on first use."""
+    global _environment_probe
+    with _environment_probe_lock:
+        if _environment_probe is None:
+            _environment_probe = EnvironmentProbe(**settings)
+        return _environment_probe
@@ -0,0 +1,81 @@
+import os
+import re
+
+from .percent_script import parse_cells, front_matter
+
+# ```{python}, ```{r label}, ```{julia}: cells an engine executes, unlike ```{=html} raw blocks or ```{.python} listings
+CODE_CELL = re.compile(r'^\s*```+\s*\{\s*([a-zA-Z][\w-]*)', re.MULTILINE)
+# inline code such as `{python} x`, which needs the Jupyter engine too
+INLINE_CODE = re.compile(r'`\{\s*([a-zA-Z][\w-]*)\s*\}')
+# cells Quarto handles itself with the markdown engine, in the browser or with its own tools
+MARKDOWN_ENGINE_CELLS = ("ojs", "mermaid", "dot")
+# front matter keys choosing an engine, which are left to decide how the document renders
+ENGINE_KEYS = ("engine", "jupyter", "knitr")
+
+
+def _names_engine(text: str) -> bool:
+    return any(key in front_matter(text) for key in ENGINE_KEYS)
+
+
+def markdown_is_execution_free(text: str) -> bool:
+    """True for .qmd/.md text with no code cells or inline code for Jupyter or knitr to run"""
+    if _names_engine(text):
+        return False
+    languages = CODE_CELL.findall(text) + INLINE_CODE.findall(text)
+    return all(language.lower() in MARKDOWN_ENGINE_CELLS for language in languages)
+
+
+def script_is_execution_free(text: str) -> bool:
+    """True for a percent format .py script made only of markdown and raw cells"""
+    cells = parse_cells(text)
+    if not cells or any(cell["cell_type"] == "code" for cell in cells):
+        return False
+    return not _names_engine(cells[0]["source"])
+
+
+def execution_free(filename: str) -> bool:
+    """
+    Whether filename renders with nothing to execute, so Quarto can use its markdown engine
+    instead of starting Jupyter or knitr: a .qmd or .md file without code cells, or a .py
+    script of markdown cells only. Documents whose front matter picks an engine are never
+    treated as execution free, nor are .r and .rmd files.
+    """
+    lower = filename.lower()
+    if not lower.endswith(('.qmd', '.md', '.py')):
+        return False
+    with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+        text = f.read()
+    if lower.endswith('.py'):
+        return script_is_execution_free(text)
+    return markdown_is_execution_free(text)
+
+
+def script_to_markdown(text: str) -> str:
+    """
+    The .qmd equivalent of a percent script with no code cells: its markdown cells one after another,
+    with raw cells given a format="html" etc. as raw blocks, as Quarto renders them from the notebook.
+    """
+    blocks = []
+    for cell in parse_cells(text):
+        raw_format = cell["attrs"].get("format") if cell["cell_type"] == "raw" else None
+        if raw_format:
+            blocks.append(f"```{{={raw_format}}}\n{cell['source']}\n```")
+        else:
+            blocks.append(cell["source"])
+    return "\n\n".join(blocks) + "\n"
+
+
+def markdown_document(filename: str) -> str:
+    """
+    The document to give Quarto's markdown engine for an execution_free() filename: filename itself
+    for .qmd and .md files, and for a .py script a .qmd of its markdown written next to it.
+    """
+    if not filename.lower().endswith('.py'):
+        return filename
+
+    with open(filename, 'r', encoding='utf-8') as f:
+        markdown = script_to_markdown(f.read())
+    qmd_filename = os.path.splitext(filename)[0] + ".qmd"
+    with open(qmd_filename, 'w', encoding='utf-8') as f:
+        f.write(markdown)
+    return qmd_filename
@@ -0,0 +1,162 @@
+import hashlib
+import re
+
+DEFAULT_MAX_CHARS = 200000
+# the shortest sha256 prefix accepted in place of the full hash
+MIN_HASH_CHARS = 8
+
+HUNK_HEADER = re.compile(r'^@@+\s*(?:-(\d+)(?:,\d+)?\s*\+\d+(?:,\d+)?)?\s*@@+')
+
+
+def text_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def hash_matches(sha256: str, expected: str) -> bool:
+    """Whether expected is sha256, or at least its first MIN_HASH_CHARS characters"""
+    expected = (expected or "").strip().lower()
+    return len(expected) >= MIN_HASH_CHARS and sha256.startswith(expected)
+
+
+def unescape_newlines(text: str) -> str:
+    """
+    Turns literal \\n and \\t sequences into line breaks and tabs when text has no real line breaks,
+    as happens when a model double escapes a whole file. Text that already has line breaks is left
+    alone, so escapes inside its strings and non-ASCII characters are kept as written.
+    """
+    if "\n" in text or "\\n" not in text:
+        return text
+    return text.replace("\\r\\n", "\n").replace("\\n", "\n").replace("\\t", "\t")
+
+
+def _line(text: str) -> str:
+    return text.rstrip("\r\n")
+
+
+def _lines(text: str) -> list:
+    """text as lines ending in a line break, so replacements can be joined back in"""
+    lines = text.splitlines(keepends=True)
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    return lines
+
+
+def parse_unified_diff(diff: str) -> list:
+    """
+    The hunks of a unified diff, as dicts of "old_start" (1-based, or None if the header had no line numbers),
+    "old" and "new" lines. File headers (---/+++) are skipped. A diff without @@ headers is read as one hunk.
+    """
+    hunks = []
+    hunk = None
+    for line in diff.splitlines():
+        header = HUNK_HEADER.match(line)
+        if header:
+            hunk = {"old_start": int(header.group(1)) if header.group(1) else None, "old": [], "new": []}
+            hunks.append(hunk)
+            continue
+        if hunk is None:
+            if line.startswith(("--- ", "+++ ", "diff ", "index ")):
+                continue
+            hunk = {"old_start": None, "old": [], "new": []}
+            hunks.append(hunk)
+
+        if line.startswith("\\"):
+            # "\ No newline at end of file"
+            continue
+        if line.startswith("-"):
+            hunk["old"].append(line[1:])
+        elif line.startswith("+"):
+            hunk["new"].append(line[1:])
+        else:
+            # a context line, whose leading space is sometimes dropped from blank lines
+            hunk["old"].append(line[1:] if line.startswith(" ") else line)
+            hunk["new"].append(line[1:] if line.startswith(" ") else line)
+
+    return [hunk for hunk in hunks if hunk["old"] or hunk["new"]]
+
+
+def _find(lines: list, old: list, hint: int, start: int):
+    """Where old occurs in lines at or after start - at hint if it does, else the occurrence nearest it"""
+    if not old:
+        return hint if hint is not None and start <= hint <= len(lines) else None
+
+    # exact lines first, then ignoring trailing whitespace, then leading and trailing whitespace
+    for compare in (_line, lambda text: _line(text).rstrip(), lambda text: _line(text).strip()):
+        wanted = [compare(line) for line in old]
+        if hint is not None and hint >= start and [compare(line) for line in lines[hint:hint + len(old)]] == wanted:
+            return hint
+        matches = [position for position in range(start, len(lines) - len(old) + 1)
+                   if [compare(line) for line in lines[position:position + len(old)]] == wanted]
+        if matches:
+            return min(matches, key=lambda position: abs(position - hint)) if hint is not None else matches[0]
+    return None
+
+
+def apply_unified_diff(text: str, diff: str) -> str:
+    """
+    Applies diff's hunks to text in order. Each hunk is found by its context and removed lines, at its
+    header's line number if they are there, otherwise wherever they occur nearest to it, so slightly
+    wrong line numbers still apply. Trailing whitespace differences are tolerated only if there is
+    no exact match, and leading whitespace differences only if there is no other match.
+
+    Raises:
+        ValueError: If a hunk's lines are not in the file, quoting them and the lines found instead.
+    """
+    hunks = parse_unified_diff(diff)
+    if not hunks:
+        raise ValueError("The diff has no changes - give lines starting with ' ', '-' or '+' after an '@@ -l,n +l,n @@' header")
+
+    lines = _lines(text)
+    offset = 0
+    start = 0
+    for number, hunk in enumerate(hunks, start=1):
+        hint = hunk["old_start"] - 1 + offset if hunk["old_start"] else None
+        if hint is not None:
+            hint = max(0, min(hint, len(lines)))
+        position = _find(lines, hunk["old"], hint, start)
+        if position is None:
+            if not hunk["old"]:
+                raise ValueError(f"Hunk {number} only adds lines, so needs an '@@ -l,n +l,n @@' header saying where")
+            near = hint if hint is not None else 0
+            found = "".join(lines[near:near + len(hunk["old"])])
+            raise ValueError(f"Hunk {number} does not match the file - these lines were not found:\n"
+                             + "\n".join(hunk["old"]) + f"\nLines {near + 1}-{near + len(hunk['old'])} are:\n{found}")
+
+        lines[position:position + len(hunk["old"])] = [line + "\n" for line in hunk["new"]]
+        offset += len(hunk["new"]) - len(hunk["old"])
+        start = position + len(hunk["new"])
+
+    return _join(lines, text)
+
+
+def replace_lines(text: str, start_line: int, end_line: int, replacement: str) -> str:
+    """
+    Replaces lines start_line to end_line (1-based, inclusive) of text with replacement.
+    end_line = start_line - 1 inserts replacement before start_line without removing anything,
+    and replacement "" deletes the lines.
+
+    Raises:
+        ValueError: If the lines are not in the file.
+    """
+    lines = _lines(text)
+    if not 1 <= start_line <= len(lines) + 1 or not start_line - 1 <= end_line <= len(lines):
+        raise ValueError(f"Lines {start_line}-{end_line} are not in the file, which has {len(lines)} lines - "
+                         f"use end_line = start_line - 1 to insert before start_line")
+    lines[start_line - 1:end_line] = _lines(replacement)
+    return _join(lines, text)
+
+
+def _join(lines: list, original: str) -> str:
+    joined = "".join(lines)
+    # keep a file without a final line break that way
+    if original and not original.endswith("\n") and joined.endswith("\n"):
+        joined = joined[:-1]
+    return joined
+
+
+def numbered(text: str, start_line: int = 1, end_line: int = 0) -> str:
+    """Lines start_line to end_line of text, each prefixed with its line number"""
+    lines = text.splitlines()
+    end_line = min(end_line or len(lines), len(lines))
+    width = len(str(end_line))
+    return "\n".join(f"{number:>{width}}| {lines[number - 1]}" for number in range(max(start_line, 1), end_line + 1))
@@ -0,0 +1,213 @@
+import base64
+import datetime
+import json
+import mimetypes
+import os
+import threading
+import time
+import uuid
+
+from my_log import log
+
+from .quarto_agent import get_storage_client
+from .sandbox import memory_share
+
+DEFAULT_INPUTS_FOLDER = "renders/.inputs"
+# renders/ is on Cloud Run's in-memory filesystem, so the cache is a share of the instance memory
+DEFAULT_MAX_BYTES = memory_share(0.10)
+# inputs downloaded or reused more recently than this are never evicted, as a render in any worker may be reading them
+DEFAULT_MIN_AGE_SECONDS = 60 * 60
+DOWNLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+# a cached Gemini file is uploaded again this long before it expires, so it is not gone mid conversation
+EXPIRY_MARGIN_SECONDS = 10 * 60
+
+
+def parse_gs_uri(gs_uri: str):
+    """Splits gs://bucket/name into (bucket, name)"""
+    if not gs_uri.startswith('gs://') or '/' not in gs_uri[5:]:
+        raise ValueError(f"Invalid GCS URI: {gs_uri}")
+    bucket_name, blob_name = gs_uri[5:].split('/', 1)
+    return bucket_name, blob_name
+
+
+def input_extension(gs_uri: str, mime_type: str = None) -> str:
+    if gs_uri.endswith((".qmd", ".md")):
+        return ".qmd"
+    extension = os.path.splitext(gs_uri)[1]
+    if not extension and mime_type:
+        extension = mimetypes.guess_extension(mime_type) or ""
+    return extension.lower()
+
+
+class InputCache:
+    """
+    Size bounded local store of downloaded attachments, keyed by content hash.
+
+    The object's md5 is read from its GCS metadata before downloading, so the same content
+    under any URI is downloaded once. Objects are streamed to disk in chunks and never held
+    in memory. The Gemini file handle from genai.upload_file() is remembered per content
+    hash until shortly before it expires, so each attachment is uploaded to the model once.
+    Files downloaded or reused in the last min_age_seconds are kept even over max_bytes.
+    """
+
+    def __init__(self, folder: str = DEFAULT_INPUTS_FOLDER, max_bytes: int = DEFAULT_MAX_BYTES,
+                 min_age_seconds: int = DEFAULT_MIN_AGE_SECONDS):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.min_age_seconds = min_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._genai_files = {}  # content hash -> (genai File, expiry timestamp)
+        os.makedirs(folder, exist_ok=True)
+
+    def _genai_index_path(self) -> str:
+        return os.path.join(self.folder, "genai_files.json")
+
+    def download(self, gs_uri: str, mime_type: str = None) -> dict:
+        """
+        Makes a local copy of gs_uri, unless one with the same content is already cached.
+
+        Returns:
+            dict: "filename" of the local copy, "content_hash", "bytes" and "cache_hit"
+        """
+        bucket_name, blob_name = parse_gs_uri(gs_uri)
+        storage_client = get_storage_client()
+        if not storage_client:
+            raise RuntimeError(f"No storage client available to download {gs_uri}")
+
+        blob = storage_client.bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(f"{gs_uri} does not exist")
+
+        # composite objects have no md5, so fall back to their crc32c plus generation
+        if blob.md5_hash:
+            content_hash = base64.b64decode(blob.md5_hash).hex()
+        else:
+            content_hash = f"{base64.b64decode(blob.crc32c).hex()}-{blob.generation}"
+        filename = os.path.join(self.folder, f"{content_hash}{input_extension(gs_uri, mime_type)}")
+
+        if os.path.isfile(filename) and os.path.getsize(filename) == blob.size:
+            os.utime(filename)
+            with self._lock:
+                self.hits += 1
+            log.info(f"Input cache hit for {gs_uri} - {filename}")
+            return {"filename": filename, "content_hash": content_hash, "bytes": blob.size, "cache_hit": True}
+
+        start = time.time()
+        blob.chunk_size = DOWNLOAD_CHUNK_BYTES
+        temp_filename = f"{filename}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            blob.download_to_filename(temp_filename)
+            os.replace(temp_filename, filename)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+        with self._lock:
+            self.misses += 1
+        log.info(f"Downloaded {gs_uri} to {filename} - {blob.size} bytes in {time.time() - start:.2f}s")
+        self._evict(keep=filename)
+
+        return {"filename": filename, "content_hash": content_hash, "bytes": blob.size, "cache_hit": False}
+
+    def _evict(self, keep: str = None):
+        files = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.endswith((".json", ".tmp")):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+
+        total = sum(size for _, _, size in files)
+        cutoff = time.time() - self.min_age_seconds
+        for last_used, path, size in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if last_used > cutoff:
+                log.warning(f"Input cache still at {total} bytes, over its {self.max_bytes} byte limit - everything left is recent")
+                break
+            if path == keep:
+                continue
+            log.info(f"Evicting cached input {path}")
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def _load_genai_index(self) -> dict:
+        try:
+            with open(self._genai_index_path(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_genai_index(self, index: dict):
+        temp_path = f"{self._genai_index_path()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(temp_path, self._genai_index_path())
+
+    def genai_file(self, genai, filename: str, content_hash: str):
+        """
+        The Gemini file for filename, uploaded with genai.upload_file() only if there is no
+        unexpired upload of the same content. Other workers' uploads are found by name via genai.get_file().
+
+        Returns:
+            tuple: (genai File, cache_hit)
+        """
+        now = time.time()
+        with self._lock:
+            cached, expires = self._genai_files.get(content_hash, (None, 0))
+            index = self._load_genai_index()
+
+        if expires - EXPIRY_MARGIN_SECONDS <= now and content_hash in index:
+            if index[content_hash]["expires"] - EXPIRY_MARGIN_SECONDS > now:
+                try:
+                    cached = genai.get_file(index[content_hash]["name"])
+                    expires = index[content_hash]["expires"]
+                except Exception as err:
+                    log.info(f"Cached Gemini file {index[content_hash]['name']} is no longer available - {str(err)}")
+
+        if cached is not None and expires - EXPIRY_MARGIN_SECONDS > now:
+            log.info(f"Reusing Gemini file {cached.name} for {filename}")
+            with self._lock:
+                self._genai_files[content_hash] = (cached, expires)
+            return cached, True
+
+        uploaded = genai.upload_file(filename)
+        expires = _expiry_timestamp(uploaded)
+        with self._lock:
+            self._genai_files[content_hash] = (uploaded, expires)
+            index = {key: value for key, value in self._load_genai_index().items() if value["expires"] > now}
+            index[content_hash] = {"name": uploaded.name, "expires": expires}
+            self._save_genai_index(index)
+
+        return uploaded, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "genai_files": len(self._genai_files)}
+
+
+def _expiry_timestamp(genai_file) -> float:
+    expiration_time = getattr(genai_file, "expiration_time", None)
+    if isinstance(expiration_time, datetime.datetime):
+        return expiration_time.timestamp()
+    # the Files API keeps uploads for 48 hours
+    return time.time() + 48 * 60 * 60
+
+
+_input_cache = None
+_input_cache_lock = threading.Lock()
+
+def get_input_cache(folder: str = DEFAULT_INPUTS_FOLDER, max_bytes: int = DEFAULT_MAX_BYTES,
+                    min_age_seconds: int = DEFAULT_MIN_AGE_SECONDS) -> InputCache:
+    """The worker's InputCache, created on first use."""
+    global _input_cache
+    with _input_cache_lock:
+        if _input_cache is None:
+            _input_cache = InputCache(folder, max_bytes=max_bytes, min_age_seconds=min_age_seconds)
+        _input_cache.max_bytes = max_bytes
+        _input_cache.min_age_seconds = min_age_seconds
+        return _input_cache
@@ -0,0 +1,610 @@
+import contextlib
+import hashlib
+import os
+import platform
+import re
+import signal
+import threading
+import time
+from collections import OrderedDict
+
+from my_log import log
+
+try:
+    import nbformat
+    from jupyter_client import AsyncKernelManager
+    from nbclient import NotebookClient
+    from nbclient.exceptions import CellTimeoutError
+    from nbclient.util import run_sync
+except ImportError:
+    nbformat = None
+
+from .percent_script import parse_cells, cell_options, document_options, to_notebook
+from .sandbox import (
+    apply_rlimits, process_group_rss, process_cpu_seconds, rlimit_enforcement, enforcement, LimitExceeded
+)
+from .streaming import WATCHDOG_SECONDS
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_MAX_RENDERS = 20
+DEFAULT_MAX_RSS_BYTES = 1024 * 1024 * 1024
+DEFAULT_CELL_TIMEOUT = 600
+DEFAULT_WARMUP_MODULES = ["numpy", "pandas", "matplotlib.pyplot", "seaborn", "IPython.display"]
+
+# Quarto's default figure settings per format, applied before the first cell as Quarto's own setup cell would
+FIGURE_SETUP = {
+    "html": {"width": 7, "height": 5, "dpi": 96, "formats": ["retina"]},
+    "pdf": {"width": 5.5, "height": 3.5, "dpi": 300, "formats": ["png", "pdf"]},
+    "docx": {"width": 5, "height": 4, "dpi": 96, "formats": ["png"]},
+}
+
+# cells using the network, the shell, the environment or user input, or writing files, whose outputs or side effects
+# can change with the code unchanged - they and the cells after them are never taken from the cell cache.
+# Files a cell reads are covered by cell_chain() instead, and a random draw or the clock cached is as good as a new one.
+VOLATILE_CODE = re.compile(
+    r'\b(?:input|to_(?:csv|excel|parquet|feather|pickle|hdf|sql|stata)|savefig|save\w*|dump|write\w*|'
+    r'glob|listdir|scandir|walk|environ|getenv|shutil|subprocess|socket|requests|httpx|urllib|urlopen|sqlite3)\b'
+    r'|\bopen\s*\([^)]*[\'"][rbt]*[wax][rbt+]*[\'"]|[\'"]https?://|^\s*[!%]',
+    re.MULTILINE
+)
+# quoted strings in a cell, those naming files being what it may read, e.g. pd.read_csv("data/sales.csv")
+STRING_LITERAL = re.compile(r'([\'"])([^\'"\n]{1,255})\1')
+
+# taken once a kernel is warm, kept on the sys module where %reset -f does not reach it
+SNAPSHOT_CODE = """
+import os as _os, sys as _sys, warnings as _warnings
+_sys._pool_snapshot = {
+    "environ": dict(_os.environ),
+    "path": list(_sys.path),
+    "modules": set(_sys.modules),
+    "warnings": list(_warnings.filters),
+}
+del _os, _sys, _warnings
+"""
+
+# clears the namespace, then puts back the process state a render can change: environment variables,
+# sys.path, the working directory, warning filters and matplotlib and pandas options. Modules imported
+# from the render folders are dropped, so the next render imports its own.
+RESET_CODE = """
+%reset -f
+import os as _os, sys as _sys, warnings as _warnings
+_snapshot = getattr(_sys, "_pool_snapshot", None)
+if _snapshot:
+    _os.environ.clear()
+    _os.environ.update(_snapshot["environ"])
+    _sys.path[:] = _snapshot["path"]
+    _warnings.filters[:] = _snapshot["warnings"]
+    for _name in [name for name in set(_sys.modules) - _snapshot["modules"]
+                  if (getattr(_sys.modules[name], "__file__", None) or "").startswith({home!r})]:
+        del _sys.modules[_name]
+    _name = None
+_os.chdir({home!r})
+try:
+    import matplotlib.pyplot as _plt
+    _plt.close('all')
+    _plt.rcdefaults()
+except ImportError:
+    pass
+if "pandas" in _sys.modules:
+    with _warnings.catch_warnings():
+        _warnings.simplefilter("ignore")
+        _sys.modules["pandas"].reset_option("all")
+del _os, _sys, _warnings, _snapshot
+globals().pop("_name", None)
+"""
+
+
+def kernel_pool_available() -> bool:
+    return nbformat is not None
+
+
+def _warmup_code(modules: list) -> str:
+    return (
+        f"for _module in {list(modules)!r}:\n"
+        "    try:\n"
+        "        __import__(_module)\n"
+        "    except ImportError:\n"
+        "        pass\n"
+    )
+
+
+def _setup_code(cwd: str, format: str) -> str:
+    figure = FIGURE_SETUP.get(format, FIGURE_SETUP["html"])
+    return (
+        "import os as _os\n"
+        f"_os.chdir({os.path.abspath(cwd)!r})\n"
+        "del _os\n"
+        "try:\n"
+        "    import matplotlib.pyplot as _plt\n"
+        "    from matplotlib_inline.backend_inline import set_matplotlib_formats as _set_formats\n"
+        f"    _plt.rcParams['figure.figsize'] = ({figure['width']}, {figure['height']})\n"
+        f"    _plt.rcParams['figure.dpi'] = {figure['dpi']}\n"
+        f"    _set_formats(*{figure['formats']!r})\n"
+        "    del _plt, _set_formats\n"
+        "except ImportError:\n"
+        "    pass\n"
+    )
+
+
+def _file_stamps(source: str, cwd: str) -> str:
+    """The modification time and size of each file, relative to cwd, that a string literal in source names"""
+    stamps = []
+    for _, literal in STRING_LITERAL.findall(source):
+        path = os.path.join(cwd, os.path.expanduser(literal))
+        try:
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                stamps.append(f"{literal}\0{stat.st_mtime_ns}\0{stat.st_size}")
+        except (OSError, ValueError):
+            continue
+    return "\0".join(stamps)
+
+
+def cell_chain(nb, seed: str, cwd: str = None) -> list:
+    """
+    (index, hash) for each code cell of nb, where each hash covers the cell source and the hash
+    of the code cell before it, so a hash only repeats when the whole code prefix is unchanged.
+    Markdown and raw cells do not take part, so editing them invalidates nothing.
+
+    With cwd, a hash also covers the modification time and size of the files named by string literals
+    in the cell, so a cell loading data, and every cell after it, changes hash when the data does.
+    """
+    chain = []
+    previous = hashlib.sha256(seed.encode('utf-8')).hexdigest()
+    for index, cell in enumerate(nb.cells):
+        if cell.cell_type != "code":
+            continue
+        stamps = _file_stamps(cell.source, cwd) if cwd else ""
+        previous = hashlib.sha256(f"{previous}\0{cell.source}\0{stamps}".encode('utf-8')).hexdigest()
+        chain.append((index, previous))
+    return chain
+
+
+class PooledKernel:
+
+    def __init__(self, kernel_name: str, cwd: str):
+        self.km = AsyncKernelManager(kernel_name=kernel_name)
+        run_sync(self.km.start_kernel)(cwd=cwd)
+        self.renders = 0
+        self.started_at = time.time()
+        # the document whose state this kernel holds, the cell_chain() hashes it has executed and their outputs
+        self.document = None
+        self.executed = []
+        self.outputs = {}
+
+    @property
+    def pid(self):
+        return getattr(getattr(self.km, 'provisioner', None), 'pid', None)
+
+    def rss_bytes(self) -> int:
+        """Resident memory of the kernel process from /proc, or 0 if unknown."""
+        if not self.pid:
+            return 0
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def returncode(self):
+        """The kernel process's exit code, or None while it runs"""
+        process = getattr(getattr(self.km, 'provisioner', None), 'process', None)
+        return process.poll() if process is not None else None
+
+    def kill(self):
+        """Kills the kernel and the processes it started, which share its process group. Safe from any thread."""
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except (OSError, TypeError):
+            pass
+
+    @contextlib.contextmanager
+    def limited(self, timeout: float = 0, max_rss_bytes: int = 0, rlimits: dict = None):
+        """
+        Runs the block under the limits run_command() puts on commands. rlimits (see sandbox.apply_rlimits())
+        cap the file sizes and address space of the kernel and what it starts. A watchdog kills the kernel if
+        the block runs past timeout seconds, if the kernel and its children use more than max_rss_bytes, or if
+        they use more than rlimits["cpu_seconds"] of CPU in the block - counted here rather than with RLIMIT_CPU,
+        as a pooled kernel has used CPU on earlier renders.
+
+        Raises:
+            LimitExceeded: with the sandbox.enforcement() that stopped the block.
+        """
+        rlimits = rlimits or {}
+        cpu_seconds = rlimits.get("cpu_seconds")
+        if self.pid:
+            apply_rlimits(self.pid, {name: value for name, value in rlimits.items() if name != "cpu_seconds"})
+        if not (timeout or max_rss_bytes or cpu_seconds) or not self.pid:
+            yield
+            return
+
+        start = time.time()
+        cpu_start = process_cpu_seconds(self.pid)
+        tripped = []
+        done = threading.Event()
+
+        def watch():
+            while not done.wait(WATCHDOG_SECONDS):
+                if timeout and time.time() - start >= timeout:
+                    limit = enforcement("wall_time", timeout, round(time.time() - start, 3),
+                                        f"Stopped after running for {timeout} seconds")
+                elif cpu_seconds and process_cpu_seconds(self.pid) - cpu_start > cpu_seconds:
+                    limit = enforcement("cpu", cpu_seconds, round(process_cpu_seconds(self.pid) - cpu_start, 3),
+                                        f"Stopped after using {cpu_seconds} seconds of CPU")
+                else:
+                    rss = process_group_rss(self.pid) if max_rss_bytes else 0
+                    if rss <= max_rss_bytes:
+                        continue
+                    limit = enforcement("memory", max_rss_bytes, rss,
+                                        f"Stopped when using {rss} bytes of memory, over the {max_rss_bytes} byte limit")
+                log.warning(f"Killing kernel {self.pid} - {limit['message']}")
+                tripped.append(limit)
+                self.kill()
+                return
+
+        watchdog = threading.Thread(target=watch, daemon=True)
+        watchdog.start()
+        try:
+            yield
+        except Exception as err:
+            limit = tripped[0] if tripped else rlimit_enforcement(self.returncode(), str(err), rlimits)
+            if limit is None and isinstance(err, CellTimeoutError):
+                limit = enforcement("wall_time", timeout, round(time.time() - start, 3),
+                                    f"Stopped a cell still running after {timeout} seconds")
+            if limit:
+                raise LimitExceeded(limit) from err
+            raise
+        finally:
+            done.set()
+            watchdog.join()
+
+    def run(self, nb, timeout: int = DEFAULT_CELL_TIMEOUT, skip: set = None, on_cell=None):
+        """
+        Executes the code cells of nb in this kernel, except cell indexes in skip.
+        on_cell(index) is called after each cell finishes without raising.
+        """
+        client = NotebookClient(nb, km=self.km, timeout=timeout, allow_errors=False)
+        try:
+            with client.setup_kernel():
+                for index, cell in enumerate(nb.cells):
+                    if cell.cell_type != "code" or (skip and index in skip):
+                        continue
+                    client.execute_cell(cell, index, execution_count=client.code_cells_executed + 1)
+                    if on_cell:
+                        on_cell(index)
+        finally:
+            if client.kc is not None:
+                client.kc.stop_channels()
+
+        return nb
+
+    def run_code(self, code: str, timeout: int = DEFAULT_CELL_TIMEOUT):
+        nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(code)])
+        return self.run(nb, timeout=timeout)
+
+    def alive(self) -> bool:
+        return run_sync(self.km.is_alive)()
+
+    def shutdown(self):
+        try:
+            run_sync(self.km.shutdown_kernel)(now=True)
+        except Exception as err:
+            log.warning(f"Error shutting down kernel {self.pid}: {str(err)}")
+
+
+class KernelPool:
+    """
+    A small pool of pre-warmed Jupyter kernels, so percent format scripts are executed
+    without paying kernel start up and the pandas/matplotlib imports on every render.
+
+    Kernels have their namespace and process state reset between renders (see RESET_CODE) and are recycled after
+    max_renders renders, or once their resident memory passes max_rss_bytes.
+
+    A kernel can instead be parked with its state intact for the document it just ran,
+    so a re-render of that document can resume from its first changed cell, the same as
+    re-running cells from there in Jupyter. Parked kernels are reset and handed to other
+    documents, oldest first, when no idle kernel is left.
+    """
+
+    def __init__(self,
+                 size: int = DEFAULT_POOL_SIZE,
+                 max_renders: int = DEFAULT_MAX_RENDERS,
+                 max_rss_bytes: int = DEFAULT_MAX_RSS_BYTES,
+                 warmup_modules: list = None,
+                 kernel_name: str = "python3"):
+        self.size = size
+        self.max_renders = max_renders
+        self.max_rss_bytes = max_rss_bytes
+        self.warmup_modules = DEFAULT_WARMUP_MODULES if warmup_modules is None else warmup_modules
+        self.kernel_name = kernel_name
+        self.home = os.getcwd()
+        self._idle = []
+        self._parked = OrderedDict()  # document -> PooledKernel
+        self._total = 0
+        self._condition = threading.Condition()
+        self.started = 0
+        self.recycled = 0
+
+    def _start_kernel(self) -> PooledKernel:
+        start = time.time()
+        kernel = PooledKernel(self.kernel_name, cwd=self.home)
+        kernel.run_code(_warmup_code(self.warmup_modules))
+        kernel.run_code(SNAPSHOT_CODE)
+        self.started += 1
+        log.info(f"Started warm kernel {kernel.pid} in {time.time() - start:.2f}s")
+        return kernel
+
+    def _add_kernel(self):
+        try:
+            kernel = self._start_kernel()
+        except Exception as err:
+            log.warning(f"Could not start a pooled kernel: {str(err)}")
+            with self._condition:
+                self._total -= 1
+                self._condition.notify()
+            return
+        with self._condition:
+            self._idle.append(kernel)
+            self._condition.notify()
+
+    def prewarm(self):
+        """Starts kernels in the background until the pool is full."""
+        with self._condition:
+            missing = self.size - self._total
+            self._total += max(missing, 0)
+        for _ in range(max(missing, 0)):
+            threading.Thread(target=self._add_kernel, daemon=True).start()
+
+    def _reset(self, kernel: PooledKernel) -> bool:
+        try:
+            kernel.run_code(RESET_CODE.format(home=self.home))
+        except Exception as err:
+            log.warning(f"Could not reset kernel {kernel.pid}: {str(err)}")
+            return False
+        kernel.document = None
+        kernel.executed = []
+        kernel.outputs = {}
+        return True
+
+    def _retire(self, kernel: PooledKernel):
+        kernel.shutdown()
+        self.recycled += 1
+        with self._condition:
+            self._total -= 1
+            self._condition.notify()
+        # keep the pool warm for the next render
+        self.prewarm()
+
+    def acquire(self, timeout: float = None, document: str = None) -> PooledKernel:
+        """
+        Takes a kernel from the pool. If document has a parked kernel that is returned with its state,
+        otherwise a clean one - waiting up to timeout seconds if every kernel is busy.
+        """
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            with self._condition:
+                if document and document in self._parked:
+                    return self._parked.pop(document)
+                if self._idle:
+                    return self._idle.pop()
+                if self._total < self.size:
+                    self._total += 1
+                    break
+                if self._parked:
+                    _, kernel = self._parked.popitem(last=False)
+                else:
+                    kernel = None
+                    remaining = deadline - time.time() if deadline else None
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"No pooled kernel became available within {timeout}s")
+                    self._condition.wait(remaining)
+
+            if kernel:
+                # hand over the least recently parked kernel
+                if self._reset(kernel):
+                    return kernel
+                self._retire(kernel)
+
+        # below pool size - start one in this thread rather than wait
+        try:
+            return self._start_kernel()
+        except Exception:
+            with self._condition:
+                self._total -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, kernel: PooledKernel, failed: bool = False, keep_for: str = None):
+        """
+        Returns kernel to the pool, or replaces it if it died or is due for recycling.
+        With keep_for the kernel is parked with its state for that document, otherwise it is reset.
+        """
+        kernel.renders += 1
+        recycle = failed or kernel.renders >= self.max_renders
+        if not recycle:
+            rss = kernel.rss_bytes()
+            if rss > self.max_rss_bytes:
+                log.info(f"Recycling kernel {kernel.pid} using {rss} bytes")
+                recycle = True
+
+        if not recycle and keep_for:
+            kernel.document = keep_for
+            with self._condition:
+                replaced = self._parked.pop(keep_for, None)
+                self._parked[keep_for] = kernel
+                self._condition.notify()
+            if replaced:
+                self.release(replaced)
+            return
+
+        if recycle or not self._reset(kernel):
+            self._retire(kernel)
+            return
+
+        with self._condition:
+            self._idle.append(kernel)
+            self._condition.notify()
+
+    def execute_script(self,
+                       script_path: str,
+                       format: str = "html",
+                       timeout: int = DEFAULT_CELL_TIMEOUT,
+                       document: str = None,
+                       cell_cache=None,
+                       max_rss_bytes: int = 0,
+                       rlimits: dict = None) -> str:
+        """
+        Executes a percent format script in a pooled kernel and writes the executed notebook
+        next to it, ready for `quarto render <notebook> --no-execute`.
+
+        document identifies the source and whose it is, e.g. the session and absolute path: kernels are parked
+        for it, and it seeds the cell hashes, so outputs are never shared between documents or sessions.
+
+        With a cell_cache (a RenderCache) the outputs of each code cell are stored under its cell_chain() hash,
+        which covers the files the cells name, up to the first cell matching VOLATILE_CODE. If every code cell
+        is in the cache no kernel is used. Otherwise the kernel parked for document resumes after the cells it
+        ran, reusing their outputs, provided they are the unchanged leading code cells and it ran nothing after
+        them - as when only markdown was edited or cells were added at the end, whatever those cells read.
+        Otherwise every cell runs in a clean kernel.
+
+        Each cell's #| eval and error options apply over the header's execute: options, as in Quarto.
+        timeout is the longest the script may run, and a kernel may be waited for. max_rss_bytes and
+        rlimits limit the kernel as PooledKernel.limited() describes.
+
+        Raises:
+            nbclient.exceptions.CellExecutionError: If a cell raises and does not allow errors.
+            LimitExceeded: If the kernel was stopped for going over a limit.
+
+        Returns:
+            str: The path of the executed .ipynb
+        """
+        with open(script_path, 'r', encoding='utf-8') as f:
+            cells = parse_cells(f.read())
+
+        nb = nbformat.from_dict(to_notebook(cells, kernel_name=self.kernel_name))
+        execute_options = document_options(cells)
+        skip = set()
+        for index, cell in enumerate(nb.cells):
+            if cell.cell_type != "code":
+                continue
+            options = dict(execute_options, **cell_options(cell.source))
+            if options.get("eval") is False:
+                skip.add(index)
+            if options.get("error") is True:
+                cell.metadata["tags"] = ["raises-exception"]
+
+        cwd = os.path.dirname(os.path.abspath(script_path))
+        chain = cell_chain(nb, seed=f"{self.kernel_name}\0{format}\0{platform.python_version()}\0{document}", cwd=cwd)
+        hashes = [cell_hash for _, cell_hash in chain]
+        notebook_path = os.path.splitext(script_path)[0] + ".ipynb"
+
+        cacheable = set()
+        for index, _ in chain:
+            if VOLATILE_CODE.search(nb.cells[index].source):
+                break
+            cacheable.add(index)
+
+        # how many leading code cells can come from the cache
+        cached = {}
+        if cell_cache:
+            for index, cell_hash in chain:
+                if index not in cacheable:
+                    break
+                entry = None if index in skip else cell_cache.get(cell_hash)
+                if index not in skip and entry is None:
+                    break
+                cached[index] = entry
+
+        if len(cached) == len(chain):
+            self._apply_cached(nb, cached)
+            nbformat.write(nb, notebook_path)
+            log.info(f"All {len(chain)} code cells of {script_path} came from the cell cache")
+            return notebook_path
+
+        kernel = self.acquire(timeout=timeout, document=document)
+        # state from cells after the unchanged ones would leak into the re-run, so only a kernel that ran
+        # nothing but unchanged leading cells resumes
+        resumed = len(kernel.executed)
+        resume = bool(resumed) and kernel.document == document and kernel.executed == hashes[:resumed]
+        if resume:
+            reused = {index: {"outputs": kernel.outputs[cell_hash]}
+                      for index, cell_hash in chain[:resumed] if cell_hash in kernel.outputs}
+            self._apply_cached(nb, reused)
+            skip = skip | {index for index, _ in chain[:resumed]}
+        else:
+            resumed = 0
+            if kernel.executed and not self._reset(kernel):
+                self._retire(kernel)
+                kernel = self.acquire(timeout=timeout)
+
+        pending = iter(chain[resumed:])
+
+        def on_cell(index):
+            # cells passed over with eval: false are recorded too, so executed stays a prefix of the chain
+            for cell_index, cell_hash in pending:
+                kernel.executed.append(cell_hash)
+                if cell_index == index:
+                    break
+            kernel.outputs[cell_hash] = nb.cells[index].outputs
+            if cell_cache and index in cacheable:
+                cell_cache.put(cell_hash, {"outputs": nb.cells[index].outputs})
+
+        failed = False
+        try:
+            with kernel.limited(timeout=timeout, max_rss_bytes=max_rss_bytes, rlimits=rlimits):
+                kernel.run_code(_setup_code(cwd, format), timeout=timeout)
+                kernel.run(nb, timeout=timeout, skip=skip, on_cell=on_cell)
+        except Exception:
+            # the cell that raised may have changed state before it did, so the kernel no longer matches any prefix
+            kernel.executed.append(None)
+            failed = not kernel.alive()
+            raise
+        finally:
+            self.release(kernel, failed=failed, keep_for=document)
+
+        nbformat.write(nb, notebook_path)
+        log.info(f"Executed {script_path} in pooled kernel {kernel.pid} to {notebook_path} - "
+                 f"resumed after {resumed} unchanged cells")
+
+        return notebook_path
+
+    @staticmethod
+    def _apply_cached(nb, cached: dict):
+        for index, entry in cached.items():
+            if entry:
+                nb.cells[index].outputs = nbformat.from_dict(entry["outputs"])
+
+    def shutdown(self):
+        with self._condition:
+            idle, self._idle = self._idle + list(self._parked.values()), []
+            self._parked.clear()
+            self._total -= len(idle)
+        for kernel in idle:
+            kernel.shutdown()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "size": self.size,
+                "idle": len(self._idle),
+                "parked": len(self._parked),
+                "total": self._total,
+                "started": self.started,
+                "recycled": self.recycled,
+            }
+
+
+_kernel_pool = None
+_kernel_pool_lock = threading.Lock()
+
+def get_kernel_pool(**settings) -> KernelPool:
+    """The worker's KernelPool, created and pre-warmed on first use."""
+    global _kernel_pool
+    with _kernel_pool_lock:
+        if _kernel_pool is None:
+            _kernel_pool = KernelPool(**settings)
+            _kernel_pool.prewarm()
+        return _kernel_pool
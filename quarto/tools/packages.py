@@ -0,0 +1,237 @@
+import importlib
+import importlib.metadata
+import os
+import re
+import sys
+import threading
+
+from my_log import log
+
+from .sandbox import memory_share
+
+try:
+    from packaging.requirements import Requirement, InvalidRequirement
+except ImportError:
+    Requirement = None
+
+DEFAULT_WHEELHOUSE = "renders/.wheelhouse"
+DEFAULT_R_LIBRARY = "renders/.r_library"
+DEFAULT_R_REPOS = "https://cloud.r-project.org/"
+# renders/ is on Cloud Run's in-memory filesystem, so the wheelhouse is a share of the instance memory
+DEFAULT_WHEELHOUSE_MAX_BYTES = memory_share(0.10)
+# wheels named in pip's output, e.g. "Saved ./renders/.wheelhouse/pandas-2.2.2-cp312-...whl"
+WHEEL_FILE = re.compile(r'[\w.+-]+\.whl')
+
+
+def split_packages(package_name: str) -> list:
+    """'pandas, seaborn plotnine' -> ['pandas', 'seaborn', 'plotnine'], keeping version specifiers such as 'pandas>=2'."""
+    return [package for package in re.split(r'[,\s]+', package_name or "") if package]
+
+
+def canonical_name(name: str) -> str:
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def requirement_name(spec: str) -> str:
+    return canonical_name(re.split(r'[<>=!~\[;@ ]', spec, maxsplit=1)[0])
+
+
+class PackageManager:
+    """
+    Installs Python and R packages, skipping any that are already installed without spawning a process.
+
+    Installed packages are indexed once per process (importlib.metadata for Python, installed.packages()
+    for R) and the index is refreshed after each install. Python packages are built or downloaded once into
+    a local wheelhouse and installed from it, so later installs and instances sharing the folder need no
+    network or compiles. R packages go into a persistent library folder that is put on R_LIBS for every
+    R process started from this one. Installs are serialized, as concurrent pip or R installs into one
+    environment can break it. The wheelhouse is kept under wheelhouse_max_bytes by deleting the least
+    recently used wheels, which pip downloads or builds again if they are needed later.
+    """
+
+    def __init__(self,
+                 wheelhouse: str = DEFAULT_WHEELHOUSE,
+                 r_library: str = DEFAULT_R_LIBRARY,
+                 r_repos: str = DEFAULT_R_REPOS,
+                 wheelhouse_max_bytes: int = DEFAULT_WHEELHOUSE_MAX_BYTES):
+        self.wheelhouse = wheelhouse
+        self.wheelhouse_max_bytes = wheelhouse_max_bytes
+        self.r_library = os.path.abspath(r_library)
+        self.r_repos = r_repos
+        self._python_index = None
+        self._r_index = None
+        self._lock = threading.RLock()
+        os.makedirs(wheelhouse, exist_ok=True)
+        os.makedirs(self.r_library, exist_ok=True)
+
+        r_libs = os.environ.get("R_LIBS", "")
+        if self.r_library not in r_libs.split(os.pathsep):
+            os.environ["R_LIBS"] = os.pathsep.join(path for path in (self.r_library, r_libs) if path)
+
+    def python_index(self) -> dict:
+        """canonical name -> version of every distribution importable by this interpreter"""
+        with self._lock:
+            if self._python_index is None:
+                importlib.invalidate_caches()
+                self._python_index = {
+                    canonical_name(dist.metadata["Name"]): dist.version
+                    for dist in importlib.metadata.distributions() if dist.metadata["Name"]
+                }
+            return self._python_index
+
+    def r_index(self, run) -> set:
+        """Names of the installed R packages, found with one Rscript call per process."""
+        with self._lock:
+            if self._r_index is None:
+                result = run(["Rscript", "-e", "cat(rownames(installed.packages()), sep='\\n')"], label="R")
+                if result["returncode"] != 0:
+                    log.warning(f"Could not list installed R packages: {result['stderr']}")
+                    return set()
+                self._r_index = set(result["stdout"].split())
+            return self._r_index
+
+    def invalidate(self):
+        with self._lock:
+            self._python_index = None
+            self._r_index = None
+
+    def python_installed(self, spec: str) -> bool:
+        installed = self.python_index().get(requirement_name(spec))
+        if installed is None:
+            return False
+        if Requirement is None:
+            # without packaging, only bare names can be checked
+            return requirement_name(spec) == canonical_name(spec)
+        try:
+            return Requirement(spec).specifier.contains(installed, prereleases=True)
+        except InvalidRequirement:
+            return False
+
+    def install_python(self, packages: list, run) -> dict:
+        """
+        Installs those of packages not already satisfied, via the wheelhouse.
+
+        Args:
+            packages: pip requirement specifiers
+            run: QuartoProcessor.run_command, or a function with the same signature
+
+        Returns:
+            dict: "installed", "already_installed", "stdout", "stderr", "returncode" and "limit", see run_command()
+        """
+        with self._lock:
+            already_installed = [package for package in packages if self.python_installed(package)]
+            to_install = [package for package in packages if package not in already_installed]
+            if not to_install:
+                return {"installed": [], "already_installed": already_installed, "returncode": 0,
+                        "stdout": f"Already installed: {', '.join(already_installed)}", "stderr": ""}
+
+            pip = [sys.executable, "-m", "pip"]
+            # wheels already in the wheelhouse are reused, anything else is downloaded or built into it once
+            wheel = run(pip + ["wheel", "--wheel-dir", self.wheelhouse, "--find-links", self.wheelhouse] + to_install,
+                        label="pip")
+            if wheel["returncode"] == 0:
+                result = run(pip + ["install", "--no-index", "--find-links", self.wheelhouse] + to_install, label="pip")
+            else:
+                log.warning(f"Could not build wheels for {to_install} - installing from the index instead")
+                result = run(pip + ["install", "--find-links", self.wheelhouse] + to_install, label="pip")
+
+            self.invalidate()
+            self.prune_wheelhouse(used=WHEEL_FILE.findall(wheel["stdout"]))
+
+            return {
+                "installed": to_install if result["returncode"] == 0 else [],
+                "already_installed": already_installed,
+                "returncode": result["returncode"],
+                "stdout": result["stdout"],
+                "stderr": result["stderr"],
+                "limit": result.get("limit"),
+            }
+
+    def prune_wheelhouse(self, used: list = ()) -> int:
+        """
+        Marks the wheel filenames in used as just used, then deletes the least recently used wheels
+        until the wheelhouse is within wheelhouse_max_bytes. Returns bytes freed.
+        """
+        with self._lock:
+            for filename in used:
+                try:
+                    os.utime(os.path.join(self.wheelhouse, filename))
+                except OSError:
+                    pass
+
+            wheels = []
+            for entry in os.scandir(self.wheelhouse):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.is_file():
+                    wheels.append((stat.st_mtime, entry.path, stat.st_size))
+
+            total = sum(size for _, _, size in wheels)
+            freed = 0
+            for _, path, size in sorted(wheels):
+                if total - freed <= self.wheelhouse_max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError as err:
+                    log.warning(f"Could not remove {path} from the wheelhouse - {str(err)}")
+                    continue
+                freed += size
+
+            if freed:
+                log.info(f"Wheelhouse at {total} bytes was over its {self.wheelhouse_max_bytes} byte limit - removed {freed} bytes")
+            return freed
+
+    def install_r(self, packages: list, run) -> dict:
+        """
+        Installs those of packages not already in any R library into the persistent r_library.
+        Configure r_repos with a binary repository (e.g. Posit Package Manager) to avoid compiling from source.
+
+        Returns:
+            dict: "installed", "already_installed", "stdout", "stderr", "returncode" and "limit", see run_command()
+        """
+        invalid = [package for package in packages if not re.fullmatch(r'[A-Za-z][A-Za-z0-9.]*', package)]
+        if invalid:
+            raise ValueError(f"Not valid R package names: {', '.join(invalid)}")
+
+        with self._lock:
+            index = self.r_index(run)
+            already_installed = [package for package in packages if package in index]
+            to_install = [package for package in packages if package not in index]
+            if not to_install:
+                return {"installed": [], "already_installed": already_installed, "returncode": 0,
+                        "stdout": f"Already installed: {', '.join(already_installed)}", "stderr": ""}
+
+            r_packages = ", ".join(f"'{package}'" for package in to_install)
+            r_command = (f"install.packages(c({r_packages}), lib='{self.r_library}', repos='{self.r_repos}', "
+                         f"Ncpus={os.cpu_count() or 1}); "
+                         f"missing <- setdiff(c({r_packages}), rownames(installed.packages())); "
+                         f"if (length(missing)) stop('Could not install: ', paste(missing, collapse=', '))")
+            result = run(["R", "--no-echo", "-e", r_command], label="R")
+
+            self.invalidate()
+
+            return {
+                "installed": to_install if result["returncode"] == 0 else [],
+                "already_installed": already_installed,
+                "returncode": result["returncode"],
+                "stdout": result["stdout"],
+                "stderr": result["stderr"],
+                "limit": result.get("limit"),
+            }
+
+
+_package_manager = None
+_package_manager_lock = threading.Lock()
+
+def get_package_manager(**settings) -> PackageManager:
+    """The worker's PackageManager, created on first use."""
+    global _package_manager
+    with _package_manager_lock:
+        if _package_manager is None:
+            _package_manager = PackageManager(**settings)
+        if "wheelhouse_max_bytes" in settings:
+            _package_manager.wheelhouse_max_bytes = settings["wheelhouse_max_bytes"]
+        return _package_manager
@@ -0,0 +1,163 @@
+import re
+
+import yaml
+
+# "# %%", "# %% [markdown]", "# %% Some title [raw] format="html""
+CELL_DELIMITER = re.compile(r'^#\s*%%(?P<rest>.*)$')
+CELL_TYPE = re.compile(r'\[(?P<type>markdown|md|raw)\]')
+CELL_ATTR = re.compile(r'(?P<key>[\w-]+)="(?P<value>[^"]*)"')
+FRONT_MATTER = re.compile(r'\A\s*---[ \t]*\n(.*?)\n---[ \t]*$', re.DOTALL | re.MULTILINE)
+OPTION_PREFIX = "#|"
+
+RAW_MIMETYPES = {
+    "html": "text/html",
+    "latex": "text/latex",
+    "tex": "text/latex",
+    "markdown": "text/markdown",
+    "rst": "text/restructuredtext",
+}
+
+
+def _comment_text(lines: list) -> str:
+    """Markdown/raw cell content written either as # comments or as one triple quoted string."""
+    stripped = "\n".join(lines).strip()
+    for quote in ('"""', "'''"):
+        if len(stripped) >= 6 and stripped.startswith(quote) and stripped.endswith(quote):
+            return stripped[3:-3].strip("\n")
+
+    text = []
+    for line in lines:
+        if line.startswith("# "):
+            text.append(line[2:])
+        elif line.startswith("#"):
+            text.append(line[1:])
+        else:
+            text.append(line)
+
+    return "\n".join(text).strip("\n")
+
+
+def parse_cells(text: str) -> list:
+    """
+    Splits a percent format script (the .py format Quarto renders through Jupyter) into cells.
+
+    Returns:
+        list: One dict per cell with keys
+            - "cell_type": "code", "markdown" or "raw"
+            - "source": the cell content with comment markers/quotes removed for markdown and raw cells
+            - "lines": the raw lines of the cell body, excluding the delimiter
+            - "line": 1-based line number of the delimiter (or of the first line for text before any delimiter)
+            - "attrs": attributes on the delimiter such as format="html"
+    """
+    cells = []
+    current = {"cell_type": "code", "lines": [], "line": 1, "attrs": {}, "delimited": False}
+
+    def finish(cell):
+        body = cell["lines"]
+        if not cell["delimited"] and not "".join(body).strip():
+            return
+        if cell["cell_type"] == "code":
+            cell["source"] = "\n".join(body).strip("\n")
+        else:
+            cell["source"] = _comment_text(body)
+        del cell["delimited"]
+        cells.append(cell)
+
+    for number, line in enumerate(text.splitlines(), start=1):
+        match = CELL_DELIMITER.match(line)
+        if not match:
+            current["lines"].append(line)
+            continue
+
+        finish(current)
+        rest = match.group("rest")
+        cell_type = CELL_TYPE.search(rest)
+        cell_type = cell_type.group("type") if cell_type else "code"
+        current = {
+            "cell_type": "markdown" if cell_type == "md" else cell_type,
+            "lines": [],
+            "line": number,
+            "attrs": {m.group("key"): m.group("value") for m in CELL_ATTR.finditer(rest)},
+            "delimited": True,
+        }
+
+    finish(current)
+
+    return cells
+
+
+def front_matter(text: str) -> dict:
+    """The YAML front matter at the top of text, or {} if there is none or it does not parse"""
+    match = FRONT_MATTER.match(text)
+    if not match:
+        return {}
+    try:
+        parsed = yaml.safe_load(match.group(1))
+    except yaml.YAMLError:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+
+def document_options(cells: list) -> dict:
+    """The execute: options in the YAML header of a parse_cells() script, e.g. {"eval": False}, or {}"""
+    if not cells or cells[0]["cell_type"] != "markdown":
+        return {}
+    options = front_matter(cells[0]["source"]).get("execute")
+    return options if isinstance(options, dict) else {}
+
+
+def option_lines(source: str) -> list:
+    """The leading #| option lines of a code cell."""
+    options = []
+    for line in source.splitlines():
+        if not line.startswith(OPTION_PREFIX):
+            break
+        options.append(line[len(OPTION_PREFIX):])
+    return options
+
+
+def cell_options(source: str) -> dict:
+    """Parses the #| options at the top of a code cell, returning {} if there are none or they are invalid YAML."""
+    options = option_lines(source)
+    if not options:
+        return {}
+    try:
+        parsed = yaml.safe_load("\n".join(line.strip() for line in options))
+    except yaml.YAMLError:
+        return {}
+
+    return parsed if isinstance(parsed, dict) else {}
+
+
+def to_notebook(cells: list, kernel_name: str = "python3") -> dict:
+    """Builds an nbformat 4 notebook dict from parse_cells() output, with no outputs."""
+    nb_cells = []
+    for cell in cells:
+        source = cell["source"]
+        if cell["cell_type"] == "code":
+            nb_cells.append({
+                "cell_type": "code",
+                "execution_count": None,
+                "metadata": {},
+                "outputs": [],
+                "source": source,
+            })
+        elif cell["cell_type"] == "raw":
+            metadata = {}
+            raw_format = cell["attrs"].get("format")
+            if raw_format:
+                metadata["format"] = raw_format
+                metadata["raw_mimetype"] = RAW_MIMETYPES.get(raw_format, raw_format)
+            nb_cells.append({"cell_type": "raw", "metadata": metadata, "source": source})
+        else:
+            nb_cells.append({"cell_type": "markdown", "metadata": {}, "source": source})
+
+    return {
+        "cells": nb_cells,
+        "metadata": {
+            "kernelspec": {"name": kernel_name, "display_name": "Python 3", "language": "python"},
+            "language_info": {"name": "python"},
+        },
+        "nbformat": 4,
+        "nbformat_minor": 4,
+    }
@@ -0,0 +1,155 @@
+import gzip
+import hashlib
+import os
+import posixpath
+import re
+
+from my_log import log
+
+# files compressed before upload and served with Content-Encoding: gzip
+COMPRESSIBLE_EXTENSIONS = ('.html', '.htm', '.css', '.js', '.mjs', '.json', '.svg', '.xml', '.txt', '.md', '.csv', '.map')
+# Quarto writes HTML dependencies such as bootstrap to <output>_files/libs/<library>/
+LIBS_FOLDER = "libs"
+OUTPUT_PREFIX = "output."
+# formats Quarto can render to one self-contained file with embed-resources
+EMBEDDABLE_FORMATS = ("html", "revealjs", "dashboard")
+
+HTML_REFERENCE = re.compile(r'''(?:src|href|data-src|poster)\s*=\s*["']([^"'#?]+)''', re.IGNORECASE)
+CSS_REFERENCE = re.compile(r'''url\(\s*["']?([^"')#?]+)''', re.IGNORECASE)
+
+
+def _is_local(reference: str) -> bool:
+    return bool(reference) and not re.match(r'^([a-z][a-z0-9+.-]*:|//|/)', reference, flags=re.IGNORECASE)
+
+
+def _references(folder: str, relative_path: str) -> set:
+    """Local files referenced from an HTML or CSS file, as paths relative to folder"""
+    pattern = CSS_REFERENCE if relative_path.lower().endswith('.css') else HTML_REFERENCE
+    with open(os.path.join(folder, relative_path), 'r', encoding='utf-8', errors='replace') as f:
+        content = f.read()
+
+    base = os.path.dirname(relative_path)
+    references = set()
+    for reference in pattern.findall(content):
+        reference = reference.strip()
+        if _is_local(reference):
+            path = os.path.normpath(os.path.join(base, reference))
+            if not path.startswith('..') and os.path.isfile(os.path.join(folder, path)):
+                references.add(path)
+    if pattern is HTML_REFERENCE:
+        # stylesheets inline in the page can reference fonts and images too
+        for reference in CSS_REFERENCE.findall(content):
+            path = os.path.normpath(os.path.join(base, reference.strip()))
+            if _is_local(reference.strip()) and not path.startswith('..') and os.path.isfile(os.path.join(folder, path)):
+                references.add(path)
+    return references
+
+
+def select_outputs(folder: str) -> list:
+    """
+    The files of a render worth publishing: each output.<format>, in folder or a format's sub folder,
+    and the figures, scripts, stylesheets and fonts they reference. The copied source, intermediate
+    notebooks and caches are left out.
+
+    Returns:
+        list: paths relative to folder, sorted
+    """
+    selected = set()
+    for entry in sorted(os.listdir(folder)):
+        path = os.path.join(folder, entry)
+        if os.path.isfile(path) and entry.startswith(OUTPUT_PREFIX):
+            selected.add(entry)
+        elif os.path.isdir(path):
+            for sub_entry in os.listdir(path):
+                if sub_entry.startswith(OUTPUT_PREFIX) and os.path.isfile(os.path.join(path, sub_entry)):
+                    selected.add(os.path.join(entry, sub_entry))
+
+    to_scan = [path for path in selected if path.lower().endswith(('.html', '.htm'))]
+    while to_scan:
+        path = to_scan.pop()
+        for reference in _references(folder, path):
+            if reference not in selected:
+                selected.add(reference)
+                if reference.lower().endswith('.css'):
+                    to_scan.append(reference)
+
+    return sorted(selected)
+
+
+def shared_libraries(files: list) -> dict:
+    """
+    The library folders among files, e.g. output_files/libs/bootstrap, and the files in each.
+
+    Returns:
+        dict: library folder -> list of its files, all relative to the render folder
+    """
+    libraries = {}
+    for path in files:
+        parts = path.split(os.sep)
+        for position in range(len(parts) - 2):
+            if parts[position].endswith("_files") and parts[position + 1] == LIBS_FOLDER:
+                libraries.setdefault(os.sep.join(parts[:position + 3]), []).append(path)
+                break
+    return libraries
+
+
+def library_name(folder: str, library: str, files: list) -> str:
+    """<library>-<hash of its files' paths and contents>, the same for identical copies of a library"""
+    hasher = hashlib.sha256()
+    for path in sorted(files):
+        hasher.update(os.path.relpath(path, library).encode('utf-8') + b"\0")
+        with open(os.path.join(folder, path), 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
+    return f"{os.path.basename(library)}-{hasher.hexdigest()[:16]}"
+
+
+def point_at_libraries(folder: str, files: list, libraries: dict, published_folder: str, base_url: str = None) -> int:
+    """
+    Rewrites the references to each library folder in the HTML files among files to its shared copy.
+
+    Args:
+        libraries: library folder relative to folder -> bucket path of its shared copy
+        published_folder: bucket path folder's files are published under
+        base_url: if set, references become base_url/<bucket path>, otherwise they are relative to
+            each HTML file's own bucket path, so work wherever the bucket is served from
+
+    Returns:
+        int: how many HTML files were changed
+    """
+    changed = 0
+    for path in files:
+        if not path.lower().endswith(('.html', '.htm')):
+            continue
+        filename = os.path.join(folder, path)
+        with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+            content = f.read()
+
+        published_dir = posixpath.dirname(posixpath.join(published_folder, path.replace(os.sep, '/')))
+        rewritten = content
+        for library, library_path in libraries.items():
+            relative = os.path.relpath(library, os.path.dirname(path) or ".").replace(os.sep, '/')
+            if base_url:
+                url = f"{base_url.rstrip('/')}/{library_path}"
+            else:
+                url = posixpath.relpath(library_path, published_dir)
+            rewritten = re.sub(r'''(["'(])(\./)?''' + re.escape(relative) + '/',
+                               lambda match, url=url: f"{match.group(1)}{url}/", rewritten)
+
+        if rewritten != content:
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(rewritten)
+            changed += 1
+
+    return changed
+
+
+def compressed_copy(filename: str) -> str:
+    """Writes filename gzipped to filename.gz, with no timestamp so identical content gives identical bytes"""
+    with open(filename, 'rb') as f:
+        data = gzip.compress(f.read(), compresslevel=6, mtime=0)
+    compressed = f"{filename}.gz"
+    with open(compressed, 'wb') as f:
+        f.write(data)
+    log.debug(f"Compressed {filename} to {len(data)} bytes")
+    return compressed
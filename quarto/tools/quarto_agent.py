@@ -1,42 +1,613 @@
 from sunholo.genai import GenAIFunctionProcessor
 from sunholo.utils import ConfigManager
-from sunholo.gcs.add_file import add_file_to_gcs
+from sunholo.gcs.add_file import resolve_bucket
 
 from my_log import log
 
-import subprocess
+from .render_cache import get_render_cache, render_cache_key, DEFAULT_CACHE_FOLDER, DEFAULT_MAX_BYTES
+from .render_jobs import get_job_manager, current_job_log, DEFAULT_MAX_WORKERS as DEFAULT_JOB_WORKERS, DEFAULT_MAX_QUEUED
+from .streaming import stream_subprocess, DEFAULT_HEAD_CHARS, DEFAULT_TAIL_CHARS
+from .spans import span, annotate
+from .workspace import get_workspace_manager, DEFAULT_QUOTA_BYTES, DEFAULT_MIN_AGE_SECONDS, DEFAULT_RESCAN_SECONDS
+from .batch import (
+    find_batch_files, render_batch_file, get_batch_pool, reset_batch_pool,
+    DEFAULT_BATCH_WORKERS, DEFAULT_MAX_BATCH_FILES
+)
+from .bounded_output import elide_middle
+from .environment import get_environment_probe
+from .validator import validate_script as script_diagnostics
+from .fast_path import execution_free, markdown_document
+from .scheduler import run_calls, file_resource, DEFAULT_TOOL_WORKERS
+from .file_edits import (
+    text_sha256, hash_matches, unescape_newlines, apply_unified_diff, replace_lines, numbered,
+    DEFAULT_MAX_CHARS as DEFAULT_MAX_FILE_CHARS
+)
+from .sandbox import (
+    get_admission_controller, AdmissionRejected,
+    DEFAULT_MAX_CONCURRENT, DEFAULT_QUEUE_SECONDS, DEFAULT_MIN_AVAILABLE_BYTES, DEFAULT_MAX_CPU_SECONDS,
+    DEFAULT_MAX_FILE_BYTES, DEFAULT_MAX_OUTPUT_CHARS, DEFAULT_MAX_ADDRESS_SPACE_BYTES,
+    # named apart from render_jobs' DEFAULT_MAX_QUEUED and kernel_pool's DEFAULT_MAX_RSS_BYTES
+    DEFAULT_MAX_QUEUED as DEFAULT_MAX_QUEUED_COMMANDS, DEFAULT_MAX_RSS_BYTES as DEFAULT_COMMAND_MAX_RSS_BYTES
+)
+from .publish import (
+    select_outputs, shared_libraries, library_name, point_at_libraries, compressed_copy,
+    COMPRESSIBLE_EXTENSIONS, EMBEDDABLE_FORMATS
+)
+from .packages import (
+    get_package_manager, split_packages, DEFAULT_WHEELHOUSE, DEFAULT_R_LIBRARY, DEFAULT_R_REPOS, DEFAULT_WHEELHOUSE_MAX_BYTES
+)
+from .kernel_pool import (
+    get_kernel_pool, kernel_pool_available,
+    DEFAULT_POOL_SIZE, DEFAULT_MAX_RENDERS, DEFAULT_MAX_RSS_BYTES
+)
+
 import os
 import json
 import traceback
 import time
 import shutil
+import hashlib
+import base64
+import threading
+import contextvars
+import contextlib
+import re
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from google.cloud import storage
+except ImportError:
+    storage = None
+
+# set QUARTO_BIN to run against another Quarto install, or a stub such as bench/stub_quarto.py
+QUARTO_BIN = os.getenv("QUARTO_BIN", "quarto")
+
+DEFAULT_UPLOAD_WORKERS = 8
+# each Quarto render keeps about two cores busy (deno, pandoc and the engine)
+DEFAULT_RENDER_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+DEFAULT_COMMAND_TIMEOUT = 1800
+DEFAULT_CELL_CACHE_FOLDER = "renders/.cell_cache"
+UPLOAD_RETRIES = 5
+
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+# (bucket_name, md5) -> a blob path already holding that content
+_upload_manifest = {}
+# shared library blob folders this process has published, e.g. quarto/<vector_name>/libs/bootstrap-<hash>
+_published_libraries = set()
+# upload_to_gcs() stats per thread, as tool calls from one model turn can run at once
+_upload_stats = threading.local()
+
+def get_storage_client():
+    """One storage.Client per process, shared by the upload threads."""
+    global _storage_client
+    if not storage:
+        return None
+    with _storage_client_lock:
+        if _storage_client is None:
+            try:
+                _storage_client = storage.Client()
+            except Exception as err:
+                log.error(f"Error creating storage client: {str(err)}")
+                return None
+    return _storage_client
+
+def file_md5(filename: str) -> str:
+    """Base64 md5 of a file, in the same form as Blob.md5_hash"""
+    hasher = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return base64.b64encode(hasher.digest()).decode('utf-8')
+
+def upload_with_retries(blob, filename: str, content_type: str = None):
+    for attempt in range(UPLOAD_RETRIES):
+        try:
+            blob.upload_from_filename(filename, content_type=content_type)
+            return
+        except Exception as e:
+            if attempt == UPLOAD_RETRIES - 1:
+                raise
+            log.warning(f"Upload attempt {attempt + 1} for {filename} failed with error: {str(e)}. Retrying...")
+            time.sleep(2 ** attempt)
+
+def engine_versions(filename: str) -> dict:
+    """
+    Versions of Quarto and the engine that would execute filename, used to key renders.
+    Read from the worker's cached environment probe.
+    """
+    environment = get_environment_probe(quarto_bin=QUARTO_BIN).probe()
+    versions = {
+        "quarto": environment["quarto"]["version"],
+        "python": environment["python"]["version"],
+    }
+    if filename.lower().endswith(('.r', '.rmd')):
+        versions["r"] = (environment["r"] or {}).get("version")
+
+    return versions
+
+def needs_jupyter_execution(filename: str) -> bool:
+    """True for documents Quarto runs through Jupyter: .py scripts, and .qmd/.md with executable code cells"""
+    if filename.endswith('.py'):
+        return True
+    if not filename.lower().endswith(('.qmd', '.md')):
+        return False
+    with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+        return re.search(r'^```+\s*\{(python|julia)', f.read(), flags=re.MULTILINE) is not None
+
+PYTHON_PACKAGES = "packages:python"
+R_PACKAGES = "packages:r"
+
+def _render_resources(params: dict) -> tuple:
+    # renders read their file and the installed packages, so they wait for writes and installs in the same turn
+    return (file_resource(params.get("markdown_filename")), PYTHON_PACKAGES, R_PACKAGES), ()
+
+# what each tool reads and writes given its arguments, so function calls from one model turn that touch the
+# same file or package environment run in the order they were made, and the rest at once.
+# Tools not listed, such as quarto_command, run on their own.
+TOOL_RESOURCES = {
+    "write_to_file": lambda params: ((), (file_resource(params.get("file_path")),)),
+    "edit_file": lambda params: ((), (file_resource(params.get("file_path")),)),
+    "read_file": lambda params: ((file_resource(params.get("file_path")),), ()),
+    "render_and_upload_quarto": _render_resources,
+    "submit_render_job": _render_resources,
+    "install_pip_package": lambda params: ((), (PYTHON_PACKAGES,)),
+    "install_r_package": lambda params: ((), (R_PACKAGES,)),
+    "submit_install_job": lambda params: ((), ()),
+    "get_job_status": lambda params: ((), ()),
+    "quarto_version": lambda params: ((PYTHON_PACKAGES, R_PACKAGES), ()),
+    "validate_script": lambda params: ((file_resource(params.get("file_path")),), ()),
+    "decide_to_go_on": lambda params: ((), ()),
+}
 
 class QuartoProcessor(GenAIFunctionProcessor):
 
-    def upload_to_gcs(self, folder:str):
+    # set per request by vac_stream to the streaming callback, so tool progress reaches the user
+    stream_callback = None
+    # set per request by vac_stream, so a conversation's renders share a workspace folder
+    session_id = "default"
+    # turned off in batch render processes
+    use_kernel_pool = True
+    # set per request by vac_stream to the chat session's tool state, kept between a conversation's requests
+    session_state = None
+
+    @property
+    def last_upload_stats(self) -> list:
+        """Per file stats of the last upload_to_gcs() made by this thread"""
+        return getattr(_upload_stats, "stats", [])
+
+    @last_upload_stats.setter
+    def last_upload_stats(self, stats: list):
+        _upload_stats.stats = stats
+
+    def process_funcs(self, full_response, output_parts=True):
+        """
+        As GenAIFunctionProcessor.process_funcs(), but the function calls of one response run concurrently
+        on up to tools.quarto.tool_workers threads. Calls using the same files or packages (see TOOL_RESOURCES)
+        run in the order the model made them, and results are returned in that order.
+        """
+        calls = []
+        if not full_response.candidates:
+            log.warning(f"No candidates in the model response, so no functions to run - {full_response}")
+            self.last_api_requests_and_responses = []
+            return [] if output_parts else ""
+
+        for part in full_response.candidates[0].content.parts:
+            if fn := part.function_call:
+                # args is None for a call without arguments, such as quarto_version()
+                params = dict(fn.args or {})
+                if fn.name in self.funcs:
+                    log.info(f"Executing {fn.name} with params {params}")
+                    calls.append((fn.name, params))
+                else:
+                    log.error(f"Function {fn.name} is not recognized")
+
+        api_requests_and_responses = run_calls(
+            self.funcs, calls, TOOL_RESOURCES, max_workers=int(self.tool_config('tool_workers', DEFAULT_TOOL_WORKERS))
+        )
+        log.info(f"{api_requests_and_responses=}")
+        self.last_api_requests_and_responses = api_requests_and_responses
+
+        if output_parts:
+            return self.parse_as_parts()
+
+        return self.parse_as_string()
+
+    def remember(self, kind: str, key: str, value):
+        """Records a file written or render made in the session's tool state, if the request has a session"""
+        if self.session_state is not None:
+            self.session_state.setdefault(kind, {})[key] = value
+
+    def emit_progress(self, line: str):
+        """Sends a progress line to the running background job, or else to the request's stream."""
+        job_log = current_job_log.get()
+        if job_log:
+            job_log(line.rstrip("\n"))
+        elif self.stream_callback:
+            self.stream_callback.on_llm_new_token(token=line)
+
+    def admission(self, label: str = "command"):
+        """
+        Context manager holding one of the instance's render slots for the block, as configured by
+        tools.quarto.sandbox. Raises AdmissionRejected if the server stays too busy. A no-op with the sandbox off.
+        """
+        sandbox_config = self.feature_config('sandbox')
+        if sandbox_config is None:
+            return contextlib.nullcontext()
+
+        controller = get_admission_controller(
+            max_concurrent=int(sandbox_config.get('max_concurrent', DEFAULT_MAX_CONCURRENT)),
+            max_queued=int(sandbox_config.get('max_queued', DEFAULT_MAX_QUEUED_COMMANDS)),
+            queue_seconds=float(sandbox_config.get('queue_seconds', DEFAULT_QUEUE_SECONDS)),
+            min_available_bytes=int(sandbox_config.get('min_available_bytes', DEFAULT_MIN_AVAILABLE_BYTES))
+        )
+        return controller.slot(label, on_wait=lambda message: self.emit_progress(f"[{label}] {message}\n"))
+
+    def sandbox_limits(self) -> dict:
+        """The max_rss_bytes, max_output_chars and rlimits of tools.quarto.sandbox, or {} with the sandbox off"""
+        sandbox_config = self.feature_config('sandbox')
+        if sandbox_config is None:
+            return {}
+
+        return {
+            "max_rss_bytes": int(sandbox_config.get('max_rss_bytes', DEFAULT_COMMAND_MAX_RSS_BYTES)),
+            "max_output_chars": int(sandbox_config.get('max_output_chars', DEFAULT_MAX_OUTPUT_CHARS)),
+            "rlimits": {
+                "cpu_seconds": int(sandbox_config.get('max_cpu_seconds', DEFAULT_MAX_CPU_SECONDS)),
+                "file_bytes": int(sandbox_config.get('max_file_bytes', DEFAULT_MAX_FILE_BYTES)),
+                "address_space_bytes": int(sandbox_config.get('max_address_space_bytes', DEFAULT_MAX_ADDRESS_SPACE_BYTES)),
+            },
+        }
+
+    def run_command(self, cmd: list, cwd: str = None, timeout: int = 0, label: str = None) -> dict:
+        """
+        Runs cmd streaming its output lines through emit_progress(), returning stream_subprocess()'s result.
+        Output kept and the default timeout come from tools.quarto.command_output and tools.quarto.command_timeout.
+        With tools.quarto.sandbox, cmd waits for a render slot and is stopped if it goes over its memory, CPU,
+        file size or output limits - result["limit"] then says which, as it does if cmd was refused a slot.
+        """
+        output_config = self.tool_config('command_output', {}) or {}
+        timeout = timeout or int(self.tool_config('command_timeout', DEFAULT_COMMAND_TIMEOUT))
+        label = label or os.path.basename(cmd[0])
+        limits = self.sandbox_limits()
+
+        with span("command", command=label) as command_span:
+            try:
+                with self.admission(label):
+                    result = stream_subprocess(
+                        cmd,
+                        cwd=cwd,
+                        timeout=timeout,
+                        on_line=lambda _, line: self.emit_progress(f"[{label}] {line}"),
+                        head_chars=int(output_config.get('head_chars', DEFAULT_HEAD_CHARS)),
+                        tail_chars=int(output_config.get('tail_chars', DEFAULT_TAIL_CHARS)),
+                        **limits
+                    )
+            except AdmissionRejected as err:
+                log.warning(f"Refused to run {' '.join(cmd)} - {str(err)}")
+                result = {"returncode": None, "stdout": "", "stderr": str(err), "timed_out": False, "seconds": 0,
+                          "stdout_chars": 0, "stderr_chars": len(str(err)), "peak_rss_bytes": None, "limit": err.limit}
+            command_span.update(returncode=result['returncode'], timed_out=result['timed_out'],
+                                bytes_out=result['stdout_chars'] + result['stderr_chars'])
+            if result['limit']:
+                command_span.update(status="error", limit=result['limit']['kind'])
+        log.info(f"{' '.join(cmd)} exited with {result['returncode']} after {result['seconds']}s - "
+                 f"{result['stdout_chars']} stdout and {result['stderr_chars']} stderr characters")
+
+        return result
+
+    def tool_config(self, key: str, default=None):
+        """Reads a setting from config.vac.<vector_name>.tools.quarto"""
+        tools = self.config.vacConfig('tools') or {}
+        quarto_config = tools.get('quarto')
+        if not isinstance(quarto_config, dict):
+            return default
+
+        return quarto_config.get(key, default)
+
+    def feature_config(self, key: str):
+        """
+        Settings dict for an optional feature under tools.quarto.<key>, or None if it has been
+        turned off with `<key>: false` or `<key>: {enabled: false}`. Features are on by default.
+        """
+        feature_config = self.tool_config(key, {})
+        if feature_config is False:
+            return None
+        feature_config = feature_config or {}
+        if not feature_config.get('enabled', True):
+            return None
+
+        return feature_config
+
+    def render_cache(self):
+        """The process wide render cache, or None if disabled via tools.quarto.render_cache"""
+        cache_config = self.feature_config('render_cache')
+        if cache_config is None:
+            return None
+
+        return get_render_cache(
+            folder=cache_config.get('folder', DEFAULT_CACHE_FOLDER),
+            max_bytes=int(cache_config.get('max_bytes', DEFAULT_MAX_BYTES))
+        )
+
+    def cell_cache(self):
+        """Store of executed cell outputs and knitr chunk caches, or None if disabled via tools.quarto.cell_cache"""
+        cache_config = self.feature_config('cell_cache')
+        if cache_config is None:
+            return None
+
+        return get_render_cache(
+            folder=cache_config.get('folder', DEFAULT_CELL_CACHE_FOLDER),
+            max_bytes=int(cache_config.get('max_bytes', DEFAULT_MAX_BYTES))
+        )
+
+    def restore_knitr_cache(self, source_filename: str, render_dir: str):
+        """
+        Puts the knitr chunk cache from the session's last render of source_filename into render_dir,
+        so `quarto render --cache` only re-runs changed chunks. Returns the cache key, or None if disabled.
+        """
+        cell_cache = self.cell_cache()
+        if not cell_cache:
+            return None
+
+        # per session, as the same path in two sessions holds different documents
+        document = f"{self.session_id}:{os.path.abspath(source_filename)}"
+        key = "knitr-" + hashlib.sha256(document.encode('utf-8')).hexdigest()
+        if cell_cache.get(key) is not None:
+            stem = os.path.splitext(os.path.basename(source_filename))[0]
+            shutil.copytree(cell_cache.outputs_folder(key), os.path.join(render_dir, f"{stem}_cache"), dirs_exist_ok=True)
+            log.info(f"Restored knitr cache for {source_filename}")
+
+        return key
+
+    def save_knitr_cache(self, key: str, source_filename: str, render_dir: str):
+        """Moves the knitr chunk cache out of render_dir into the cell cache, so it is not uploaded."""
+        stem = os.path.splitext(os.path.basename(source_filename))[0]
+        knitr_dir = os.path.join(render_dir, f"{stem}_cache")
+        if not os.path.isdir(knitr_dir):
+            return
+        self.cell_cache().put(key, {"source": os.path.abspath(source_filename)}, output_folder=knitr_dir)
+        shutil.rmtree(knitr_dir, ignore_errors=True)
+
+    def job_manager(self):
+        """The worker's background job runner, sized by tools.quarto.render_jobs"""
+        jobs_config = self.tool_config('render_jobs', {}) or {}
+
+        return get_job_manager(
+            max_workers=int(jobs_config.get('max_workers', DEFAULT_JOB_WORKERS)),
+            max_queued=int(jobs_config.get('max_queued', DEFAULT_MAX_QUEUED))
+        )
+
+    def workspace(self):
+        """The worker's render workspace manager, with its disk quota from tools.quarto.workspace"""
+        workspace_config = self.tool_config('workspace', {}) or {}
+
+        return get_workspace_manager(
+            quota_bytes=int(workspace_config.get('quota_bytes', DEFAULT_QUOTA_BYTES)),
+            min_age_seconds=int(workspace_config.get('min_age_seconds', DEFAULT_MIN_AGE_SECONDS)),
+            rescan_seconds=int(workspace_config.get('rescan_seconds', DEFAULT_RESCAN_SECONDS))
+        )
+
+    def package_manager(self):
+        """The worker's package installer, with its wheelhouse and R library from tools.quarto.packages"""
+        packages_config = self.tool_config('packages', {}) or {}
+
+        return get_package_manager(
+            wheelhouse=packages_config.get('wheelhouse', DEFAULT_WHEELHOUSE),
+            r_library=packages_config.get('r_library', DEFAULT_R_LIBRARY),
+            r_repos=packages_config.get('r_repos', DEFAULT_R_REPOS),
+            wheelhouse_max_bytes=int(packages_config.get('wheelhouse_max_bytes', DEFAULT_WHEELHOUSE_MAX_BYTES))
+        )
+
+    def kernel_pool(self):
+        """The worker's warm Jupyter kernel pool, or None if disabled via tools.quarto.kernel_pool or not installed"""
+        pool_config = self.feature_config('kernel_pool')
+        if pool_config is None or not self.use_kernel_pool or not kernel_pool_available():
+            return None
+
+        return get_kernel_pool(
+            size=int(pool_config.get('size', DEFAULT_POOL_SIZE)),
+            max_renders=int(pool_config.get('max_renders', DEFAULT_MAX_RENDERS)),
+            max_rss_bytes=int(pool_config.get('max_rss_bytes', DEFAULT_MAX_RSS_BYTES)),
+            warmup_modules=pool_config.get('warmup_modules')
+        )
+
+    def upload_to_gcs(self, folder:str, files: list = None, prefix: str = None, compress: bool = False):
+        """
+        Uploads every file in folder, or just files (paths relative to folder), to prefix in the configured bucket,
+        by default quarto/<vector_name>/<folder>/.
+
+        Files are uploaded concurrently on a bounded thread pool sharing one storage client.
+        A manifest of content hashes means files already in the bucket with the same md5 are not re-sent:
+        if the same path already holds them they are skipped, otherwise they are copied server side.
+        With compress, text files such as HTML, CSS and JavaScript are gzipped and stored with Content-Encoding: gzip.
+        Per file bytes and timings are kept in self.last_upload_stats.
+
+        Returns:
+            list: The gs:// URLs of the uploaded files, sorted by their path within folder.
+                  An entry is None if that file failed to upload.
+        """
         log.info(f"Uploading {folder=}")
         vector_name = self.config.vector_name
+        self.last_upload_stats = []
 
-        output_urls = []
-        # Iterate through all files in the directory and upload them
-        for root, _, files in os.walk(folder):
-            for file in files:
-                filename = os.path.join(root, file)
+        filenames = []
+        if files is not None:
+            filenames = [os.path.join(folder, file) for file in files]
+        else:
+            for root, _, walked in os.walk(folder):
+                for file in walked:
+                    filenames.append(os.path.join(root, file))
+        filenames.sort(key=lambda filename: os.path.relpath(filename, folder))
 
-                # Create a relative path for the bucket
-                relative_path = os.path.relpath(filename, folder)
-                bucket_filepath = f"quarto/{vector_name}/{folder}/{relative_path}"
+        if not filenames:
+            return []
 
-                file_url = add_file_to_gcs(filename,
-                                           vector_name=vector_name,
-                                           metadata={"type": "quarto"},
-                                           bucket_filepath=bucket_filepath)
-        
-                log.info(f"Uploaded {filename} to {file_url=}")
-                output_urls.append(file_url)
+        storage_client = get_storage_client()
+        if not storage_client:
+            log.error(f"No storage client available to upload {folder=}")
+            return [None] * len(filenames)
+
+        bucket_name = resolve_bucket(vector_name)
+        bucket = storage_client.bucket(bucket_name)
+        prefix = prefix or f"quarto/{vector_name}/{folder}/"
+
+        # one listing call instead of an exists() round trip per file
+        try:
+            existing = {blob.name: blob.md5_hash for blob in bucket.list_blobs(prefix=prefix)}
+        except Exception as err:
+            log.warning(f"Could not list gs://{bucket_name}/{prefix} - {str(err)}")
+            existing = {}
+
+        def upload(filename):
+            start = time.time()
+            relative_path = os.path.relpath(filename, folder)
+            bucket_filepath = f"{prefix}{relative_path}"
+            file_url = f"gs://{bucket_name}/{bucket_filepath}"
+            compressed = compress and filename.lower().endswith(COMPRESSIBLE_EXTENSIONS)
+            upload_filename = compressed_copy(filename) if compressed else filename
+            size = os.path.getsize(upload_filename)
+            md5 = file_md5(upload_filename)
+            action = "uploaded"
+
+            def upload_blob():
+                blob = bucket.blob(bucket_filepath)
+                blob.metadata = {"vector_name": vector_name, "type": "quarto"}
+                content_type = None
+                if compressed:
+                    blob.content_encoding = "gzip"
+                    content_type = mimetypes.guess_type(filename)[0]
+                upload_with_retries(blob, upload_filename, content_type=content_type)
+
+            try:
+                source = _upload_manifest.get((bucket_name, md5))
+                if existing.get(bucket_filepath) == md5 or source == bucket_filepath:
+                    action = "skipped"
+                elif source:
+                    try:
+                        bucket.copy_blob(bucket.blob(source), bucket, bucket_filepath)
+                        action = "copied"
+                    except Exception as err:
+                        # the source was deleted or overwritten since it was recorded, so forget it and upload
+                        log.warning(f"Could not copy gs://{bucket_name}/{source} to {file_url}, uploading instead - {str(err)}")
+                        _upload_manifest.pop((bucket_name, md5), None)
+                        upload_blob()
+                else:
+                    upload_blob()
+            except Exception as err:
+                log.error(f"Failed to upload {filename} to {file_url} - {str(err)}")
+                file_url = None
+                action = "failed"
+            finally:
+                if compressed:
+                    os.remove(upload_filename)
+
+            if file_url:
+                _upload_manifest[(bucket_name, md5)] = bucket_filepath
+
+            stat = {
+                "file": relative_path,
+                "action": action,
+                "bytes": size if action == "uploaded" else 0,
+                "compressed": compressed,
+                "seconds": round(time.time() - start, 3)
+            }
+            log.info(f"{action.capitalize()} {filename} to {file_url=} - {stat['bytes']} bytes in {stat['seconds']}s")
+
+            return file_url, stat
+
+        max_workers = int(self.tool_config('upload_workers', DEFAULT_UPLOAD_WORKERS))
+        with span("gcs_upload", files=len(filenames)) as upload_span:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(upload, filenames))
+
+            output_urls = [file_url for file_url, _ in results]
+            self.last_upload_stats = [stat for _, stat in results]
+            upload_span.update(
+                bytes_out=sum(stat['bytes'] for stat in self.last_upload_stats),
+                deduplicated=sum(1 for stat in self.last_upload_stats if stat['action'] in ('skipped', 'copied')),
+                failed=sum(1 for stat in self.last_upload_stats if stat['action'] == 'failed')
+            )
+        log.info(f"Uploaded {len(output_urls)} files from {folder=}: "
+                 f"{sum(stat['bytes'] for stat in self.last_upload_stats)} bytes sent, "
+                 f"{sum(1 for stat in self.last_upload_stats if stat['action'] in ('skipped', 'copied'))} deduplicated")
 
         return output_urls
-        
+
+    def publish(self, folder: str) -> list:
+        """
+        Uploads a render's outputs, configured by tools.quarto.publish.
+
+        Only the output.<format> files and what they reference are uploaded, gzipped if publish.gzip is set.
+        HTML dependency libraries go to a content addressed folder, quarto/<vector_name>/libs/<library>-<hash>/,
+        uploaded once and shared by every render using the same library, and the HTML is pointed at it.
+        With publish turned off, everything in folder is uploaded as it is.
+
+        Returns:
+            list: as upload_to_gcs(), for the render's own files
+        """
+        publish_config = self.feature_config('publish')
+        if publish_config is None:
+            return self.upload_to_gcs(folder)
+
+        vector_name = self.config.vector_name
+        compress = publish_config.get('gzip', True)
+        files = select_outputs(folder)
+
+        # all of a library is published, as its scripts can load files the HTML does not name
+        libraries = {}
+        for library in shared_libraries(files):
+            libraries[library] = []
+            for root, _, walked in os.walk(os.path.join(folder, library)):
+                libraries[library].extend(os.path.relpath(os.path.join(root, file), folder) for file in walked)
+        files = sorted(set(files).union(*libraries.values()))
+
+        library_paths = {}
+        if publish_config.get('share_libraries', True):
+            for library, library_files in libraries.items():
+                library_path = f"quarto/{vector_name}/libs/{library_name(folder, library, library_files)}"
+                if library_path not in _published_libraries:
+                    with span("publish_library", library=os.path.basename(library)):
+                        library_urls = self.upload_to_gcs(
+                            os.path.join(folder, library),
+                            files=[os.path.relpath(file, library) for file in library_files],
+                            prefix=f"{library_path}/",
+                            compress=compress
+                        )
+                    if not library_urls or not all(library_urls):
+                        log.warning(f"Could not publish {library} to {library_path}, so uploading it with the render")
+                        continue
+                    # renders in other workers find it in the bucket listing, and skip re-sending it
+                    _published_libraries.add(library_path)
+                library_paths[library] = library_path
+
+            if library_paths:
+                point_at_libraries(folder, files, library_paths, f"quarto/{vector_name}/{folder}",
+                                   base_url=publish_config.get('public_base_url'))
+
+        shared = tuple(f"{library}{os.sep}" for library in library_paths)
+        own_files = [file for file in files if not file.startswith(shared)] if shared else files
+        log.info(f"Publishing {len(own_files)} files from {folder=}, sharing {len(library_paths)} libraries")
+
+        return self.upload_to_gcs(folder, files=own_files, compress=compress)
+
+    def publish_scope(self) -> dict:
+        """Where and how renders are published - the vector name, bucket and tools.quarto.publish - for render cache keys"""
+        vector_name = self.config.vector_name
+        return {
+            "vector_name": vector_name,
+            "bucket": resolve_bucket(vector_name),
+            "publish": self.feature_config('publish'),
+        }
+
+    def embed_resources(self, format: str) -> bool:
+        """Whether renders to format are made self-contained, via tools.quarto.publish.embed_resources"""
+        publish_config = self.feature_config('publish')
+        return bool(publish_config and publish_config.get('embed_resources')) and format in EMBEDDABLE_FORMATS
+
     def construct_tools(self) -> dict:
         #tools = self.config.vacConfig("tools")
         #if not tools:
@@ -44,13 +615,19 @@ class QuartoProcessor(GenAIFunctionProcessor):
         #    raise ValueError(f"No config.vac.{vac_name}.tools found")
         #quarto_config = tools.get("quarto")
 
+        files_config = self.tool_config('files', {}) or {}
+        max_file_chars = int(files_config.get('max_chars', DEFAULT_MAX_FILE_CHARS))
+
+        def file_summary(file_path: str, text: str) -> dict:
+            return {"status": "success", "file_path": file_path, "sha256": text_sha256(text),
+                    "lines": len(text.splitlines()), "chars": len(text)}
+
         def write_to_file(text: str, file_path: str = "renders/temp.py", append: bool=False) -> str:
             """
             Writes the given text content to a specified file for use in Quarto renders. 
             Do not use backticks (```) to the start of the text - this is text that will write directly to the file, not within markdown.
             This function will only write .py, .r files. Do not attempt to write other types of files with this function.
-            Will only accept up to 4000 characters of text each time to avoid overflow issues. 
-            Use the same file_path argument and call the function again to append additional text to the file.
+            Write the whole script in one call - long scripts are accepted. To change a file afterwards, use edit_file() rather than writing it again.
 
             Args:
                 text (str): The text content to write to the file.
@@ -58,25 +635,29 @@ class QuartoProcessor(GenAIFunctionProcessor):
                                 Default is "renders/temp.py".
                 append (bool): Whether you want to append to the existing file.  If False (default) then it will overwrite the existing file.
             Returns:
-                str: The path to the file where the text was written.
+                dict: "file_path", and the file's "sha256", "lines" and "chars" - pass the sha256 to edit_file().
             Raises:
                 ValueError: If the file extension is not .py or .r.
-                ValueError: If the text exceeds 4000 characters.
+                ValueError: If the file would be longer than the server's limit (files.max_chars).
             """
             try:
                 # Validate the file extension
                 if not file_path.endswith(('.py', '.r')):
                     raise ValueError("This function only supports writing to .py and .r files.")
 
-                # Ensure the text does not exceed 4000 characters
-                if len(text) > 4000:
-                    raise ValueError("Text exceeds the 4000 character limit. Shorten text and then call this function again with same file_name to append the text to the file.")
+                # Ensure \n gets rendered correctly, if the whole text came double escaped
+                text = unescape_newlines(text)
 
-                # Ensure the directory exists
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                # counted in characters like text, as bytes would overcount anything non-ASCII
+                existing = 0
+                if append and os.path.exists(file_path):
+                    with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
+                        existing = len(file.read())
+                if existing + len(text) > max_file_chars:
+                    raise ValueError(f"The file would be over the {max_file_chars} character limit.")
 
-                # Ensure \n gets rendered correctly
-                text = text.encode('utf-8').decode('unicode_escape')
+                # Ensure the directory exists
+                os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
 
                 mode = 'a' if append else 'w'
                 
@@ -86,12 +667,153 @@ class QuartoProcessor(GenAIFunctionProcessor):
                 
                 # Log the successful write operation
                 print(f"Text successfully written to {file_path}")
-                return file_path
+                self.remember("files", file_path, time.time())
+                if append:
+                    with open(file_path, 'r', encoding='utf-8') as file:
+                        text = file.read()
+                return json.dumps(file_summary(file_path, text))
 
             except Exception as e:
                 print(f"Error writing content to file: {str(e)}")
                 raise
 
+        def edit_file(file_path: str, expected_sha256: str, diff: str = "", start_line: int = 0, end_line: int = 0,
+                      replacement: str = "") -> dict:
+            """
+            Changes part of an existing .py or .r file, instead of writing the whole file again.
+            Either give a unified diff, or replace lines start_line to end_line with replacement.
+            The edit is only made if the file's sha256 still matches expected_sha256, as returned by
+            write_to_file(), edit_file() or read_file() - the first 8 characters are enough.
+
+            Args:
+                file_path (str): The file to edit.
+                expected_sha256 (str): The sha256 of the file as you last saw it.
+                diff (str): A unified diff, e.g. '@@ -7,2 +7,2 @@' then ' unchanged line', '-old line', '+new line'.
+                    Several hunks can be given. Context lines are matched even if the line numbers are a little off.
+                start_line (int): Without a diff, the first line (1-based) to replace.
+                end_line (int): The last line to replace, inclusive. Use start_line - 1 to insert before start_line.
+                replacement (str): The lines to put in place of start_line to end_line - "" deletes them.
+            Returns:
+                dict: "status", and the edited file's "sha256", "lines" and "chars". Any "diagnostics" from checking
+                    the edited script. On an error, a "message" and the file's current "sha256".
+            """
+            try:
+                if not file_path.endswith(('.py', '.r')):
+                    raise ValueError("This function only supports editing .py and .r files.")
+                with open(file_path, 'r', encoding='utf-8') as file:
+                    text = file.read()
+            except (OSError, ValueError) as err:
+                return json.dumps({"status": "error", "message": f"Could not edit {file_path}: {str(err)}"})
+
+            current_sha256 = text_sha256(text)
+            if not hash_matches(current_sha256, expected_sha256):
+                return json.dumps({
+                    "status": "error",
+                    "message": f"{file_path} has changed since sha256 {expected_sha256} - use read_file() to see it now, then edit again",
+                    "sha256": current_sha256,
+                })
+
+            try:
+                if diff:
+                    edited = apply_unified_diff(text, diff)
+                elif start_line:
+                    edited = replace_lines(text, int(start_line), int(end_line), unescape_newlines(replacement))
+                else:
+                    raise ValueError("Give either a diff, or a start_line and end_line to replace")
+                if len(edited) > max_file_chars:
+                    raise ValueError(f"The file would be over the {max_file_chars} character limit.")
+            except ValueError as err:
+                return json.dumps({"status": "error", "message": str(err), "sha256": current_sha256})
+
+            with open(file_path, 'w', encoding='utf-8') as file:
+                file.write(edited)
+            self.remember("files", file_path, time.time())
+            log.info(f"Edited {file_path}: {len(text)} to {len(edited)} characters")
+
+            result = file_summary(file_path, edited)
+            # checked straight away, so a broken edit is fixed before a render is tried
+            if self.feature_config('validator') is not None:
+                validation = script_diagnostics(file_path)
+                if validation["diagnostics"]:
+                    result["diagnostics"] = validation["diagnostics"]
+            return json.dumps(result)
+
+        def read_file(file_path: str, start_line: int = 1, end_line: int = 0) -> dict:
+            """
+            Shows a .py or .r file with line numbers, and its sha256 for edit_file().
+
+            Args:
+                file_path (str): The file to read.
+                start_line (int): The first line to show, default 1.
+                end_line (int): The last line to show, default 0 for the end of the file.
+            Returns:
+                dict: "sha256", "lines" and "chars" of the whole file, and "content", the requested lines numbered.
+            """
+            try:
+                if not file_path.endswith(('.py', '.r')):
+                    raise ValueError("This function only supports reading .py and .r files.")
+                with open(file_path, 'r', encoding='utf-8') as file:
+                    text = file.read()
+            except (OSError, ValueError) as err:
+                return json.dumps({"status": "error", "message": f"Could not read {file_path}: {str(err)}"})
+
+            return json.dumps(dict(file_summary(file_path, text), content=numbered(text, int(start_line), int(end_line))))
+
+        def render_format(render_dir: str, render_filename: str, format: str, render_flags: str) -> dict:
+            # Render the markdown file using Quarto from render_dir
+            output_filename = f'output.{format}'
+            if self.embed_resources(format):
+                render_flags += " -M embed-resources:true"
+            render_command = f"render {render_filename} --to={format} --output={output_filename}{render_flags}"
+            result = json.loads(quarto_command(render_command, cwd=render_dir))
+            log.info(f"{result=}")
+            return result
+
+        def render_formats(temp_dir: str, render_filename: str, formats: list, render_flags: str,
+                           knitr_stem: str = None, shared_dir: str = None) -> dict:
+            """
+            Renders each format in its own sub folder of temp_dir, so Quarto's intermediate files do not clash,
+            running up to tools.quarto.render_workers conversions at once.
+            With a knitr cache the first format is rendered alone, so the others reuse its executed chunks.
+            shared_dir (e.g. the executed notebook's figures) is copied into every sub folder.
+            """
+            knitr_dir = os.path.join(temp_dir, f"{knitr_stem}_cache") if knitr_stem else None
+
+            def render_in_subfolder(format):
+                format_dir = os.path.join(temp_dir, format)
+                os.makedirs(format_dir, exist_ok=True)
+                shutil.copy(os.path.join(temp_dir, render_filename), format_dir)
+                if shared_dir:
+                    shutil.copytree(shared_dir, os.path.join(format_dir, os.path.basename(shared_dir)), dirs_exist_ok=True)
+                if knitr_dir and os.path.isdir(knitr_dir):
+                    shutil.copytree(knitr_dir, os.path.join(format_dir, os.path.basename(knitr_dir)), dirs_exist_ok=True)
+
+                result = render_format(format_dir, render_filename, format, render_flags)
+
+                # only the outputs are uploaded from the sub folders
+                os.remove(os.path.join(format_dir, render_filename))
+                if knitr_dir:
+                    format_knitr_dir = os.path.join(format_dir, os.path.basename(knitr_dir))
+                    if os.path.isdir(format_knitr_dir):
+                        shutil.copytree(format_knitr_dir, knitr_dir, dirs_exist_ok=True)
+                        shutil.rmtree(format_knitr_dir, ignore_errors=True)
+                return result
+
+            results = {}
+            remaining = list(formats)
+            if knitr_dir:
+                results[remaining[0]] = render_in_subfolder(remaining.pop(0))
+
+            max_workers = min(len(remaining), int(self.tool_config('render_workers', DEFAULT_RENDER_WORKERS))) or 1
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # each conversion runs in a copy of this context, so its spans and job log lines are kept
+                futures = {format: executor.submit(contextvars.copy_context().run, render_in_subfolder, format)
+                           for format in remaining}
+                for format, future in futures.items():
+                    results[format] = future.result()
+
+            return {format: results[format] for format in formats}
+
         def render_and_upload_quarto(markdown_filename: str = "", format: str='html') -> dict:
             """
             Render and upload a Quarto markdown document to Google Cloud Storage.
@@ -102,58 +824,188 @@ class QuartoProcessor(GenAIFunctionProcessor):
             The markdown must be quarto formatted to work with quarto.
             The markdown will be supplied to the quarto_cmd() function and execute `quarto render temp.qmd --to={format} --output={filename}`
             If successfully rendered, the output file will then be uploaded to a GCS bucket
+            Renders of identical file content and format are cached, and return the previously uploaded gcs_urls.
+            Several formats can be rendered in one call, e.g. format='html,pdf' - the code is executed once for all of them.
+            Documents with no code cells render fastest, as nothing has to be executed.
             
             Args:
                 markdown_filename (str): The location of the markdown file to render. If not provided, a demo markdown file will be used.
-                format (str): The format to render the markdown file into - default is 'html'.
+                format (str): The format to render the markdown file into - default is 'html'. Separate several formats with commas.
             Returns:
                 dict: A dictionary with the result of the rendering process, including:
-                    - "status": "success" or "error" depending on the outcome.
+                    - "status": "success" or "error" depending on the outcome, or "partial" if only some formats rendered.
                     - "gcs_url": The URL of the uploaded file (if successful).
                     - "stdout": The standard output from the Quarto rendering process.
                     - "stderr": The standard error output from the Quarto rendering process.
                     - "message": An error message if the rendering or upload failed.
+                    - "cached": True if the result came from the render cache.
+                    - "formats": For several formats, the "status", "gcs_urls", "stdout" and "stderr" of each format.
             """
 
             if not markdown_filename:
                 markdown_filename = 'tools/demo.qmd'
 
-            try:               
-                # Create a timestamped directory
-                timestamp = time.strftime("%Y%m%d-%H%M%S")
-                temp_dir = os.path.join("renders", timestamp)
-                os.makedirs(temp_dir, exist_ok=True)
-
-                # Copy the markdown file to the timestamped directory
-                new_markdown_filename = os.path.join(temp_dir, os.path.basename(markdown_filename))
-                shutil.copy(markdown_filename, new_markdown_filename)
-
-                # Render the markdown file using Quarto from the new directory
-                output_filename = f'output.{format}'
-                render_command = f"render {os.path.basename(new_markdown_filename)} --to={format} --output={output_filename}"
-                result = quarto_command(render_command, cwd=temp_dir)
-                result = json.loads(result)
-                log.info(f"{result=}")
-
-                # Check if there was an error during rendering
-                if result["status"] == "error":
-                    return json.dumps({
-                        "status": "error",
-                        "stdout": result["stdout"],
-                        "stderr": result["stderr"],
-                        "message": "Quarto rendering failed."
-                    })
-                
-                # Upload the rendered file to Google Cloud Storage
-                upload_to_gcs = self.upload_to_gcs(temp_dir)
-                
-                return json.dumps({
-                    "status": "success",
-                    "gcs_urls": upload_to_gcs,
-                    "stdout": result["stdout"],
-                    "stderr": result["stderr"]
-                })
-            
+            formats = list(dict.fromkeys(fmt.strip() for fmt in format.split(',') if fmt.strip())) or ['html']
+            format = ",".join(formats)
+
+            try:
+                # scripts are checked before anything is started, as a malformed one only fails after a full render
+                if self.feature_config('validator') is not None and markdown_filename.lower().endswith(('.py', '.r')):
+                    with span("validate"):
+                        validation = script_diagnostics(markdown_filename)
+                    if validation["status"] == "error":
+                        return json.dumps({
+                            "status": "error",
+                            "message": "Not rendered, as Quarto would fail on this script - fix the lines in diagnostics and render again.",
+                            "diagnostics": validation["diagnostics"],
+                        })
+                    if validation["warnings"]:
+                        log.info(f"Rendering {markdown_filename} despite warnings: {validation['diagnostics']}")
+
+                cache = self.render_cache()
+                cache_key = None
+                if cache:
+                    with open(markdown_filename, 'rb') as f:
+                        # self-contained HTML is a different output, so gets its own entry
+                        embedded = [fmt for fmt in formats if self.embed_resources(fmt)]
+                        cache_format = f"{format};embed-resources={','.join(embedded)}" if embedded else format
+                        cache_key = render_cache_key(f.read(), cache_format, engine_versions(markdown_filename),
+                                                     scope=self.publish_scope())
+                    cached = cache.get(cache_key)
+                    annotate(cache_hit=bool(cached))
+                    if cached:
+                        log.info(f"Render cache hit for {markdown_filename} {format=} - {cache.stats()}")
+                        cached = {key: value for key, value in cached.items() if key != "cached_at"}
+                        self.remember("renders", f"{markdown_filename}:{format}", cached.get("gcs_urls"))
+                        return json.dumps(dict(cached, status="success", cached=True))
+
+                # A new directory in the session's workspace, kept from eviction while rendering
+                with self.workspace().render_dir(self.session_id) as temp_dir:
+                    # Copy the markdown file to the render directory
+                    new_markdown_filename = os.path.join(temp_dir, os.path.basename(markdown_filename))
+                    shutil.copy(markdown_filename, new_markdown_filename)
+
+                    render_filename = os.path.basename(new_markdown_filename)
+                    render_flags = ""
+                    # documents with no code go straight to Quarto's markdown engine, with no Jupyter or knitr to start
+                    markdown_only = self.feature_config('fast_path') is not None and execution_free(new_markdown_filename)
+                    if markdown_only:
+                        render_filename = os.path.basename(markdown_document(new_markdown_filename))
+                        render_flags = " --no-execute"
+                        annotate(engine="markdown")
+
+                    # Python scripts are executed in a warm pooled kernel, and Quarto renders the executed notebook
+                    kernel_pool = self.kernel_pool() if new_markdown_filename.endswith('.py') and not markdown_only else None
+                    if kernel_pool:
+                        try:
+                            # pooled kernels run outside run_command(), so take their render slot and limits here
+                            limits = self.sandbox_limits()
+                            with span("execute", engine="kernel_pool"), self.admission("python"):
+                                notebook = kernel_pool.execute_script(new_markdown_filename,
+                                                                      format=formats[0],
+                                                                      timeout=int(self.tool_config('command_timeout', DEFAULT_COMMAND_TIMEOUT)),
+                                                                      document=f"{self.session_id}:{os.path.abspath(markdown_filename)}",
+                                                                      cell_cache=self.cell_cache(),
+                                                                      max_rss_bytes=limits.get("max_rss_bytes", 0),
+                                                                      rlimits=limits.get("rlimits"))
+                        except Exception as err:
+                            return json.dumps({
+                                "status": "error",
+                                "stdout": "",
+                                "stderr": str(err),
+                                "message": "Executing the Python script failed.",
+                                "limit": getattr(err, "limit", None)
+                            })
+                        render_filename = os.path.basename(notebook)
+                        render_flags = " --no-execute"
+
+                    # knitr caches chunks itself, given its cache folder from the last render
+                    knitr_cache_key = None
+                    shared_dir = None
+                    if new_markdown_filename.lower().endswith(('.r', '.rmd')):
+                        knitr_cache_key = self.restore_knitr_cache(markdown_filename, temp_dir)
+                        if knitr_cache_key:
+                            render_flags = " --cache"
+
+                    # For several formats, Jupyter code is executed once into a notebook every format is rendered from
+                    elif len(formats) > 1 and not kernel_pool and not markdown_only and needs_jupyter_execution(new_markdown_filename):
+                        with span("execute", engine="quarto"):
+                            result = render_format(temp_dir, render_filename, "ipynb", " --execute")
+                        if result["status"] == "error":
+                            return json.dumps({
+                                "status": "error",
+                                "stdout": result["stdout"],
+                                "stderr": result["stderr"],
+                                "message": "Executing the document failed.",
+                                "limit": result.get("limit")
+                            })
+                        render_filename = "executed.ipynb"
+                        os.replace(os.path.join(temp_dir, "output.ipynb"), os.path.join(temp_dir, render_filename))
+                        render_flags = " --no-execute"
+                        if os.path.isdir(os.path.join(temp_dir, "output_files")):
+                            shared_dir = os.path.join(temp_dir, "output_files")
+
+                    if len(formats) == 1:
+                        result = render_format(temp_dir, render_filename, formats[0], render_flags)
+                    else:
+                        knitr_stem = os.path.splitext(os.path.basename(markdown_filename))[0] if knitr_cache_key else None
+                        format_results = render_formats(temp_dir, render_filename, formats, render_flags, knitr_stem, shared_dir)
+                        if shared_dir:
+                            shutil.rmtree(shared_dir, ignore_errors=True)
+
+                    if knitr_cache_key:
+                        self.save_knitr_cache(knitr_cache_key, markdown_filename, temp_dir)
+
+                    if len(formats) == 1:
+                        # Check if there was an error during rendering
+                        if result["status"] == "error":
+                            return json.dumps({
+                                "status": "error",
+                                "stdout": result["stdout"],
+                                "stderr": result["stderr"],
+                                "message": "Quarto rendering failed.",
+                                "limit": result.get("limit")
+                            })
+
+                        # Publish the rendered outputs to Google Cloud Storage
+                        upload_to_gcs = self.publish(temp_dir)
+                        render_result = {
+                            "gcs_urls": upload_to_gcs,
+                            "stdout": result["stdout"],
+                            "stderr": result["stderr"]
+                        }
+                    else:
+                        failed = [fmt for fmt, result in format_results.items() if result["status"] == "error"]
+                        if len(failed) == len(formats):
+                            return json.dumps({
+                                "status": "error",
+                                "formats": format_results,
+                                "message": "Quarto rendering failed for every format."
+                            })
+
+                        # one upload of every format's outputs, then the URLs are split out per format
+                        upload_to_gcs = self.publish(temp_dir)
+                        for fmt, result in format_results.items():
+                            result["gcs_urls"] = [
+                                url for url, stat in zip(upload_to_gcs, self.last_upload_stats)
+                                if stat["file"].startswith(f"{fmt}{os.sep}")
+                            ]
+                        render_result = {
+                            "gcs_urls": upload_to_gcs,
+                            "formats": format_results
+                        }
+                        if failed:
+                            render_result["message"] = f"Quarto rendering failed for {', '.join(failed)}"
+
+                    if cache and upload_to_gcs and all(upload_to_gcs) and "message" not in render_result:
+                        # a hit only needs the result, as the outputs are already published
+                        cache.put(cache_key, render_result)
+                        log.info(f"Render cache miss for {markdown_filename} {format=} - {cache.stats()}")
+
+                    status = "partial" if "message" in render_result else "success"
+                    self.remember("renders", f"{markdown_filename}:{format}", render_result["gcs_urls"])
+                    return json.dumps(dict(render_result, status=status))
+
             except Exception as e:
                 error_message = f"Error in render_and_upload_quarto: {str(e)}"
                 traceback_details = traceback.format_exc()
@@ -164,6 +1016,62 @@ class QuartoProcessor(GenAIFunctionProcessor):
                     "message": error_and_traceback,
                 })
         
+        def render_batch(path: str, format: str = 'html') -> dict:
+            """
+            Render and upload every Quarto document in a directory, or matching a glob such as 'reports/*.py', in parallel.
+            Use this instead of calling render_and_upload_quarto() once per file.
+            Each file's result is shown to the user as soon as it finishes, and a failing file does not stop the others.
+
+            Args:
+                path (str): A directory (searched recursively, skipping files and folders starting with '_' or '.') or a glob pattern.
+                format (str): The format to render each file into - default is 'html'. Separate several formats with commas.
+            Returns:
+                dict: "status" ("success", "partial" or "error"), "succeeded" and "failed" counts, and "results":
+                      for each file its "file", "status", "gcs_urls" and, if it failed, a shortened "message" and "stderr".
+            """
+            filenames = find_batch_files(path)
+            max_files = int(self.tool_config('batch_max_files', DEFAULT_MAX_BATCH_FILES))
+            if not filenames:
+                return json.dumps({"status": "error", "message": f"No renderable files found for {path}"})
+            if len(filenames) > max_files:
+                return json.dumps({"status": "error",
+                                   "message": f"{len(filenames)} files found for {path} - batches are limited to {max_files}"})
+
+            self.emit_progress(f"Rendering {len(filenames)} files from {path}\n")
+            pool = get_batch_pool(int(self.tool_config('batch_workers', DEFAULT_BATCH_WORKERS)))
+            futures = {pool.submit(render_batch_file, self.config, self.session_id, filename, format): filename
+                       for filename in filenames}
+
+            results = {}
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool as err:
+                    reset_batch_pool()
+                    result = {"file": filename, "status": "error", "message": f"The render process crashed: {str(err)}"}
+                except Exception as err:
+                    result = {"file": filename, "status": "error", "message": str(err)}
+
+                summary = {"file": filename, "status": result.get("status"), "gcs_urls": result.get("gcs_urls"), "seconds": result.get("seconds")}
+                if result.get("status") != "success":
+                    summary["message"] = elide_middle(str(result.get("message", "")), 1000)
+                    summary["stderr"] = elide_middle(str(result.get("stderr", "")), 2000)
+                results[filename] = summary
+                self.emit_progress(f"[batch {len(results)}/{len(filenames)}] {filename}: {summary['status']} "
+                                   f"{summary['gcs_urls'] or summary.get('message', '')}\n")
+
+            failed = sum(1 for result in results.values() if result["status"] != "success")
+            annotate(files=len(filenames), failed=failed)
+            status = "success" if not failed else ("error" if failed == len(filenames) else "partial")
+
+            return json.dumps({
+                "status": status,
+                "succeeded": len(filenames) - failed,
+                "failed": failed,
+                "results": [results[filename] for filename in filenames]
+            })
+
         def decide_to_go_on(go_on: bool, chat_summary: str) -> dict:
             """
             Examine the chat history.  If the answer to the user's question has been answered, then go_on=False.
@@ -183,46 +1091,53 @@ class QuartoProcessor(GenAIFunctionProcessor):
             """
             return {"go_on": go_on, "chat_summary": chat_summary}
         
-        def quarto_command(cmd: str, cwd: str = None) -> dict:
+        def quarto_command(cmd: str, cwd: str = None, timeout: int = 0) -> dict:
             """
             Run a Quarto command in the terminal and capture the output.
             Do not run commands starting with 'quarto' e.g. 'quarto preview' - instead use 'preview'.
             The 'quarto' command will be prefixed to your cmd.
+            Output is shown to the user as it happens; only the start and end of long output is returned.
             
             Args:
                 cmd (str): The command to execute with Quarto (e.g., 'check', 'render <file>').
                 cwd (str): The working directory in which to run the command. Default is None, 
-                   which means the command runs in the current working directory.        
+                   which means the command runs in the current working directory.
+                timeout (int): Seconds the command may run before it is stopped. Default is 0, the server's limit.
             Returns:
                 dict: A dictionary containing 'stdout' and 'stderr' from the command execution.
                     If the command is successful (return code 0), 'status' will be 'success',
                     even if there is content in 'stderr'.
+                    If a server limit stopped the command, or it could not start as the server was busy,
+                    'limit' says which: its 'kind' (wall_time, cpu, memory, output, file_size or admission) and 'message'.
             """
             try:
-                result = subprocess.run(
-                            ["quarto"] + cmd.split(), 
-                            capture_output=True, 
-                            text=True, 
-                            cwd=cwd
-                        )
-                log.info(f"{result.stdout=}")
-                log.info(f"{result.stderr=}")
+                result = self.run_command([QUARTO_BIN] + cmd.split(), cwd=cwd, timeout=timeout, label="quarto")
+
+                if result["limit"]:
+                    # a server limit stopped or refused the command, which the model may work around
+                    return json.dumps({
+                        "status": "error",
+                        "stdout": result["stdout"],
+                        "stderr": result["stderr"],
+                        "message": f"Quarto command '{cmd}': {result['limit']['message']}",
+                        "limit": result["limit"],
+                    })
 
-                if result.returncode == 0:
+                if result["returncode"] == 0:
                     # Command was successful
                     return json.dumps({
                         "status": "success",
-                        "stdout": result.stdout,
-                        "stderr": result.stderr
+                        "stdout": result["stdout"],
+                        "stderr": result["stderr"]
                     })
                 else:
                     # Command failed
                     return json.dumps({
                         "status": "error",
-                        "stdout": result.stdout,
-                        "stderr": result.stderr,
-                        "message": f"Quarto command '{cmd}' failed with return code {result.returncode}",
-                        "returncode": result.returncode
+                        "stdout": result["stdout"],
+                        "stderr": result["stderr"],
+                        "message": f"Quarto command '{cmd}' failed with return code {result['returncode']}",
+                        "returncode": result["returncode"]
                     })
                 
             except Exception as e:
@@ -232,43 +1147,58 @@ class QuartoProcessor(GenAIFunctionProcessor):
                     "stderr": f"Error running Quarto command '{cmd}': {str(e)}"
                 })
         
-        def quarto_version() -> str:
+        def quarto_version() -> dict:
             """
-            Reports back the version of Quarto available and what is installed on the server.
-            If the result starts with "OK:" then quarto is successfully installed.
-            There may be other dependencies thought that are not installed such as R or Jupyter.
+            Reports back the version of Quarto available and what is installed on the server:
+            the Python, Jupyter, R, knitr and LaTeX versions and which engines can execute documents.
+            The answer is cached, so this is quick - only use quarto_command('check') for Quarto's full diagnostics.
             
             Returns:
-                str: The version information of Quarto, as returned by the 'quarto check' command.
+                dict: "status" ("success" if Quarto is installed), "quarto", "python" and "r" versions,
+                    "engines" (e.g. markdown, jupyter, knitr) and "pdf_engines".
             """
-            result = quarto_command("check")
-            result = json.loads(result)
+            environment = get_environment_probe(quarto_bin=QUARTO_BIN).probe()
+            status = "success" if environment["quarto"]["version"] else "error"
+
+            return json.dumps(dict(environment, status=status))
 
-            if result["status"] == "success":
-                return f"OK: {result['stderr']}"
-            return result["stdout"]
+        def validate_script(file_path: str) -> dict:
+            """
+            Check a .py or .r script for problems Quarto would fail on, in milliseconds and without running it:
+            a missing or invalid YAML header, malformed '#|' cell options, Python syntax errors and literal \\n
+            sequences where there should be line breaks. render_and_upload_quarto() runs the same checks first.
+
+            Args:
+                file_path (str): The .py or .r file to check.
+            Returns:
+                dict: "status" ("ok" or "error"), and "diagnostics" each with the "line", "severity" and "message" to fix.
+            """
+            try:
+                return json.dumps(script_diagnostics(file_path))
+            except OSError as err:
+                return json.dumps({"status": "error", "message": f"Could not read {file_path}: {str(err)}"})
 
         def install_pip_package(package_name: str) -> dict:
             """
-            Install a pip package in the local environment.
+            Install pip packages in the local environment. Packages that are already installed are skipped.
             
             Args:
-                package_name (str): The name of the pip package to install.
+                package_name (str): The name of the pip package to install, or several separated by commas or spaces.
+                                    Version specifiers such as 'pandas>=2' are supported.
             
             Returns:
-                dict: A dictionary containing 'stdout' and 'stderr' from the command execution.
+                dict: A dictionary containing 'stdout' and 'stderr' from the command execution,
+                      and the 'installed' and 'already_installed' packages.
             """
             try:
-                result = subprocess.run(["pip", "install", package_name], capture_output=True, text=True)
+                packages = split_packages(package_name)
+                log.info(f"Installing packages {packages}")
+                result = self.package_manager().install_python(packages, run=self.run_command)
+                annotate(cache_hit=not result["installed"] and result["returncode"] == 0)
+                if result["installed"]:
+                    get_environment_probe(quarto_bin=QUARTO_BIN).invalidate()
 
-                log.info(f"Installing package {package_name}")
-                log.info(f"{result.stdout=}")
-                log.info(f"{result.stderr=}")
-
-                return json.dumps({
-                    "stdout": result.stdout,
-                    "stderr": result.stderr
-                })
+                return json.dumps(result)
             
             except Exception as e:
                 return json.dumps({
@@ -278,29 +1208,24 @@ class QuartoProcessor(GenAIFunctionProcessor):
 
         def install_r_package(package_name: str) -> dict:
             """
-            Install an R package in the local environment.
+            Install R packages in the local environment. Packages that are already installed are skipped.
             
             Args:
-                package_name (str): The name of the R package to install.
+                package_name (str): The name of the R package to install, or several separated by commas or spaces.
             
             Returns:
-                dict: A dictionary containing 'stdout' and 'stderr' from the command execution.
+                dict: A dictionary containing 'stdout' and 'stderr' from the command execution,
+                      and the 'installed' and 'already_installed' packages.
             """
             try:
-                # Construct the R command to install the package
-                r_command = f"install.packages('{package_name}', repos='https://cloud.r-project.org/')"
-                
-                # Run the R command
-                result = subprocess.run(["R", "-e", r_command], capture_output=True, text=True)
+                packages = split_packages(package_name)
+                log.info(f"Installing R packages {packages}")
+                result = self.package_manager().install_r(packages, run=self.run_command)
+                annotate(cache_hit=not result["installed"] and result["returncode"] == 0)
+                if result["installed"]:
+                    get_environment_probe(quarto_bin=QUARTO_BIN).invalidate()
 
-                log.info(f"Installing R package {package_name}")
-                log.info(f"{result.stdout=}")
-                log.info(f"{result.stderr=}")
-
-                return json.dumps({
-                    "stdout": result.stdout,
-                    "stderr": result.stderr
-                })
+                return json.dumps(result)
             
             except Exception as e:
                 return json.dumps({
@@ -308,14 +1233,83 @@ class QuartoProcessor(GenAIFunctionProcessor):
                     "stderr": f"Error installing R package '{package_name}': {str(e)}"
                     })
 
+        def submit_render_job(markdown_filename: str = "", format: str = 'html') -> dict:
+            """
+            Start rendering and uploading a Quarto document in the background, returning straight away with a job_id.
+            Use this instead of render_and_upload_quarto() for slow renders such as PDF output or scripts with heavy computation,
+            then call get_job_status(job_id) to follow its progress and get the same result render_and_upload_quarto() gives.
+
+            Args:
+                markdown_filename (str): The location of the file to render, as for render_and_upload_quarto()
+                format (str): The format to render the file into - default is 'html'.
+            Returns:
+                dict: "job_id" and "status" ("queued"), or "status": "error" and a "message" if no more jobs can be started.
+            """
+            try:
+                job = self.job_manager().submit("render", render_and_upload_quarto,
+                                                markdown_filename=markdown_filename, format=format)
+            except RuntimeError as err:
+                return json.dumps({"status": "error", "message": str(err)})
+
+            return json.dumps({"job_id": job["job_id"], "status": job["status"]})
+
+        def submit_install_job(package_name: str, language: str = "python") -> dict:
+            """
+            Start installing a package in the background, returning straight away with a job_id.
+            Use this for R packages, which can take minutes to compile, then call get_job_status(job_id) for the result.
+
+            Args:
+                package_name (str): The name of the package to install, or several separated by commas or spaces.
+                language (str): "python" for a pip package or "r" for an R package. Default is "python".
+            Returns:
+                dict: "job_id" and "status" ("queued"), or "status": "error" and a "message" if no more jobs can be started.
+            """
+            install = install_r_package if language.lower() == "r" else install_pip_package
+            try:
+                job = self.job_manager().submit(f"install_{language.lower()}", install, package_name=package_name)
+            except RuntimeError as err:
+                return json.dumps({"status": "error", "message": str(err)})
+
+            return json.dumps({"job_id": job["job_id"], "status": job["status"]})
+
+        def get_job_status(job_id: str, wait_seconds: int = 0) -> dict:
+            """
+            Report the progress of a background job started by submit_render_job() or submit_install_job().
+            Waits up to wait_seconds (at most 60) for the job to finish before answering, to avoid polling too often.
+
+            Args:
+                job_id (str): The job_id returned when the job was submitted.
+                wait_seconds (int): How long to wait for the job to finish. Default is 0, which reports immediately.
+            Returns:
+                dict: The job "status" ("queued", "running", "success" or "error"), the latest "log" lines,
+                    and once finished the "result" of the render or install.
+            """
+            job = self.job_manager().wait(job_id, timeout=min(max(int(wait_seconds), 0), 60))
+            if not job:
+                return json.dumps({"status": "error", "message": f"No job found with job_id {job_id}"})
+
+            return json.dumps({
+                "job_id": job_id,
+                "status": job["status"],
+                "log": job["log"][-20:],
+                "result": job["result"],
+            })
+
         return {
             "render_and_upload_quarto": render_and_upload_quarto,
+            "render_batch": render_batch,
+            "submit_render_job": submit_render_job,
+            "submit_install_job": submit_install_job,
+            "get_job_status": get_job_status,
             "quarto_command": quarto_command,
             "quarto_version": quarto_version,
+            "validate_script": validate_script,
             "decide_to_go_on": decide_to_go_on,
             "install_pip_package": install_pip_package,
             "install_r_package": install_r_package,
             "write_to_file": write_to_file,
+            "edit_file": edit_file,
+            "read_file": read_file,
         }
 
 def get_quarto(config:ConfigManager, processor:QuartoProcessor):
@@ -332,6 +1326,11 @@ def get_quarto(config:ConfigManager, processor:QuartoProcessor):
                     "When you think the answer has been given to the satisfaction of the user, or you think no answer is possible, or you need user confirmation or input, you MUST use the decide_to_go_on(go_on=False) function"
                     "When you want to ask the question to the user, mark the go_on=False in the function"
                     "You must use the render_and_upload_quarto() function to render Quarto functions and upload them to the pre-configured bucket.  Do not try to use your own bucket"
+                    "For slow renders such as PDFs, or R package installs, use submit_render_job() or submit_install_job() and follow them with get_job_status()"
+                    "To render several files, such as a folder of reports or a Quarto project, use render_batch() rather than one render per file"
+                    "Scripts are checked before rendering - if render_and_upload_quarto() returns diagnostics, fix those lines and render again, or use validate_script() to check a script first"
+                    "Write each script whole in one write_to_file() call. To fix or change it, use edit_file() with a diff or line range and the sha256 you were given, rather than writing the file again"
+                    "Install all the packages you need in one call, e.g. install_pip_package('pandas, seaborn') - packages already installed are skipped"
                     "DO NOT use .qmd files as there are issues parsing markdown - always write .py and .r files with the appropriate Quarto metadata instead."
                     '''These are instructions on how to annotate .py files for Quarto:
 Script rendering for Jupyter makes use of the percent format that is supported by several other tools including Spyder, VS Code, PyCharm, and Jupytext.
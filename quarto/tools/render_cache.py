@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from my_log import log
+
+from .sandbox import memory_share
+
+DEFAULT_CACHE_FOLDER = "renders/.render_cache"
+# renders/ is on Cloud Run's in-memory filesystem, so each cache is a share of the instance memory
+DEFAULT_MAX_BYTES = memory_share(0.05)
+# entries are written to a temporary folder and renamed into place - one without entry.json younger
+# than this may be another worker's put still in progress, so is left alone
+INCOMPLETE_GRACE_SECONDS = 3600
+TEMP_PREFIX = ".tmp-"
+
+
+def _folder_size(folder: str) -> int:
+    total = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+
+def render_cache_key(source_bytes: bytes, format: str, versions: dict, scope: dict = None) -> str:
+    """
+    Content address for a render: the source bytes, the output format, the versions of Quarto and
+    the execution engines that would produce it, and scope - where and how it was published, such as
+    the vector name, bucket and publish settings, as the cache folder is shared by every VAC on the instance.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(source_bytes)
+    hasher.update(b"\0" + format.encode("utf-8"))
+    hasher.update(b"\0" + json.dumps(versions, sort_keys=True).encode("utf-8"))
+    hasher.update(b"\0" + json.dumps(scope or {}, sort_keys=True, default=str).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class RenderCache:
+    """
+    Size bounded on-disk store of finished renders, evicted least recently used first.
+
+    Each entry is a folder named after its render_cache_key() holding an entry.json
+    (the uploaded gcs_urls plus the Quarto stdout/stderr), and for entries put() with an output_folder,
+    such as knitr chunk caches, a copy of it. The cell cache (executed cell outputs and knitr chunk caches)
+    is a RenderCache in its own folder.
+
+    Every gunicorn worker on the instance shares the folder: entries are written to a temporary folder and
+    renamed into place, and each put() rescans the folder so entries from other workers count towards max_bytes.
+    """
+
+    def __init__(self, folder: str = DEFAULT_CACHE_FOLDER, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size in bytes, oldest first
+        self._load()
+
+    def _entry_folder(self, key: str) -> str:
+        return os.path.join(self.folder, key)
+
+    def _load(self):
+        os.makedirs(self.folder, exist_ok=True)
+        self._scan()
+        log.info(f"Loaded {len(self._entries)} render cache entries from {self.folder}")
+
+    def _scan(self):
+        """Rebuilds the index from the folder, oldest used first, keeping the sizes already known"""
+        now = time.time()
+        found = []
+        for key in os.listdir(self.folder):
+            entry_folder = self._entry_folder(key)
+            entry_json = os.path.join(entry_folder, "entry.json")
+            try:
+                if key.startswith(TEMP_PREFIX):
+                    raise FileNotFoundError(entry_json)
+                found.append((os.path.getmtime(entry_json), key))
+            except OSError:
+                # a put() that never finished, once it is too old to still be running
+                try:
+                    if now - os.path.getmtime(entry_folder) > INCOMPLETE_GRACE_SECONDS:
+                        shutil.rmtree(entry_folder, ignore_errors=True)
+                except OSError:
+                    pass
+
+        known = self._entries
+        self._entries = OrderedDict()
+        for _, key in sorted(found):
+            self._entries[key] = known[key] if key in known else _folder_size(self._entry_folder(key))
+
+    def outputs_folder(self, key: str) -> str:
+        """Where the output_folder given to put() was copied for key"""
+        return os.path.join(self._entry_folder(key), "outputs")
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(self._entries.values())
+
+    def get(self, key: str):
+        """Returns the cached render result dict for key, or None on a miss."""
+        with self._lock:
+            entry_json = os.path.join(self._entry_folder(key), "entry.json")
+            if key not in self._entries and not os.path.isfile(entry_json):
+                self.misses += 1
+                return None
+
+            try:
+                with open(entry_json, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError) as err:
+                log.warning(f"Dropping unreadable render cache entry {key}: {str(err)}")
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            if key not in self._entries:
+                # put by another worker
+                self._entries[key] = _folder_size(self._entry_folder(key))
+            self._entries.move_to_end(key)
+            os.utime(entry_json)
+            self.hits += 1
+
+            return entry
+
+    def put(self, key: str, result: dict, output_folder: str = None, exclude: list = None):
+        """
+        Stores result under key, copying output_folder alongside it if given.
+        Files named in exclude (e.g. the copied source) are not stored.
+        """
+        # written outside the lock and the entry's folder, so readers never see half an entry
+        temp_folder = os.path.join(self.folder, f"{TEMP_PREFIX}{key}-{uuid.uuid4().hex[:8]}")
+        try:
+            if output_folder:
+                shutil.copytree(output_folder, os.path.join(temp_folder, "outputs"),
+                                ignore=shutil.ignore_patterns(*(exclude or [])))
+            else:
+                os.makedirs(temp_folder)
+            with open(os.path.join(temp_folder, "entry.json"), 'w', encoding='utf-8') as f:
+                json.dump(dict(result, cached_at=time.time()), f)
+        except OSError as err:
+            log.warning(f"Could not write render cache entry {key}: {str(err)}")
+            shutil.rmtree(temp_folder, ignore_errors=True)
+            return
+
+        size = _folder_size(temp_folder)
+        if size > self.max_bytes:
+            log.info(f"Render of {size} bytes is larger than the cache - not caching {key}")
+            shutil.rmtree(temp_folder, ignore_errors=True)
+            return
+
+        with self._lock:
+            self._remove(key)
+            try:
+                os.rename(temp_folder, self._entry_folder(key))
+            except OSError as err:
+                # another worker put the same key in between
+                log.info(f"Not replacing render cache entry {key}: {str(err)}")
+                shutil.rmtree(temp_folder, ignore_errors=True)
+            self._scan()
+            self._evict()
+
+    def _remove(self, key: str):
+        self._entries.pop(key, None)
+        shutil.rmtree(self._entry_folder(key), ignore_errors=True)
+
+    def _evict(self):
+        while self._entries and self.size_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            log.info(f"Evicting render cache entry {oldest}")
+            self._remove(oldest)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+_render_caches = {}
+_render_caches_lock = threading.Lock()
+
+def get_render_cache(folder: str = DEFAULT_CACHE_FOLDER, max_bytes: int = DEFAULT_MAX_BYTES) -> RenderCache:
+    """Process wide RenderCache per folder, so hits survive across requests."""
+    with _render_caches_lock:
+        cache = _render_caches.get(folder)
+        if cache is None:
+            cache = RenderCache(folder, max_bytes=max_bytes)
+            _render_caches[folder] = cache
+        cache.max_bytes = max_bytes
+        return cache
@@ -0,0 +1,197 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from my_log import log
+
+DEFAULT_JOBS_FOLDER = "renders/.jobs"
+DEFAULT_MAX_WORKERS = 2
+DEFAULT_MAX_QUEUED = 20
+DEFAULT_JOB_TTL = 24 * 60 * 60
+MAX_LOG_LINES = 200
+LOG_FLUSH_SECONDS = 0.5
+
+FINISHED = ("success", "error")
+
+# set while a job runs, so tools can add progress lines to the job instead of a request's stream
+current_job_log = contextvars.ContextVar("current_job_log", default=None)
+
+
+class JobManager:
+    """
+    Runs long tool calls (renders, package installs) in the background on a bounded thread pool.
+
+    Job state is written to <folder>/<job_id>.json, so any gunicorn worker on the instance
+    can answer a poll for a job that another worker is running.
+    """
+
+    def __init__(self,
+                 folder: str = DEFAULT_JOBS_FOLDER,
+                 max_workers: int = DEFAULT_MAX_WORKERS,
+                 max_queued: int = DEFAULT_MAX_QUEUED,
+                 ttl: int = DEFAULT_JOB_TTL):
+        self.folder = folder
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="render-job")
+        self._jobs = {}  # job_id -> job dict, for jobs this process is running
+        self._flushed = {}
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.folder, f"{job_id}.json")
+
+    def _write(self, job: dict, force: bool = True):
+        now = time.time()
+        if not force and now - self._flushed.get(job["job_id"], 0) < LOG_FLUSH_SECONDS:
+            return
+        self._flushed[job["job_id"]] = now
+
+        with self._lock:
+            state = json.dumps(job)
+        path = self._path(job["job_id"])
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(state)
+        os.replace(temp_path, path)
+
+    def _active(self) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job["status"] not in FINISHED)
+
+    def submit(self, kind: str, fn, **kwargs) -> dict:
+        """
+        Queues fn(**kwargs) and returns the new job straight away.
+        While fn runs, current_job_log holds a function that adds progress lines to the job.
+
+        Raises:
+            RuntimeError: If max_queued jobs are already waiting or running.
+        """
+        if self._active() >= self.max_queued:
+            raise RuntimeError(f"Too many background jobs ({self.max_queued}) - try again when one has finished")
+
+        self.prune()
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "kind": kind,
+            "args": kwargs,
+            "status": "queued",
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "result": None,
+            "log": [],
+        }
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+        self._write(job)
+        self._executor.submit(self._run, job, fn, kwargs)
+        log.info(f"Queued {kind} job {job['job_id']} with {kwargs}")
+
+        return job
+
+    def _run(self, job: dict, fn, kwargs: dict):
+        job["status"] = "running"
+        job["started"] = time.time()
+        self._write(job)
+
+        def job_log(line: str):
+            with self._lock:
+                job["log"].append(line)
+                del job["log"][:-MAX_LOG_LINES]
+            self._write(job, force=False)
+
+        token = current_job_log.set(job_log)
+        try:
+            result = fn(**kwargs)
+            if isinstance(result, str):
+                try:
+                    result = json.loads(result)
+                except ValueError:
+                    pass
+            job["result"] = result
+            failed = isinstance(result, dict) and result.get("status") == "error"
+            job["status"] = "error" if failed else "success"
+        except Exception as err:
+            log.warning(f"Job {job['job_id']} failed: {traceback.format_exc()}")
+            job["result"] = {"status": "error", "message": str(err)}
+            job["status"] = "error"
+        finally:
+            current_job_log.reset(token)
+
+        job["finished"] = time.time()
+        self._write(job)
+        with self._lock:
+            self._jobs.pop(job["job_id"], None)
+        self._flushed.pop(job["job_id"], None)
+        log.info(f"Job {job['job_id']} finished with {job['status']} in {job['finished'] - job['started']:.2f}s")
+
+    def get(self, job_id: str):
+        """The job's current state, or None if it is unknown on this instance."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return json.loads(json.dumps(job))
+        try:
+            with open(self._path(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def wait(self, job_id: str, timeout: float = 0, poll_interval: float = 0.5):
+        """Polls until the job finishes or timeout seconds pass, returning its latest state."""
+        deadline = time.time() + timeout
+        job = self.get(job_id)
+        while job and job["status"] not in FINISHED and time.time() < deadline:
+            time.sleep(poll_interval)
+            job = self.get(job_id)
+        return job
+
+    def stream(self, job_id: str, poll_interval: float = 1.0, timeout: float = 3600):
+        """Yields the job state each time its status or log changes, until it finishes."""
+        deadline = time.time() + timeout
+        last = None
+        while time.time() < deadline:
+            job = self.get(job_id)
+            if job is None:
+                yield {"job_id": job_id, "status": "error", "message": "Unknown job"}
+                return
+            snapshot = (job["status"], len(job["log"]), job["log"][-1:] if job["log"] else None)
+            if snapshot != last:
+                last = snapshot
+                yield job
+            if job["status"] in FINISHED:
+                return
+            time.sleep(poll_interval)
+
+    def prune(self):
+        """Deletes the state files of jobs older than ttl."""
+        cutoff = time.time() - self.ttl
+        for filename in os.listdir(self.folder):
+            path = os.path.join(self.folder, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+def get_job_manager(**settings) -> JobManager:
+    """The worker's JobManager, created on first use. max_workers is fixed once its thread pool exists."""
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(**settings)
+        if "max_queued" in settings:
+            _job_manager.max_queued = settings["max_queued"]
+        return _job_manager
@@ -0,0 +1,339 @@
+import contextlib
+import contextvars
+import fcntl
+import os
+import resource
+import signal
+import threading
+import time
+
+from my_log import log
+
+# render slots are lock files, so every gunicorn worker on the instance shares them
+DEFAULT_SLOTS_FOLDER = "renders/.slots"
+DEFAULT_MAX_CONCURRENT = max(2, (os.cpu_count() or 1) // 2)
+DEFAULT_MAX_QUEUED = 8
+DEFAULT_QUEUE_SECONDS = 300
+DEFAULT_MIN_AVAILABLE_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_RSS_BYTES = 1536 * 1024 * 1024
+DEFAULT_MAX_CPU_SECONDS = 1800
+DEFAULT_MAX_FILE_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_MAX_OUTPUT_CHARS = 50 * 1000 * 1000
+# off by default: deno and V8 reserve far more address space than they use
+DEFAULT_MAX_ADDRESS_SPACE_BYTES = 0
+
+RLIMITS = {
+    "cpu_seconds": resource.RLIMIT_CPU,
+    "file_bytes": resource.RLIMIT_FSIZE,
+    "address_space_bytes": resource.RLIMIT_AS,
+}
+# a process over its soft CPU limit gets SIGXCPU, and SIGKILL this many seconds later
+CPU_GRACE_SECONDS = 10
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# memory assumed by memory_share() when no limit can be read, the size the service is deployed with
+FALLBACK_MEMORY_BYTES = 2 * 1024 * 1024 * 1024
+
+# the slot held by this render, so nested calls such as a render's own commands do not take a second one
+_held_slot = contextvars.ContextVar("held_slot", default=None)
+
+
+def enforcement(kind: str, limit, observed=None, message: str = "") -> dict:
+    """
+    A limit that stopped or refused a command, for tool results to report to the model.
+    kind is one of wall_time, cpu, memory, output, file_size or admission.
+    """
+    return {"kind": kind, "limit": limit, "observed": observed, "message": message}
+
+
+class LimitExceeded(RuntimeError):
+    """Raised when a limit stops work run outside stream_subprocess(), carrying the enforcement() for the tool result."""
+
+    def __init__(self, limit: dict):
+        super().__init__(limit["message"])
+        self.limit = limit
+
+
+class AdmissionRejected(LimitExceeded):
+    """Raised when a command is refused a render slot."""
+
+
+def _read_int(path: str):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def available_memory():
+    """
+    Bytes of memory that can still be used: the lower of MemAvailable and what is left under the
+    container's cgroup limit, not counting reclaimable page cache. None if neither can be read.
+    """
+    candidates = []
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    candidates.append(int(line.split()[1]) * 1024)
+                    break
+    except OSError:
+        pass
+
+    # cgroup v2, then v1 - an unlimited v1 group reports a huge limit, which min() ignores
+    for limit_file, usage_file, stat_file, inactive_key in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory.stat", "inactive_file"),
+        ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+         "/sys/fs/cgroup/memory/memory.stat", "total_inactive_file"),
+    ):
+        limit = _read_int(limit_file)
+        usage = _read_int(usage_file)
+        if limit is None or usage is None:
+            continue
+        inactive = 0
+        try:
+            with open(stat_file) as f:
+                for line in f:
+                    key, _, value = line.partition(" ")
+                    if key == inactive_key:
+                        inactive = int(value)
+                        break
+        except (OSError, ValueError):
+            pass
+        candidates.append(max(limit - usage + inactive, 0))
+        break
+
+    return min(candidates) if candidates else None
+
+
+def memory_limit():
+    """
+    Bytes of memory the container may use: the lower of MemTotal and its cgroup limit.
+    None if neither can be read.
+    """
+    candidates = []
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    candidates.append(int(line.split()[1]) * 1024)
+                    break
+    except OSError:
+        pass
+
+    for limit_file in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        limit = _read_int(limit_file)
+        if limit is not None:
+            candidates.append(limit)
+            break
+
+    return min(candidates) if candidates else None
+
+
+def memory_share(fraction: float) -> int:
+    """
+    fraction of memory_limit(), as the default size of a store under renders/. Cloud Run's
+    filesystem is held in memory, so every byte written there counts against the instance limit.
+    """
+    return int((memory_limit() or FALLBACK_MEMORY_BYTES) * fraction)
+
+
+def process_group_rss(pgid: int) -> int:
+    """Resident bytes of every process in the process group pgid, e.g. quarto with its deno, pandoc and kernel"""
+    total = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # fields after the command name start at field 3 (state), so pgrp (5) is [2] and rss (24) is [21]
+        if len(fields) > 21 and int(fields[2]) == pgid:
+            total += int(fields[21]) * PAGE_SIZE
+    return total
+
+
+def apply_rlimits(pid: int, rlimits: dict):
+    """
+    Sets rlimits, a dict of RLIMITS names to values (0 for none), on the running process pid.
+    The processes it starts from then on inherit them. Applied after the process starts rather
+    than in preexec_fn, which is not safe in this multi-threaded server.
+    """
+    for name, value in (rlimits or {}).items():
+        if not value:
+            continue
+        hard = value + CPU_GRACE_SECONDS if name == "cpu_seconds" else value
+        try:
+            resource.prlimit(pid, RLIMITS[name], (value, hard))
+        except (OSError, ValueError, AttributeError) as err:
+            log.warning(f"Could not set {name}={value} on process {pid} - {str(err)}")
+
+
+def process_cpu_seconds(pid: int) -> float:
+    """CPU seconds used so far by process pid and the children it has waited for, or 0 if unknown"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return 0
+    # utime, stime, cutime and cstime (fields 14 to 17) are [11] to [14] after the command name
+    return sum(int(value) for value in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+
+
+def rlimit_enforcement(returncode: int, stderr: str, rlimits: dict):
+    """The enforcement() for a process stopped by one of its rlimits, or None"""
+    rlimits = rlimits or {}
+    if returncode == -signal.SIGXCPU:
+        return enforcement("cpu", rlimits.get("cpu_seconds"),
+                           message=f"Stopped after using {rlimits.get('cpu_seconds')} seconds of CPU")
+    # processes ignoring SIGXFSZ, such as Python, get EFBIG errors instead
+    if returncode == -signal.SIGXFSZ or (rlimits.get("file_bytes") and "File too large" in (stderr or "")):
+        return enforcement("file_size", rlimits.get("file_bytes"),
+                           message=f"Stopped writing a file larger than {rlimits.get('file_bytes')} bytes")
+    return None
+
+
+class AdmissionController:
+    """
+    Caps the commands running at once on the instance at max_concurrent, across gunicorn workers,
+    with one lock file per slot in slots_folder.
+
+    A command waits for a free slot, and for at least min_available_bytes of memory to be free,
+    for up to queue_seconds. It is refused at once if max_queued commands in this worker are
+    already waiting, and when its wait runs out.
+    """
+
+    def __init__(self,
+                 slots_folder: str = DEFAULT_SLOTS_FOLDER,
+                 max_concurrent: int = DEFAULT_MAX_CONCURRENT,
+                 max_queued: int = DEFAULT_MAX_QUEUED,
+                 queue_seconds: float = DEFAULT_QUEUE_SECONDS,
+                 min_available_bytes: int = DEFAULT_MIN_AVAILABLE_BYTES):
+        self.slots_folder = slots_folder
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_seconds = queue_seconds
+        self.min_available_bytes = min_available_bytes
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self._waiting = 0
+        self._lock = threading.Lock()
+        os.makedirs(slots_folder, exist_ok=True)
+
+    def _try_slot(self):
+        """An open, locked slot file descriptor, or None if every slot is taken"""
+        for index in range(self.max_concurrent):
+            fd = os.open(os.path.join(self.slots_folder, f"slot-{index}.lock"), os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                os.close(fd)
+        return None
+
+    def _admit(self):
+        """(slot fd, None) when admitted now, or (None, reason) with reason memory or busy"""
+        available = available_memory()
+        if available is not None and available < self.min_available_bytes:
+            return None, "memory"
+        fd = self._try_slot()
+        return (fd, None) if fd is not None else (None, "busy")
+
+    def _rejection(self, reason: str, waited: float) -> AdmissionRejected:
+        with self._lock:
+            self.rejected += 1
+        if reason == "memory":
+            available = available_memory()
+            limit = enforcement("admission", self.min_available_bytes, available,
+                                f"Not started: only {available} bytes of memory free on the server, "
+                                f"below the {self.min_available_bytes} needed - try again shortly")
+        elif reason == "queue":
+            limit = enforcement("admission", self.max_queued, self.max_queued,
+                                f"Not started: {self.max_queued} commands are already waiting for the server - try again shortly")
+        else:
+            limit = enforcement("admission", self.max_concurrent, self.max_concurrent,
+                                f"Not started: the server was still running {self.max_concurrent} commands "
+                                f"after waiting {round(waited)}s - try again shortly")
+        limit["reason"] = reason
+        return AdmissionRejected(limit)
+
+    @contextlib.contextmanager
+    def slot(self, label: str = "command", on_wait=None):
+        """
+        Holds a slot for the block, waiting for one if needed and calling on_wait(message) once if so.
+
+        Raises:
+            AdmissionRejected: if no slot came free in time, or too many commands are waiting.
+        """
+        if _held_slot.get() is not None:
+            yield
+            return
+
+        start = time.time()
+        fd, reason = self._admit()
+        if fd is None:
+            with self._lock:
+                if self._waiting >= self.max_queued:
+                    queue_full = True
+                else:
+                    queue_full = False
+                    self._waiting += 1
+                    self.queued += 1
+            if queue_full:
+                raise self._rejection("queue", 0)
+            try:
+                log.info(f"Queueing {label} - {reason}")
+                if on_wait:
+                    on_wait(f"Waiting for the server to free up ({'memory' if reason == 'memory' else 'all render slots busy'})")
+                delay = 0.05
+                while fd is None:
+                    waited = time.time() - start
+                    if waited >= self.queue_seconds:
+                        raise self._rejection(reason, waited)
+                    time.sleep(min(delay, self.queue_seconds - waited))
+                    delay = min(delay * 2, 1.0)
+                    fd, reason = self._admit()
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+
+        with self._lock:
+            self.admitted += 1
+        token = _held_slot.set(fd)
+        log.info(f"Admitted {label} after {time.time() - start:.2f}s")
+        try:
+            yield
+        finally:
+            _held_slot.reset(token)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "waiting": self._waiting,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "available_memory_bytes": available_memory(),
+            }
+
+
+_admission_controller = None
+_admission_controller_lock = threading.Lock()
+
+def get_admission_controller(**settings) -> AdmissionController:
+    """The worker's AdmissionController, created on first use."""
+    global _admission_controller
+    with _admission_controller_lock:
+        if _admission_controller is None:
+            _admission_controller = AdmissionController(**settings)
+        for key in ("max_concurrent", "max_queued", "queue_seconds", "min_available_bytes"):
+            if key in settings:
+                setattr(_admission_controller, key, settings[key])
+        return _admission_controller
@@ -0,0 +1,104 @@
+import contextvars
+import os
+import re
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from my_log import log
+
+DEFAULT_TOOL_WORKERS = 4
+# zero width and other format characters, and control characters other than tab and newline
+INVISIBLE_CHARACTERS = re.compile(r'[\u200b-\u200f\u202a-\u202e\u2060-\u2064\ufeff\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+
+
+def remove_invisible_characters(result):
+    """result with invisible characters removed from it, or from each string in it if it is a list"""
+    if isinstance(result, str):
+        return INVISIBLE_CHARACTERS.sub("", result)
+    if isinstance(result, list):
+        return [remove_invisible_characters(item) for item in result]
+    return result
+
+
+def file_resource(path: str) -> str:
+    return f"file:{os.path.abspath(path)}" if path else None
+
+
+def call_dependencies(calls: list, resources: dict) -> list:
+    """
+    For each of calls, a (name, params) list in the order the model made them, the positions of the earlier
+    calls it must wait for.
+
+    resources maps a tool name to a function of its params returning (reads, writes), the resources such as
+    files or package environments it uses. A call waits for earlier calls writing what it reads or writes,
+    and for earlier calls reading what it writes. Tools not in resources run alone: after every earlier
+    call, and before every later one.
+    """
+    dependencies = []
+    declared = []
+    for position, (name, params) in enumerate(calls):
+        if name in resources:
+            try:
+                reads, writes = resources[name](params)
+                reads = {resource for resource in reads if resource}
+                writes = {resource for resource in writes if resource}
+            except Exception as err:
+                log.warning(f"Could not work out what {name}({params}) uses, so running it alone - {str(err)}")
+                reads = writes = None
+        else:
+            reads = writes = None
+
+        if reads is None:
+            after = set(range(position))
+        else:
+            after = set()
+            for earlier, (earlier_reads, earlier_writes) in enumerate(declared):
+                if earlier_reads is None:
+                    after.add(earlier)
+                elif earlier_writes & (reads | writes) or earlier_reads & writes:
+                    after.add(earlier)
+
+        declared.append((reads, writes))
+        dependencies.append(sorted(after))
+
+    return dependencies
+
+
+def run_calls(funcs: dict, calls: list, resources: dict, max_workers: int = DEFAULT_TOOL_WORKERS) -> list:
+    """
+    Runs calls, (name, params) pairs, concurrently where call_dependencies() allows, each in a copy of the
+    caller's context so spans and job logs follow it. Results have invisible characters removed, and an
+    exception becomes a short error message as the call's result, with its traceback only logged.
+
+    Returns:
+        list: [name, params, result] for each call, in the order of calls
+    """
+    def run(name, params):
+        try:
+            result = remove_invisible_characters(funcs[name](**params))
+            log.info(f"Got result from {name}: {result}")
+        except Exception as err:
+            error_message = f"Error in {name}: {type(err).__name__}: {str(err)}"
+            log.warning(f"{error_message}\nTraceback: {traceback.format_exc()}")
+            result = [error_message]
+        return [name, params, result]
+
+    if len(calls) <= 1 or max_workers <= 1:
+        return [run(name, params) for name, params in calls]
+
+    dependencies = call_dependencies(calls, resources)
+    log.info(f"Running {len(calls)} function calls with dependencies {dependencies}")
+
+    # calls are queued in order, so those a call waits for have always been started before it
+    futures = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(calls)), thread_name_prefix="tool-call") as executor:
+        for (name, params), after in zip(calls, dependencies):
+            waits_for = [futures[earlier] for earlier in after]
+
+            def call(name=name, params=params, waits_for=waits_for):
+                wait(waits_for)
+                return run(name, params)
+
+            futures.append(executor.submit(contextvars.copy_context().run, call))
+
+    return [future.result() for future in futures]
@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import OrderedDict
+
+from my_log import log
+
+DEFAULT_MAX_SESSIONS = 200
+DEFAULT_TTL_SECONDS = 60 * 60
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def history_size(history: list) -> int:
+    """Approximate bytes held by a chat history, from the serialised size of each Content"""
+    size = 0
+    for content in history:
+        pb = getattr(content, "_pb", None)
+        size += pb.ByteSize() if pb is not None else len(str(content))
+    return size
+
+
+def history_from_pairs(paired_messages: list) -> list:
+    """
+    Chat history for GenerativeModel.start_chat(history=) from (human, ai) message pairs,
+    as sunholo's extract_chat_history() returns them. Pairs without an AI answer are dropped.
+    """
+    history = []
+    for human, ai in paired_messages:
+        if not ai:
+            continue
+        history.append({"role": "user", "parts": [human or "(no message)"]})
+        history.append({"role": "model", "parts": [ai]})
+    return history
+
+
+class Session:
+    """
+    One conversation's live state between requests: the chat with the model, the function responses
+    from its last turn that were never sent, and the tool state (files written, renders made).
+    """
+
+    def __init__(self, key: tuple, chat, model):
+        self.key = key
+        self.chat = chat
+        self.model = model
+        # function responses of the last turn, sent ahead of the next question so the model's calls are answered
+        self.pending = None
+        self.state = {"files": {}, "renders": {}}
+        self.pinned = set()
+        self.turns = 0
+        self.created = time.time()
+        self.last_used = self.created
+        self.size_bytes = 0
+
+
+class SessionStore:
+    """
+    Live sessions kept in memory between the requests of a conversation, so a follow-up continues the same
+    chat instead of rebuilding it from the chat_history the client sends.
+
+    A request takes its session out with checkout() and puts it back with checkin(), so two requests for
+    one session at once never share a chat - the second finds nothing and rebuilds. Sessions are evicted
+    least recently used first when there are more than max_sessions or their histories add up to more than
+    max_bytes, and dropped once unused for ttl_seconds. on_evict(session) is called for each one dropped.
+    """
+
+    def __init__(self,
+                 max_sessions: int = DEFAULT_MAX_SESSIONS,
+                 ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 on_evict=None):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, session: Session, now: float) -> bool:
+        return now - session.last_used > self.ttl_seconds
+
+    def checkout(self, key: tuple):
+        """The session stored under key, removed from the store until checkin(), or None."""
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is not None and self._expired(session, time.time()):
+                dropped = [session]
+                session = None
+            else:
+                dropped = []
+            if session is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._evicted(dropped)
+        return session
+
+    def checkin(self, session: Session):
+        """Stores session as the most recently used, evicting others to stay within the limits."""
+        now = time.time()
+        session.last_used = now
+        try:
+            session.size_bytes = history_size(session.chat.history)
+        except Exception as err:
+            # a broken streamed response leaves no coherent history to continue from
+            log.warning(f"Not keeping session {session.key} - {str(err)}")
+            self.discard(session)
+            return
+
+        with self._lock:
+            previous = self._sessions.pop(session.key, None)
+            self._sessions[session.key] = session
+            dropped = [previous] if previous is not None and previous is not session else []
+
+            for key in [key for key, stored in self._sessions.items() if self._expired(stored, now)]:
+                dropped.append(self._sessions.pop(key))
+            total = sum(stored.size_bytes for stored in self._sessions.values())
+            while self._sessions and (len(self._sessions) > self.max_sessions or total > self.max_bytes):
+                _, oldest = self._sessions.popitem(last=False)
+                total -= oldest.size_bytes
+                dropped.append(oldest)
+        self._evicted(dropped)
+
+    def discard(self, session: Session):
+        """Forgets session, e.g. after a request failed part way through its chat."""
+        with self._lock:
+            if self._sessions.get(session.key) is session:
+                del self._sessions[session.key]
+        self._evicted([session])
+
+    def _evicted(self, sessions: list):
+        for session in sessions:
+            self.evictions += 1
+            log.info(f"Dropped session {session.key} after {session.turns} turns, {session.size_bytes} bytes of history")
+            if self.on_evict:
+                try:
+                    self.on_evict(session)
+                except Exception as err:
+                    log.warning(f"Error cleaning up session {session.key} - {str(err)}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "history_bytes": sum(session.size_bytes for session in self._sessions.values()),
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+def get_session_store(**settings) -> SessionStore:
+    """The worker's SessionStore, created on first use."""
+    global _session_store
+    with _session_store_lock:
+        if _session_store is None:
+            _session_store = SessionStore(**settings)
+        for key in ("max_sessions", "ttl_seconds", "max_bytes"):
+            if key in settings:
+                setattr(_session_store, key, settings[key])
+        return _session_store
@@ -0,0 +1,118 @@
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import time
+import uuid
+
+from my_log import log
+
+# the SpanRecorder of the request being served, and the span currently open within it
+current_recorder = contextvars.ContextVar("current_recorder", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def args_digest(args: dict) -> str:
+    """Short stable hash of a tool's arguments, so calls can be compared without logging their content."""
+    encoded = json.dumps(args, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:12]
+
+
+def _size(value) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return len(json.dumps(value, default=str).encode("utf-8"))
+
+
+class SpanRecorder:
+    """
+    Records a timed span for each stage of a request (download, model call, tool, render, upload),
+    to see whether a slow answer came from the model, Quarto or storage.
+
+    Spans are plain dicts with name, parent, start (seconds since the recorder was created),
+    seconds and status, plus whatever attributes were given or added with annotate().
+    If log_spans is True each finished span is also logged as a structured log entry.
+    """
+
+    def __init__(self, trace_id: str = None, log_spans: bool = False):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.log_spans = log_spans
+        self.spans = []
+        self._started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs):
+        parent = current_span.get()
+        span = {
+            "name": name,
+            "parent": parent["name"] if parent else None,
+            "start": round(time.perf_counter() - self._started, 4),
+            **attrs,
+        }
+        recorder_token = current_recorder.set(self)
+        span_token = current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+            span.setdefault("status", "success")
+        except BaseException as err:
+            span["status"] = "error"
+            span["error"] = str(err)
+            raise
+        finally:
+            span["seconds"] = round(time.perf_counter() - start, 4)
+            current_span.reset(span_token)
+            current_recorder.reset(recorder_token)
+            self.spans.append(span)
+            if self.log_spans:
+                log.info(log_struct={"trace_id": self.trace_id, "span": span})
+
+    def wrap_tool(self, fn):
+        """fn timed as a 'tool' span, with its argument digest, bytes in and out and status."""
+        @functools.wraps(fn)
+        def wrapper(**kwargs):
+            with self.span("tool", tool=fn.__name__, args_digest=args_digest(kwargs), bytes_in=_size(kwargs)) as span:
+                result = fn(**kwargs)
+                span["bytes_out"] = _size(result)
+                try:
+                    parsed = json.loads(result) if isinstance(result, str) else result
+                except ValueError:
+                    parsed = None
+                if isinstance(parsed, dict):
+                    if parsed.get("status") == "error":
+                        span["status"] = "error"
+                    if "cached" in parsed and "cache_hit" not in span:
+                        span["cache_hit"] = bool(parsed["cached"])
+                return result
+        return wrapper
+
+    def tool_calls(self) -> list:
+        """The tool spans, in the order the tools were called."""
+        return [span for span in sorted(self.spans, key=lambda span: span["start"]) if span["name"] == "tool"]
+
+    def totals(self) -> dict:
+        """Total seconds per span name, e.g. how long was spent in the model versus rendering."""
+        totals = {}
+        for span in self.spans:
+            totals[span["name"]] = round(totals.get(span["name"], 0) + span["seconds"], 4)
+        return totals
+
+
+def span(name: str, **attrs):
+    """A child span of the current request's recorder, or a no-op outside one (e.g. in background jobs)."""
+    recorder = current_recorder.get()
+    if recorder is None:
+        return contextlib.nullcontext({})
+    return recorder.span(name, **attrs)
+
+
+def annotate(**attrs):
+    """Adds attributes such as cache_hit or bytes_out to the span currently open, if any."""
+    span = current_span.get()
+    if span is not None:
+        span.update(attrs)
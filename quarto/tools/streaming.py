@@ -0,0 +1,138 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from my_log import log
+
+from .bounded_output import BoundedOutput
+from .sandbox import apply_rlimits, process_group_rss, rlimit_enforcement, enforcement
+
+DEFAULT_HEAD_CHARS = 4000
+DEFAULT_TAIL_CHARS = 4000
+# how often the memory of a command with max_rss_bytes is checked
+WATCHDOG_SECONDS = 0.5
+
+
+def kill_process_group(process: subprocess.Popen):
+    """Kills process and anything it started, e.g. the Jupyter kernel or pandoc under quarto."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (OSError, AttributeError):
+        process.kill()
+
+
+def stream_subprocess(cmd: list,
+                      cwd: str = None,
+                      timeout: float = None,
+                      on_line=None,
+                      head_chars: int = DEFAULT_HEAD_CHARS,
+                      tail_chars: int = DEFAULT_TAIL_CHARS,
+                      max_rss_bytes: int = 0,
+                      max_output_chars: int = 0,
+                      rlimits: dict = None,
+                      **popen_kwargs) -> dict:
+    """
+    Runs cmd, calling on_line(stream_name, line) for each stdout/stderr line as it arrives.
+    Only the head and tail of each stream are kept (see BoundedOutput).
+    The command and its children are killed if it runs past timeout seconds, if together they use more than
+    max_rss_bytes of memory, or if they write more than max_output_chars to stdout and stderr.
+    rlimits (see sandbox.apply_rlimits()) cap the CPU seconds and file sizes of each process.
+
+    Returns:
+        dict: "returncode", "stdout", "stderr", "timed_out", "seconds", "peak_rss_bytes" (if watched),
+            "stdout_chars"/"stderr_chars" with the full size of each stream, and "limit", the
+            sandbox.enforcement() that stopped the command or None
+    """
+    start = time.time()
+    process = subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
+        bufsize=1,
+        start_new_session=True,
+        **popen_kwargs
+    )
+    apply_rlimits(process.pid, rlimits)
+    limits = []
+    outputs = {
+        "stdout": BoundedOutput(head_chars, tail_chars),
+        "stderr": BoundedOutput(head_chars, tail_chars),
+    }
+
+    def read(name, pipe):
+        for line in pipe:
+            outputs[name].append(line)
+            if max_output_chars and not limits:
+                written = outputs["stdout"].total_chars + outputs["stderr"].total_chars
+                if written > max_output_chars:
+                    limits.append(enforcement("output", max_output_chars, written,
+                                              f"Stopped after writing more than {max_output_chars} characters of output"))
+                    log.warning(f"Killing {cmd} after {written} characters of output")
+                    kill_process_group(process)
+            if on_line:
+                try:
+                    on_line(name, line)
+                except Exception as err:
+                    log.debug(f"on_line callback failed: {str(err)}")
+        pipe.close()
+
+    readers = [threading.Thread(target=read, args=(name, getattr(process, name)), daemon=True) for name in outputs]
+    for reader in readers:
+        reader.start()
+
+    timed_out = False
+    peak_rss = 0
+    deadline = start + timeout if timeout else None
+    while True:
+        wait_seconds = WATCHDOG_SECONDS if max_rss_bytes else None
+        if deadline:
+            wait_seconds = max(min(wait_seconds or timeout, deadline - time.time()), 0)
+        try:
+            process.wait(timeout=wait_seconds)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+
+        if deadline and time.time() >= deadline:
+            timed_out = True
+            limits.append(enforcement("wall_time", timeout, round(time.time() - start, 3),
+                                      f"Stopped after running for {timeout} seconds"))
+            log.warning(f"Killing {cmd} after {timeout}s")
+        elif max_rss_bytes:
+            rss = process_group_rss(process.pid)
+            peak_rss = max(peak_rss, rss)
+            if rss <= max_rss_bytes:
+                continue
+            limits.append(enforcement("memory", max_rss_bytes, rss,
+                                      f"Stopped when using {rss} bytes of memory, over the {max_rss_bytes} byte limit"))
+            log.warning(f"Killing {cmd} using {rss} bytes of memory")
+        else:
+            continue
+        kill_process_group(process)
+        process.wait()
+        break
+
+    for reader in readers:
+        reader.join(timeout=5)
+
+    if not limits and process.returncode:
+        limit = rlimit_enforcement(process.returncode, outputs["stderr"].text(), rlimits)
+        if limit:
+            limits.append(limit)
+
+    return {
+        "returncode": process.returncode,
+        "stdout": outputs["stdout"].text(),
+        "stderr": outputs["stderr"].text(),
+        "timed_out": timed_out,
+        "seconds": round(time.time() - start, 3),
+        "stdout_chars": outputs["stdout"].total_chars,
+        "stderr_chars": outputs["stderr"].total_chars,
+        "peak_rss_bytes": peak_rss or None,
+        "limit": limits[0] if limits else None,
+    }
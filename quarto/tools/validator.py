@@ -0,0 +1,230 @@
+import ast
+import re
+
+import yaml
+
+from .percent_script import parse_cells, CELL_DELIMITER, OPTION_PREFIX
+
+MAX_DIAGNOSTICS = 20
+# a literal \n (backslash then n) followed by what should have started a new line
+LITERAL_NEWLINE = re.compile(r'\\n\s*(#|---)')
+HEADER_EXAMPLE = "e.g. '# ---', '# title: My report', '# ---'"
+
+
+def _diagnostic(line: int, severity: str, message: str) -> dict:
+    return {"line": line, "severity": severity, "message": message}
+
+
+def _strip_comment(line: str, prefix: str = "#") -> str:
+    stripped = line.strip()
+    if stripped.startswith(prefix + " "):
+        return stripped[len(prefix) + 1:]
+    if stripped.startswith(prefix):
+        return stripped[len(prefix):]
+    return stripped
+
+
+def _comment_lines(lines: list, first_line: int) -> list:
+    """(line number, text) of each line of a markdown cell with its # removed, dropping triple quote lines"""
+    return [(number, _strip_comment(line)) for number, line in enumerate(lines, start=first_line)
+            if line.strip() not in ('"""', "'''")]
+
+
+def _yaml_error_line(err: yaml.YAMLError, line_numbers: list) -> int:
+    mark = getattr(err, "problem_mark", None) or getattr(err, "context_mark", None)
+    if mark is not None and mark.line < len(line_numbers):
+        return line_numbers[mark.line]
+    return line_numbers[0] if line_numbers else 1
+
+
+def check_header(text_lines: list, where: str, example: str = HEADER_EXAMPLE, missing: str = "error") -> list:
+    """
+    Checks that text_lines, (line number, text) pairs, start with a --- delimited YAML mapping.
+    A missing header is reported with the severity missing.
+    """
+    content = [(number, text) for number, text in text_lines if text.strip()]
+    if not content or content[0][1].strip() != "---":
+        line = content[0][0] if content else (text_lines[0][0] if text_lines else 1)
+        return [_diagnostic(line, missing, f"{where} should start with a YAML header between --- lines, {example}")]
+
+    opening = content[0][0]
+    header = []
+    for number, text in text_lines:
+        if number <= opening:
+            continue
+        if text.strip() == "---":
+            break
+        header.append((number, text))
+    else:
+        return [_diagnostic(opening, "error", "The YAML header opened here is never closed with a --- line")]
+
+    try:
+        parsed = yaml.safe_load("\n".join(text for _, text in header))
+    except yaml.YAMLError as err:
+        line = _yaml_error_line(err, [number for number, _ in header])
+        return [_diagnostic(line, "error", f"Invalid YAML in the header: {getattr(err, 'problem', None) or err}")]
+
+    if header and not isinstance(parsed, dict):
+        return [_diagnostic(opening, "error", "The YAML header must be 'key: value' lines, such as 'title: My report'")]
+
+    return []
+
+
+def check_options(lines: list, first_line: int) -> list:
+    """Checks the #| cell options at the top of a cell's lines, and warns about any found after its code."""
+    diagnostics = []
+    options = []
+    code_started = False
+    for number, line in enumerate(lines, start=first_line):
+        if line.startswith(OPTION_PREFIX) and not code_started:
+            options.append((number, line[len(OPTION_PREFIX):]))
+        elif line.startswith(OPTION_PREFIX):
+            diagnostics.append(_diagnostic(number, "warning",
+                                           "Cell options after the first line of code are ignored - move #| lines to the top of the cell"))
+        elif line.strip():
+            code_started = True
+
+    # an unindented option line without a colon throws off the YAML error position, so it is reported directly
+    for number, text in options:
+        if text.strip() and not text.startswith(("  ", "\t")) and ":" not in text:
+            return diagnostics + [_diagnostic(number, "error",
+                                              "Cell options must be '#| key: value' lines, such as '#| echo: false'")]
+
+    if options:
+        try:
+            parsed = yaml.safe_load("\n".join(text.strip() for _, text in options))
+            if not isinstance(parsed, dict):
+                diagnostics.append(_diagnostic(options[0][0], "error",
+                                               "Cell options must be '#| key: value' lines, such as '#| echo: false'"))
+        except yaml.YAMLError as err:
+            line = _yaml_error_line(err, [number for number, _ in options])
+            diagnostics.append(_diagnostic(line, "error",
+                                           f"Invalid #| cell option: {getattr(err, 'problem', None) or err} - use '#| key: value'"))
+
+    return diagnostics
+
+
+def check_python(lines: list, first_line: int) -> list:
+    """Compiles a code cell, skipping IPython magics and shell escapes."""
+    source = "\n".join("" if line.lstrip().startswith(('%', '!')) else line for line in lines)
+    try:
+        ast.parse(source)
+    except SyntaxError as err:
+        line = first_line + (err.lineno or 1) - 1
+        message = f"Python syntax error: {re.sub(r' [(]detected at line [0-9]+[)]', '', err.msg)}"
+        line_text = lines[err.lineno - 1] if err.lineno and err.lineno <= len(lines) else ""
+        if "\\n" in line_text and "continuation character" in err.msg:
+            message += " - the line holds a literal \\n where a line break was meant"
+        elif "unterminated" in err.msg:
+            message += " - if a \\n inside a string became a real line break, write it as \\\\n"
+        return [_diagnostic(line, "error", message)]
+    return []
+
+
+def check_literal_newlines(lines: list, line_numbers: set) -> list:
+    """
+    Warns about literal \\n sequences on the given lines, which should be markdown and comment lines only:
+    in code they are usually meant, e.g. Markdown("## Summary\\n### Details").
+    """
+    return [
+        _diagnostic(number, "warning", "Literal \\n sequences where there should be line breaks, "
+                                       "e.g. '\\n# %%' - put each cell delimiter, #| option and comment on its own line")
+        for number, line in enumerate(lines, start=1) if number in line_numbers and LITERAL_NEWLINE.search(line)
+    ]
+
+
+def _is_comment(line: str) -> bool:
+    return line.lstrip().startswith("#")
+
+
+def validate_percent_script(text: str) -> list:
+    """Diagnostics for a percent format .py script, as Quarto renders through Jupyter."""
+    lines = text.splitlines()
+    cells = parse_cells(text)
+
+    # cell delimiters, markdown cells and comments, leaving out code and the strings in it
+    prose = set()
+    for cell in cells:
+        delimited = cell["line"] <= len(lines) and CELL_DELIMITER.match(lines[cell["line"] - 1]) is not None
+        prose.add(cell["line"])
+        for number, line in enumerate(cell["lines"], start=cell["line"] + 1 if delimited else cell["line"]):
+            if cell["cell_type"] == "markdown" or _is_comment(line):
+                prose.add(number)
+    diagnostics = check_literal_newlines(lines, prose)
+
+    if not cells or cells[0]["cell_type"] != "markdown":
+        line = cells[0]["line"] if cells else 1
+        diagnostics.append(_diagnostic(line, "error", "The script must start with a '# %% [markdown]' cell "
+                                                      f"holding a YAML header between --- lines, {HEADER_EXAMPLE}"))
+
+    for position, cell in enumerate(cells):
+        delimited = cell["line"] <= len(lines) and CELL_DELIMITER.match(lines[cell["line"] - 1]) is not None
+        first_line = cell["line"] + 1 if delimited else cell["line"]
+
+        if cell["cell_type"] == "markdown" and position == 0:
+            diagnostics.extend(check_header(_comment_lines(cell["lines"], first_line), "The first markdown cell"))
+        elif cell["cell_type"] == "code":
+            diagnostics.extend(check_options(cell["lines"], first_line))
+            diagnostics.extend(check_python(cell["lines"], first_line))
+
+    return diagnostics
+
+
+def validate_r_script(text: str) -> list:
+    """Diagnostics for a knitr spin .r script, whose markdown and YAML header are #' lines."""
+    lines = text.splitlines()
+    diagnostics = check_literal_newlines(lines, {number for number, line in enumerate(lines, start=1) if _is_comment(line)})
+
+    header_lines = []
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        if not line.startswith("#'"):
+            break
+        header_lines.append((number, _strip_comment(line, prefix="#'")))
+    diagnostics.extend(check_header(
+        header_lines,
+        "An R script", example="e.g. \"#' ---\", \"#' title: My report\", \"#' ---\"", missing="warning"
+    ))
+
+    # each run of #| lines is one chunk's options
+    block = []
+    for number, line in enumerate(lines + [""], start=1):
+        if line.startswith(OPTION_PREFIX):
+            block.append(line)
+            continue
+        if block:
+            diagnostics.extend(check_options(block, number - len(block)))
+            block = []
+
+    return diagnostics
+
+
+def validate_script(filename: str) -> dict:
+    """
+    Checks a .py or .r script for the structural problems Quarto would fail or misrender on, without running anything:
+    the YAML header, #| cell options, Python syntax per cell, and literal \\n sequences left in place of line breaks.
+
+    Returns:
+        dict: "status" ("ok", or "error" if anything would stop the render), "errors", "warnings" and
+            "diagnostics", each with a 1-based "line", "severity" and "message"
+    """
+    with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+        text = f.read()
+
+    if filename.lower().endswith('.py'):
+        diagnostics = validate_percent_script(text)
+    elif filename.lower().endswith('.r'):
+        diagnostics = validate_r_script(text)
+    else:
+        diagnostics = []
+
+    diagnostics.sort(key=lambda diagnostic: (diagnostic["line"], diagnostic["severity"]))
+    errors = sum(1 for diagnostic in diagnostics if diagnostic["severity"] == "error")
+
+    return {
+        "status": "error" if errors else "ok",
+        "errors": errors,
+        "warnings": len(diagnostics) - errors,
+        "diagnostics": diagnostics[:MAX_DIAGNOSTICS],
+    }
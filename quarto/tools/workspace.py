@@ -0,0 +1,235 @@
+import contextlib
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from my_log import log
+
+from .render_cache import _folder_size
+from .sandbox import memory_share
+
+DEFAULT_WORKSPACE_ROOT = "renders"
+# renders/ is on Cloud Run's in-memory filesystem, so the quota is a share of the instance memory
+DEFAULT_QUOTA_BYTES = memory_share(0.15)
+# files and render trees touched more recently than this are never evicted, as the agent may still use them
+DEFAULT_MIN_AGE_SECONDS = 30 * 60
+# sizes are tracked as renders finish, and re-read from disk this often to count other workers' renders
+DEFAULT_RESCAN_SECONDS = 5 * 60
+SESSIONS_FOLDER = "sessions"
+
+
+def _safe_id(value: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(value))[:64] or "default"
+
+
+def _last_used(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def _size(path: str, is_dir: bool) -> int:
+    return _folder_size(path) if is_dir else os.path.getsize(path)
+
+
+class WorkspaceManager:
+    """
+    Hands out a unique render directory per render, under renders/sessions/<session_id>/,
+    and keeps the session folders within a disk quota.
+
+    When usage goes over quota_bytes the least recently used render trees and session files,
+    such as uploaded scripts, are deleted until it fits again. Render directories in use,
+    paths pinned by live chat sessions and anything touched in the last min_age_seconds are kept.
+    Only what is under renders/sessions/ is counted or evicted: files the agent writes elsewhere
+    in renders/ are its working files, and dot folders (.render_cache, .inputs...) bound themselves.
+
+    Sizes are recorded as each render finishes and as files are added with track(), so enforcing
+    the quota does not walk the tree. The session folders are re-read every rescan_seconds to pick
+    up renders and evictions by the other workers sharing renders/.
+    """
+
+    def __init__(self,
+                 root: str = DEFAULT_WORKSPACE_ROOT,
+                 quota_bytes: int = DEFAULT_QUOTA_BYTES,
+                 min_age_seconds: int = DEFAULT_MIN_AGE_SECONDS,
+                 rescan_seconds: int = DEFAULT_RESCAN_SECONDS):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.min_age_seconds = min_age_seconds
+        self.rescan_seconds = rescan_seconds
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._active = {}  # render dir -> count of renders using it
+        self._pinned = {}  # absolute path -> count of sessions pinning it
+        self._units = {}  # render dir or session file -> (last used, is_dir, size)
+        self._scanned_at = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, SESSIONS_FOLDER), exist_ok=True)
+
+    def session_dir(self, session_id: str) -> str:
+        path = os.path.join(self.root, SESSIONS_FOLDER, _safe_id(session_id))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def new_render_dir(self, session_id: str) -> str:
+        """A new, uniquely named directory for one render within the session."""
+        render_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        path = os.path.join(self.session_dir(session_id), render_id)
+        os.makedirs(path)
+        return path
+
+    @contextlib.contextmanager
+    def render_dir(self, session_id: str):
+        """
+        Yields a new render directory that is protected from eviction until the block ends,
+        after which its size is recorded and the quota is enforced.
+        """
+        path = self.new_render_dir(session_id)
+        with self._lock:
+            self._active[path] = self._active.get(path, 0) + 1
+        try:
+            yield path
+        finally:
+            with self._lock:
+                self._active[path] -= 1
+                if not self._active[path]:
+                    del self._active[path]
+            os.utime(path)
+            self.track(path)
+            self.enforce_quota()
+
+    def track(self, path: str):
+        """Records the size of a render tree or file added to a session folder outside render_dir()"""
+        try:
+            is_dir = os.path.isdir(path)
+            unit = (_last_used(path), is_dir, _size(path, is_dir))
+        except OSError:
+            return
+        with self._lock:
+            self._units[path] = unit
+
+    def pin(self, paths):
+        """Keeps paths, render trees or loose files such as scripts, from eviction until unpin()"""
+        with self._lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                self._pinned[path] = self._pinned.get(path, 0) + 1
+
+    def unpin(self, paths):
+        with self._lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                if path in self._pinned:
+                    self._pinned[path] -= 1
+                    if not self._pinned[path]:
+                        del self._pinned[path]
+
+    def _is_pinned(self, path: str) -> bool:
+        # a pinned session folder keeps every render tree in it
+        path = os.path.abspath(path)
+        return path in self._pinned or os.path.dirname(path) in self._pinned
+
+    def _scan(self) -> dict:
+        """Every render tree and file in the session folders, read from disk"""
+        units = {}
+        for session in os.scandir(os.path.join(self.root, SESSIONS_FOLDER)):
+            if not session.is_dir():
+                continue
+            for entry in os.scandir(session.path):
+                try:
+                    is_dir = entry.is_dir()
+                    units[entry.path] = (_last_used(entry.path), is_dir, _size(entry.path, is_dir))
+                except OSError:
+                    continue
+        return units
+
+    def _rescan_if_due(self):
+        if time.time() - self._scanned_at < self.rescan_seconds:
+            return
+        started = time.time()
+        units = self._scan()
+        with self._lock:
+            # keep what was tracked while the scan ran
+            units.update((path, unit) for path, unit in self._units.items() if unit[0] >= started)
+            self._units = units
+            self._scanned_at = started
+
+    def enforce_quota(self) -> int:
+        """Evicts least recently used render trees and files until usage is within quota. Returns bytes freed."""
+        self._rescan_if_due()
+        with self._lock:
+            total = sum(size for _, _, size in self._units.values())
+            if total <= self.quota_bytes:
+                return 0
+
+            cutoff = time.time() - self.min_age_seconds
+            freed = 0
+            for path, (last_used, is_dir, size) in sorted(self._units.items(), key=lambda item: item[1][0]):
+                if total - freed <= self.quota_bytes:
+                    break
+                if last_used > cutoff or path in self._active or self._is_pinned(path):
+                    continue
+                try:
+                    if is_dir:
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass  # evicted by another worker
+                except OSError as err:
+                    log.warning(f"Could not evict {path} - {str(err)}")
+                    continue
+                del self._units[path]
+                freed += size
+                self.evictions += 1
+
+            self.evicted_bytes += freed
+            self._remove_empty_sessions()
+
+        log.info(f"Workspace at {total} bytes was over its {self.quota_bytes} byte quota - evicted {freed} bytes")
+        if total - freed > self.quota_bytes:
+            log.warning(f"Workspace still at {total - freed} bytes after eviction - everything left is in use or recent")
+
+        return freed
+
+    def _remove_empty_sessions(self):
+        for session in os.scandir(os.path.join(self.root, SESSIONS_FOLDER)):
+            if session.is_dir() and not os.listdir(session.path):
+                try:
+                    os.rmdir(session.path)
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        self._rescan_if_due()
+        with self._lock:
+            return {
+                "root": self.root,
+                "usage_bytes": sum(size for _, _, size in self._units.values()),
+                "quota_bytes": self.quota_bytes,
+                "sessions": len({os.path.dirname(path) for path in self._units}),
+                "render_dirs": sum(1 for _, is_dir, _ in self._units.values() if is_dir),
+                "active_render_dirs": len(self._active),
+                "pinned_paths": len(self._pinned),
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+            }
+
+
+_workspace_manager = None
+_workspace_manager_lock = threading.Lock()
+
+def get_workspace_manager(**settings) -> WorkspaceManager:
+    """The worker's WorkspaceManager, created on first use."""
+    global _workspace_manager
+    with _workspace_manager_lock:
+        if _workspace_manager is None:
+            _workspace_manager = WorkspaceManager(**settings)
+        for key in ("quota_bytes", "min_age_seconds", "rescan_seconds"):
+            if key in settings:
+                setattr(_workspace_manager, key, settings[key])
+        return _workspace_manager
@@ -1,26 +1,241 @@
 from sunholo.utils import ConfigManager
 from sunholo.vertex import init_genai
-from sunholo.gcs import get_bytes_from_gcs
-
-from tools.quarto_agent import get_quarto, QuartoProcessor
-
-import mimetypes
-import tempfile
+from sunholo.agents import extract_chat_history
+
+from tools.quarto_agent import get_quarto, QuartoProcessor, QUARTO_BIN
+from tools.environment import get_environment_probe
+from tools.bounded_output import elide_middle
+from tools.spans import SpanRecorder
+from tools.emitter import TokenEmitter, TOOLS, LOOP, DEFAULT_FLUSH_CHARS, DEFAULT_FLUSH_SECONDS
+from tools.ingest import (
+    get_input_cache, DEFAULT_INPUTS_FOLDER, DEFAULT_MAX_BYTES as DEFAULT_INPUTS_MAX_BYTES,
+    DEFAULT_MIN_AGE_SECONDS as DEFAULT_INPUTS_MIN_AGE_SECONDS
+)
+from tools.workspace import get_workspace_manager
+from tools.sessions import (
+    get_session_store, Session, history_from_pairs,
+    DEFAULT_MAX_SESSIONS, DEFAULT_TTL_SECONDS as DEFAULT_SESSION_TTL_SECONDS, DEFAULT_MAX_BYTES as DEFAULT_SESSION_MAX_BYTES
+)
+
+import os
+import shutil
+import uuid
+import time
+import threading
 
 from my_log import log
 
-import google.generativeai as genai
 import json
 
-init_genai()
-
-# kwargs supports - image_uri, mime
+# seconds a cached config and model are used before being rebuilt, even if no config file changed
+VAC_CACHE_TTL = int(os.getenv("VAC_CACHE_TTL", 300))
+
+_vac_cache = {}
+_vac_cache_lock = threading.Lock()
+
+def _config_signature(config: ConfigManager) -> tuple:
+    signature = []
+    for folder in (config.config_folder, config.local_config_folder):
+        if not folder or not os.path.isdir(folder):
+            continue
+        for filename in sorted(os.listdir(folder)):
+            if filename.endswith(('.yaml', '.yml', '.json')):
+                path = os.path.join(folder, filename)
+                signature.append((path, os.path.getmtime(path)))
+    return tuple(signature)
+
+def get_vac(vector_name: str):
+    """
+    The ConfigManager and configured quarto model for vector_name, cached per process so requests
+    skip re-reading the YAML and rebuilding the model's tools and system instruction.
+    Rebuilt when a config file is modified or after VAC_CACHE_TTL seconds.
+
+    Returns:
+        tuple: (config, orchestrator) - orchestrator is None if no model could be configured
+    """
+    with _vac_cache_lock:
+        cached = _vac_cache.get(vector_name)
+    if cached:
+        config, orchestrator, signature, created = cached
+        if time.time() - created < VAC_CACHE_TTL and _config_signature(config) == signature:
+            return config, orchestrator
+        log.info(f"Rebuilding cached config and model for {vector_name}")
+
+    # the model is built and called with google.generativeai, so it is configured first
+    get_genai()
+    config = ConfigManager(vector_name)
+    orchestrator = get_quarto(config, QuartoProcessor(config))
+    if orchestrator:
+        with _vac_cache_lock:
+            _vac_cache[vector_name] = (config, orchestrator, _config_signature(config), time.time())
+
+    return config, orchestrator
+
+# google.generativeai is configured on first use rather than at import, so a gunicorn master preloading
+# this module (see gunicorn.conf.py) creates no clients that its forked workers would share
+_genai = None
+_genai_lock = threading.Lock()
+
+def get_genai():
+    """google.generativeai, configured with GOOGLE_API_KEY via init_genai() on first use."""
+    global _genai
+    with _genai_lock:
+        if _genai is None:
+            import google.generativeai as genai
+            init_genai()
+            _genai = genai
+        return _genai
+
+def warm_up(vector_names: list = None):
+    """
+    Does the per process setup a first request would otherwise wait for: configuring google.generativeai,
+    building the cached config and model of each of vector_names, and probing the Quarto environment.
+    Run by each gunicorn worker in the background once it has started.
+
+    Args:
+        vector_names: defaults to the comma separated VAC_WARM_UP environment variable
+    """
+    start = time.time()
+    try:
+        get_genai()
+    except Exception as err:
+        log.warning(f"Could not configure google.generativeai - {str(err)}")
+
+    if vector_names is None:
+        vector_names = [name.strip() for name in os.getenv("VAC_WARM_UP", "").split(",") if name.strip()]
+    for vector_name in vector_names:
+        try:
+            get_vac(vector_name)
+        except Exception as err:
+            log.warning(f"Could not warm up {vector_name} - {str(err)}")
+
+    get_environment_probe(quarto_bin=QUARTO_BIN).probe()
+    log.info(f"Warmed up {vector_names} in {time.time() - start:.2f}s")
+
+DEFAULT_MAX_PROMPT_TOKENS = 30000
+DEFAULT_KEEP_RECENT_TURNS = 4
+DEFAULT_MAX_TOOL_OUTPUT_CHARS = 2000
+
+def compact_history(chat, keep_recent_turns: int, max_chars: int) -> int:
+    """
+    Shortens the function results held in the chat history, apart from the last keep_recent_turns
+    messages, to max_chars each so long Quarto stdout/stderr stops being re-sent on every turn.
+
+    Returns:
+        int: How many function results were shortened
+    """
+    genai = get_genai()
+    history = list(chat.history)
+    cutoff = max(len(history) - keep_recent_turns, 0)
+    compacted = 0
+    for position, content in enumerate(history[:cutoff]):
+        parts = []
+        changed = False
+        for part in content.parts:
+            function_response = part.function_response
+            result = function_response.response.get("result") if function_response else None
+            if isinstance(result, str) and len(result) > max_chars:
+                part = genai.protos.Part(
+                    function_response=genai.protos.FunctionResponse(
+                        name=function_response.name,
+                        response={"result": elide_middle(result, max_chars),
+                                  "args": function_response.response.get("args")}
+                    )
+                )
+                changed = True
+                compacted += 1
+            parts.append(part)
+        if changed:
+            history[position] = genai.protos.Content(role=content.role, parts=parts)
+
+    if compacted:
+        chat.history = history
+
+    return compacted
+
+def release_session(session: Session):
+    """Lets the workspace evict a dropped session's files again."""
+    get_workspace_manager().unpin(session.pinned)
+    session.pinned = set()
+
+def start_session(processor: QuartoProcessor, orchestrator, vector_name: str, session_id: str, chat_history: list):
+    """
+    The request's Session: the conversation's live one if this worker has it, else a new one with its chat
+    rebuilt from chat_history. None if sessions are turned off via tools.quarto.sessions, or there is no session_id.
+
+    Returns:
+        tuple: (session, resumed)
+    """
+    sessions_config = processor.feature_config('sessions')
+    if sessions_config is None or not session_id:
+        return None, False
+
+    session_store = get_session_store(
+        max_sessions=int(sessions_config.get('max_sessions', DEFAULT_MAX_SESSIONS)),
+        ttl_seconds=int(sessions_config.get('ttl_seconds', DEFAULT_SESSION_TTL_SECONDS)),
+        max_bytes=int(sessions_config.get('max_bytes', DEFAULT_SESSION_MAX_BYTES)),
+        on_evict=release_session
+    )
+    session = session_store.checkout((vector_name, session_id))
+    if session is not None:
+        if session.model is not orchestrator:
+            # the config or model was rebuilt since the last request, so the history carries on with the new one
+            try:
+                session.chat = orchestrator.start_chat(history=session.chat.history)
+                session.model = orchestrator
+            except Exception as err:
+                log.warning(f"Could not move session {session.key} to the rebuilt model - {str(err)}")
+                session_store.discard(session)
+                session = None
+        if session is not None:
+            log.info(f"Resuming session {session.key} after {session.turns} turns - {session_store.stats()}")
+            return session, True
+
+    history = history_from_pairs(extract_chat_history(chat_history)) if chat_history else []
+    log.info(f"Starting session {(vector_name, session_id)} from {len(history)} chat_history messages")
+    return Session((vector_name, session_id), orchestrator.start_chat(history=history), orchestrator), False
+
+def end_session(processor: QuartoProcessor, session: Session, unsent: list, failed: bool):
+    """
+    Keeps the session for the conversation's next request, with the function responses the loop stopped
+    before sending, and its workspace folder and written files kept from eviction while it lives.
+    """
+    session_store = get_session_store()
+    if failed:
+        session_store.discard(session)
+        return
+
+    session.turns += 1
+    session.pending = unsent
+    paths = {processor.workspace().session_dir(processor.session_id)} | set(session.state.get("files", {}))
+    new_paths = paths - session.pinned
+    processor.workspace().pin(new_paths)
+    session.pinned |= new_paths
+    session_store.checkin(session)
+
+# kwargs supports - image_uri, mime, session_id, max_steps
 def vac_stream(question: str, vector_name:str, chat_history=[], callback=None, **kwargs):
     
-    config = ConfigManager(vector_name)
+    config, orchestrator = get_vac(vector_name)
+    # a new processor per request keeps function results (check_function_result) isolated
     processor = QuartoProcessor(config)
 
-    orchestrator = get_quarto(config, processor)
+    # streamed text is sent in batches, with the loop banners and tool progress shown as set by tools.quarto.stream
+    stream_config = processor.tool_config('stream', {}) or {}
+    emitter = TokenEmitter(
+        callback,
+        verbosity=stream_config.get('verbosity', 'all'),
+        flush_chars=int(stream_config.get('flush_chars', DEFAULT_FLUSH_CHARS)),
+        flush_seconds=float(stream_config.get('flush_seconds', DEFAULT_FLUSH_SECONDS))
+    )
+    processor.stream_callback = emitter
+
+    # one span per stage and tool call, returned in the metadata and optionally logged via tools.quarto.spans
+    spans_config = processor.feature_config('spans') or {}
+    recorder = SpanRecorder(log_spans=bool(spans_config.get('log', False)))
+    processor.funcs = {name: recorder.wrap_tool(fn) for name, fn in processor.funcs.items()}
+    processor.session_id = kwargs.get('session_id') or recorder.trace_id
+
     if not orchestrator:
         msg = f"No quarto model could be configured for {vector_name}"
         log.error(msg)
@@ -28,175 +243,234 @@ def vac_stream(question: str, vector_name:str, chat_history=[], callback=None, *
         return {"answer": msg}
     
     downloaded_file = None
-    mime_type = None
+    downloaded_content = None
     if 'image_uri' in kwargs:
         image_uri = kwargs['image_uri']
-        mime_type = kwargs['mime']
+        mime_type = kwargs.get('mime')
+
+        # attachments are streamed to a local cache keyed by content, and uploaded to the model once
+        input_config = processor.tool_config('input_cache', {}) or {}
+        input_cache = get_input_cache(
+            folder=input_config.get('folder', DEFAULT_INPUTS_FOLDER),
+            max_bytes=int(input_config.get('max_bytes', DEFAULT_INPUTS_MAX_BYTES)),
+            min_age_seconds=int(input_config.get('min_age_seconds', DEFAULT_INPUTS_MIN_AGE_SECONDS))
+        )
 
         log.info(f"Found {image_uri} - downloading...")
-        file_bytes = get_bytes_from_gcs(image_uri)
-        extension = mimetypes.guess_extension(mime_type)
-        if image_uri.endswith(".qmd") or image_uri.endswith(".md"):
-            extension = ".qmd"
+        try:
+            with recorder.span("download", uri=image_uri) as download_span:
+                downloaded = input_cache.download(image_uri, mime_type)
+                download_span.update(bytes_in=downloaded["bytes"], cache_hit=downloaded["cache_hit"])
+            downloaded_file = downloaded["filename"]
+            log.info(f"Using {downloaded_file} for {image_uri}")
+        except Exception as err:
+            log.error(f"Could not download {image_uri} - {str(err)}")
+            downloaded = None
+
+        if downloaded_file and downloaded_file.endswith(('.py', '.r')):
+            # scripts may be edited by write_to_file, so the agent gets its own copy rather than the cached one
+            session_dir = processor.workspace().session_dir(processor.session_id)
+            script_copy = os.path.join(session_dir, f"{uuid.uuid4().hex[:8]}-{os.path.basename(downloaded_file)}")
+            shutil.copy(downloaded_file, script_copy)
+            processor.workspace().track(script_copy)
+            downloaded_file = script_copy
+
+        if downloaded:
+            try:
+                with recorder.span("genai_upload", bytes_out=downloaded["bytes"]) as upload_span:
+                    downloaded_content, upload_span["cache_hit"] = input_cache.genai_file(
+                        get_genai(), downloaded["filename"], downloaded["content_hash"]
+                    )
+                log.info(f"{downloaded_content=}")
+            except Exception as e:
+                log.warning(f"Could not upload {downloaded_file=} via genai.upload_file() - {str(e)}")
 
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=extension, dir="renders")
-        downloaded_file = temp_file.name
-        
-        with open(downloaded_file, 'wb') as f:
-            f.write(file_bytes)
-        
-        log.info(f"Created {downloaded_file} from {image_uri}")
-    
     content = [f"Please help the user with their question:<user_input>{question}</user_input>"] 
                
     if downloaded_file:
         content.append(f"A local file is available to work with located at: {downloaded_file}")
-        try:
-            downloaded_content = genai.upload_file(downloaded_file)
-            log.info(f"{downloaded_content=}")
+        if downloaded_content:
             content.append(downloaded_content)
-        except Exception as e:
-            log.warning(f"Could not upload {downloaded_file=} via genai.upload_file() - {str(e)}")
 
-    chat = orchestrator.start_chat()
+    # with a session_id, a follow-up continues the conversation's live chat rather than one rebuilt from chat_history
+    session, resumed = start_session(processor, orchestrator, vector_name, kwargs.get('session_id'), chat_history)
+    if session:
+        chat = session.chat
+        processor.session_state = session.state
+    else:
+        chat = orchestrator.start_chat()
+
+    # the chat keeps the history, so after the first turn only new function results are sent
+    message = content
+    if resumed and session.pending:
+        # the model's last calls are answered before the new question
+        message = list(session.pending) + content
+    unsent = None
+    model_failed = False
+    context_budget = processor.feature_config('context_budget')
 
     guardrail = 0
     guardrail_max = kwargs.get('max_steps', 10)
-    big_text = ""
     usage_metadata = {
                         "prompt_token_count": 0,
                         "candidates_token_count": 0,
                         "total_token_count": 0,
                     }
-    functions_called = []
 
-    while guardrail < guardrail_max:
+    try:
+        while guardrail < guardrail_max:
 
-        callback.on_llm_new_token(
-            token=f"\n----Loop [{guardrail}] Start------\n"
-            )
+            emitter.emit(f"\n----Loop [{guardrail}] Start------\n", LOOP)
 
-        log.info(f"# Loop [{guardrail}] - {content=}")
-        this_text = "" # reset for this loop
-        response = []
+            log.info(f"# Loop [{guardrail}] - {message=}")
+            loop_start = emitter.mark()
+            response = []
 
-        try:
-            callback.on_llm_new_token(token="\n= Calling Agent\n")
-            response = chat.send_message(content, stream=True)
+            # the model span covers sending the message and reading its streamed response
+            with recorder.span("model", loop=guardrail) as model_span:
+                try:
+                    emitter.emit("\n= Calling Agent\n", LOOP)
+                    emitter.flush()
+                    response = chat.send_message(message, stream=True)
+                    unsent = None
             
-        except Exception as e:
-            msg = f"Error sending {content} to model: {str(e)}"
-            log.info(msg)
-            callback.on_llm_new_token(token=msg)
-            break
-
-        loop_metadata = response.usage_metadata
-        if loop_metadata:
-            usage_metadata = {
-                "prompt_token_count": usage_metadata["prompt_token_count"] + (loop_metadata.prompt_token_count or 0),
-                "candidates_token_count": usage_metadata["candidates_token_count"] + (loop_metadata.candidates_token_count or 0),
-                "total_token_count": usage_metadata["total_token_count"] + (loop_metadata.total_token_count or 0),
-            }
-            callback.on_llm_new_token(token=(
-                "\n-- Agent response\n" 
-                f"prompt_token_count: [{loop_metadata.prompt_token_count}]/[{usage_metadata["prompt_token_count"]}] "
-                f"candidates_token_count: [{loop_metadata.candidates_token_count}]/[{usage_metadata["candidates_token_count"]}] "
-                f"total_token_count: [{loop_metadata.total_token_count}]/[{usage_metadata["total_token_count"]}] \n"
-                ))
-        loop_metadata = None
+                except Exception as e:
+                    msg = f"Error sending {message} to model: {str(e)}"
+                    log.info(msg)
+                    emitter.emit(msg)
+                    model_span["status"] = "error"
+                    model_span["error"] = str(e)
+                    model_failed = True
+                    break
+
+                loop_metadata = response.usage_metadata
+                loop_prompt_tokens = 0
+                if loop_metadata:
+                    loop_prompt_tokens = loop_metadata.prompt_token_count or 0
+                    model_span["prompt_tokens"] = loop_prompt_tokens
+                    model_span["candidates_tokens"] = loop_metadata.candidates_token_count or 0
+                    usage_metadata = {
+                        "prompt_token_count": usage_metadata["prompt_token_count"] + (loop_metadata.prompt_token_count or 0),
+                        "candidates_token_count": usage_metadata["candidates_token_count"] + (loop_metadata.candidates_token_count or 0),
+                        "total_token_count": usage_metadata["total_token_count"] + (loop_metadata.total_token_count or 0),
+                    }
+                    emitter.emit((
+                        "\n-- Agent response\n" 
+                        f"prompt_token_count: [{loop_metadata.prompt_token_count}]/[{usage_metadata["prompt_token_count"]}] "
+                        f"candidates_token_count: [{loop_metadata.candidates_token_count}]/[{usage_metadata["candidates_token_count"]}] "
+                        f"total_token_count: [{loop_metadata.total_token_count}]/[{usage_metadata["total_token_count"]}] \n"
+                        ), LOOP)
+                loop_metadata = None
     
-        for chunk in response:
-            if not chunk:
-                continue
-
-            log.debug(f"[{guardrail}] {chunk=}")
-            try:
-                # Check if 'text' is an attribute of chunk and if it's a string
-                if hasattr(chunk, 'text') and isinstance(chunk.text, str):
-                    token = chunk.text
-                    callback.on_llm_new_token(token=token)
-                    big_text += token
-                    this_text += token
-                else:
-                    log.info(f"skipping {chunk}")
+                for chunk in response:
+                    if not chunk:
+                        continue
+
+                    log.debug(f"[{guardrail}] {chunk=}")
+                    try:
+                        # Check if 'text' is an attribute of chunk and if it's a string
+                        if hasattr(chunk, 'text') and isinstance(chunk.text, str):
+                            emitter.answer(chunk.text)
+                        else:
+                            log.info(f"skipping {chunk}")
                 
-            except ValueError as err:
-                callback.on_llm_new_token(token=f"{str(err)} for {chunk=}")
-        
-        # change response to one with executed functions
-        executed_responses = processor.process_funcs(response)
-        log.info(f"[{guardrail}] {executed_responses=}")
-
-        if executed_responses:  
-            callback.on_llm_new_token(token="\nAgent function execution:\n")
-            for executed_response in executed_responses:
-                token = ""
-                fn = executed_response.function_response.name
-                fn_args = executed_response.function_response.response["args"]
-                fn_result = executed_response.function_response.response["result"]
-                log.info(f"{fn=}({fn_args}) {fn_result}]")
-
-                try:
-                    fn_result_json = json.loads(fn_result)
-                except Exception:
-                    log.warning(f"{fn_result} was not json decoded")
-                    fn_result_json=None
-
-                if fn == "decide_to_go_on":
-                    token = f"\n\n{'STOPPING' if not fn_result.get('go_on') else 'CONTINUE'}: {fn_result.get('chat_summary')}"
-                else:
-                    token = f"--- function call: {fn}({fn_args}) ---"
-                    if fn_result_json:
-                        if fn_result_json.get('stdout'):
-                            # ensures \n gets rendered correctly
-                            text = fn_result_json.get('stdout').encode('utf-8').decode('unicode_escape')
-                            token += text
-                        if fn_result_json.get('stderr'):
-                            text = fn_result_json.get('stdout').encode('utf-8').decode('unicode_escape')
-                            token += text
-                        if not fn_result_json.get('stdout') and fn_result_json.get('stderr'):
-                            token += f" - result:\n{fn_result}\n"
+                    except ValueError as err:
+                        emitter.emit(f"{str(err)} for {chunk=}")
+
+            # change response to one with executed functions
+            emitter.flush()
+            executed_responses = processor.process_funcs(response)
+            log.info(f"[{guardrail}] {executed_responses=}")
+
+            if executed_responses:  
+                emitter.emit("\nAgent function execution:\n", TOOLS)
+                for executed_response in executed_responses:
+                    token = ""
+                    fn = executed_response.function_response.name
+                    fn_args = executed_response.function_response.response["args"]
+                    fn_result = executed_response.function_response.response["result"]
+                    log.info(f"{fn=}({fn_args}) {fn_result}]")
+
+                    try:
+                        fn_result_json = json.loads(fn_result)
+                    except Exception:
+                        log.warning(f"{fn_result} was not json decoded")
+                        fn_result_json=None
+
+                    if fn == "decide_to_go_on":
+                        token = f"\n\n{'STOPPING' if not fn_result.get('go_on') else 'CONTINUE'}: {fn_result.get('chat_summary')}"
                     else:
-                        token += f" - result:\n{fn_result}\n"
+                        token = f"--- function call: {fn}({fn_args}) ---"
+                        # json.loads() has already turned escaped newlines in the output back into newlines
+                        if isinstance(fn_result_json, dict) and fn_result_json.get('stdout'):
+                            token += fn_result_json['stdout']
+                            token += fn_result_json.get('stderr') or ""
+                        else:
+                            token += f" - result:\n{fn_result}\n"
                 
-                big_text += token
-                this_text += token
-                callback.on_llm_new_token(token=token)
-        else:
-            token = "\nNo function executions where found\n"
-            callback.on_llm_new_token(token=token)
-            big_text += token
-            this_text += token
-
-        if this_text:
-            content.append(f"Agent: {this_text}")    
-            log.info(f"[{guardrail}] Updated content:\n{this_text}")
-        else:
-            log.warning(f"[{guardrail}] No content created this loop")
-            content.append(f"Agent: No response was found for loop [{guardrail}]")
-
-        callback.on_llm_new_token(
-            token=f"\n----Loop [{guardrail}] End------\n{usage_metadata}\n----------------------"
-            )
-
-        go_on_check = processor.check_function_result("decide_to_go_on", {"go_on":False})
-        if go_on_check:
-            log.info("Breaking agent loop")
-            break
+                    emitter.emit(token, TOOLS, record=True)
+            else:
+                emitter.emit("\nNo function executions where found\n", TOOLS, record=True)
+
+            this_text = emitter.text(since=loop_start)
+            if this_text:
+                log.info(f"[{guardrail}] Loop content:\n{this_text}")
+            else:
+                log.warning(f"[{guardrail}] No content created this loop")
+
+            if executed_responses:
+                message = executed_responses
+                unsent = executed_responses
+            else:
+                message = "No function was called in your last turn. Carry on with the task, or call decide_to_go_on()."
+
+            if context_budget and loop_prompt_tokens > int(context_budget.get('max_prompt_tokens', DEFAULT_MAX_PROMPT_TOKENS)):
+                compacted = compact_history(
+                    chat,
+                    keep_recent_turns=int(context_budget.get('keep_recent_turns', DEFAULT_KEEP_RECENT_TURNS)),
+                    max_chars=int(context_budget.get('max_tool_output_chars', DEFAULT_MAX_TOOL_OUTPUT_CHARS))
+                )
+                log.info(f"[{guardrail}] {loop_prompt_tokens} prompt tokens is over budget - compacted {compacted} function results")
+
+            emitter.emit(f"\n----Loop [{guardrail}] End------\n{usage_metadata}\n----------------------", LOOP)
+
+            go_on_check = processor.check_function_result("decide_to_go_on", {"go_on":False})
+            if go_on_check:
+                log.info("Breaking agent loop")
+                break
         
-        guardrail += 1
-        if guardrail > guardrail_max:
-            log.warning("Guardrail kicked in, more than 10 loops")
-            break
-
-    callback.on_llm_end(response=big_text)
+            guardrail += 1
+            if guardrail > guardrail_max:
+                log.warning("Guardrail kicked in, more than 10 loops")
+                break
+    except BaseException:
+        # a loop stopped part way leaves no coherent chat to continue, and the session's pins must still be released
+        if session:
+            end_session(processor, session, unsent, failed=True)
+        raise
+
+    if session:
+        end_session(processor, session, unsent, failed=model_failed)
+
+    big_text = emitter.close()
     log.info(f"orchestrator.response: {big_text}")
 
+    functions_called = [
+        {key: value for key, value in call.items() if key not in ("name", "parent")}
+        for call in recorder.tool_calls()
+    ]
+    timings = recorder.totals()
+    log.info(f"Timings for trace {recorder.trace_id}: {timings}")
+
     metadata = {
         "question:": question,
         "chat_history": chat_history,
         "usage_metadata": usage_metadata,
-        "functions_called": functions_called
+        "functions_called": functions_called,
+        "trace_id": recorder.trace_id,
+        "session": {"resumed": resumed, "turns": session.turns} if session else None,
+        "timings": timings,
+        "spans": recorder.spans
     }
 
     return {"answer": big_text or "No answer was given", "metadata": metadata}